@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""Benchmark scan, review and compress against a synthetic library.
+
+Everything runs on local disk with fake mediainfo, HandBrakeCLI and ffmpeg executables, so no NAS or media tools
+are needed. The same parameters always generate the same library. Results are written as JSON; pass an earlier
+result file to --compare to print the change for every metric.
+
+    python benchmark.py --files 10000 --depth 3 --output before.json
+    python benchmark.py --files 10000 --depth 3 --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import statistics
+import subprocess
+import zlib
+
+import media_manager as mm
+
+DEFAULTS = {
+    'files': 10000,  # Files in the scanned library
+    'depth': 3,  # Directory levels below movies/ and tv_shows/
+    'fanout': 10,  # Subdirectories per directory
+    'per-dir': 50,  # Files per leaf directory
+    'movie-share': 0.3,  # Share of the files placed under movies/
+    'non-english-share': 0.1,  # Share of files whose fake audio track is not English (the review queue)
+    'changed': 0.01,  # Share of files added before the incremental rescan
+    'workers': mm.SCAN_WORKERS,
+    'mediainfo-latency': 0.0,  # seconds per fake mediainfo call, on top of process startup
+    'handbrake-latency': 0.5,  # seconds per fake encode
+    'ffmpeg-latency': 0.0,
+    'compress-files': 10,
+    'compress-bytes': 4 * 1024 * 1024,
+    'jobs': 1,
+    'review-repeats': 20,
+    'workdir': os.path.join('/tmp', 'media_manager_bench'),
+}
+
+# Fake tools are Python scripts; latency comes from the environment so one set of scripts serves every run
+FAKE_MEDIAINFO = '''
+import json, os, sys, time, zlib
+time.sleep(float(os.environ.get('BENCH_MEDIAINFO_LATENCY', '0')))
+path = sys.argv[-1]
+non_english = zlib.crc32(path.encode()) % 1000 < float(os.environ.get('BENCH_NON_ENGLISH_SHARE', '0')) * 1000
+# 8 Mbps H.264 1080p, with the duration that bit rate gives this file's size, so the estimate favours compressing
+duration = max(os.path.getsize(path) * 8 / 8000000, 0.001)
+print(json.dumps({"media": {"track": [
+    {"@type": "General", "Duration": str(duration)},
+    {"@type": "Video", "Format": "AVC", "Width": "1920", "Height": "1080", "FrameRate": "23.976",
+     "BitRate": "8000000", "Duration": str(duration)},
+    {"@type": "Audio", "Language": "ja" if non_english else "en", "Format": "AAC", "Channels": "2", "BitRate": "128000"},
+    {"@type": "Text", "Language": "en", "Format": "UTF-8"}]}}))
+'''
+
+FAKE_HANDBRAKE = '''
+import json, os, sys, time
+args = sys.argv
+src, dst = args[args.index('-i') + 1], args[args.index('-o') + 1]
+latency = float(os.environ.get('BENCH_HANDBRAKE_LATENCY', '0'))
+# --json output: each object is a multi-line `Label: {` ... `}` block
+def report(state):
+    print("Progress: " + json.dumps(state, indent=4), flush=True)
+for step in range(5):
+    time.sleep(latency / 5)
+    report({"State": "WORKING", "Working": {"Pass": 1, "PassCount": 1, "Progress": step / 5,
+            "Rate": 100.0, "RateAvg": 100.0, "ETASeconds": 1}})
+report({"State": "WORKDONE"})
+with open(src, 'rb') as f:
+    data = f.read()
+with open(dst, 'wb') as f:
+    f.write(data[:max(1, len(data) // 3)])
+'''
+
+FAKE_FFMPEG = '''
+import os, sys, time
+time.sleep(float(os.environ.get('BENCH_FFMPEG_LATENCY', '0')))
+output = sys.argv[-1]
+if output not in ('-', 'pipe:1') and not output.startswith('-'):
+    with open(output, 'wb') as f:
+        f.write(b'\\0' * 1024)
+'''
+
+def install_fake_tools(bin_dir, params):
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, source in (('mediainfo', FAKE_MEDIAINFO), ('HandBrakeCLI', FAKE_HANDBRAKE), ('ffmpeg', FAKE_FFMPEG)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(f"#!{sys.executable}\n{source}")
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['BENCH_MEDIAINFO_LATENCY'] = str(params['mediainfo-latency'])
+    os.environ['BENCH_HANDBRAKE_LATENCY'] = str(params['handbrake-latency'])
+    os.environ['BENCH_FFMPEG_LATENCY'] = str(params['ffmpeg-latency'])
+    os.environ['BENCH_NON_ENGLISH_SHARE'] = str(params['non-english-share'])
+
+def get_library_path(root, index, params):
+    """Deterministic location of file number index: movies/ or tv_shows/, then depth levels of fanout dirs."""
+    directory = index // params['per-dir']
+    top = 'movies' if zlib.crc32(str(directory).encode()) % 100 < params['movie-share'] * 100 else 'tv_shows'
+    parts = []
+    for _ in range(params['depth']):
+        parts.append(f"d{directory % params['fanout']:02d}")
+        directory //= params['fanout']
+    # Directories past fanout ** depth share leaves, which only makes those leaves larger
+    return os.path.join(root, top, *reversed(parts), f"file_{index:07d}.mkv")
+
+def get_added_paths(root, params):
+    """Files created before the incremental rescan, spread across the tree as a day of downloads would be."""
+    added = max(1, int(params['files'] * params['changed']))
+    stride = max(1, params['files'] // added)
+    return [get_library_path(root, k * stride, params).replace('.mkv', f'_new{k}.mkv') for k in range(added)]
+
+def write_file(path, size, index):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique content keeps fingerprints distinct; the parsers reject it and fall back to mediainfo
+    head = f"synthetic media file {index}\n".encode()
+    with open(path, 'wb') as f:
+        f.write(head)
+        if size > len(head):
+            f.truncate(size)
+
+def generate_library(root, params):
+    """Create the library unless an identical one already exists; returns the seconds spent."""
+    layout = {key: params[key] for key in ('files', 'depth', 'fanout', 'per-dir', 'movie-share')}
+    manifest_path = os.path.join(root, '.bench.json')
+    try:
+        with open(manifest_path) as f:
+            if json.load(f) == layout:
+                return 0.0
+    except (OSError, ValueError):
+        pass
+    start = time.monotonic()
+    shutil.rmtree(root, ignore_errors=True)
+    for index in range(params['files']):
+        write_file(get_library_path(root, index, params), 64, index)
+    with open(manifest_path, 'w') as f:
+        json.dump(layout, f)
+    return time.monotonic() - start
+
+def timed(func, *args, **kwargs):
+    start = time.monotonic()
+    func(*args, **kwargs)
+    return time.monotonic() - start
+
+def bench_scan(library, conn, params):
+    results = {}
+    seconds = timed(mm.scan_files, library, conn, workers=params['workers'])
+    results['scan_cold'] = {'seconds': seconds, 'files_per_second': params['files'] / seconds}
+    seconds = timed(mm.scan_files, library, conn, workers=params['workers'])
+    results['scan_unchanged'] = {'seconds': seconds, 'files_per_second': params['files'] / seconds}
+
+    added = get_added_paths(library, params)
+    for k, path in enumerate(added):
+        write_file(path, 64, -k - 1)
+    time.sleep(mm.DIR_MTIME_SETTLE)  # Freshly modified directories are always relisted; let the changes settle
+    seconds = timed(mm.scan_files, library, conn, workers=params['workers'])
+    results['scan_incremental'] = {'seconds': seconds, 'files_added': len(added),
+                                   'files_per_second': len(added) / seconds}
+    return results
+
+def bench_review(conn, params):
+    samples = []
+    for _ in range(params['review-repeats']):
+        start = time.monotonic()
+        count = mm.count_files_without_english_audio(conn)
+        samples.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    rows = mm.get_files_without_english_audio(conn)
+    first = next(rows, None)
+    first_row = time.monotonic() - start
+    total = (first is not None) + sum(1 for _ in rows)
+    queue_seconds = time.monotonic() - start
+    return {'review_count': {'p50_ms': statistics.median(samples) * 1000, 'max_ms': max(samples) * 1000,
+                             'files': count},
+            'review_queue': {'first_row_ms': first_row * 1000, 'seconds': queue_seconds, 'files': total}}
+
+def bench_compress(library, conn, params):
+    for index in range(params['compress-files']):
+        write_file(os.path.join(library, 'movies', f"compress_{index:04d}.mkv"), params['compress-bytes'], index)
+    mm.scan_files(library, conn, workers=params['workers'])
+    seconds = timed(mm.compress_files, 'movie', params['compress-bytes'] - 1, conn, jobs=params['jobs'])
+    done, timed_encodes = conn.execute("SELECT COUNT(*), COUNT(avg_fps) FROM compress_history").fetchone()
+    if timed_encodes < done:
+        # The planner learns encode speeds from avg_fps; missing values mean the progress output wasn't parsed
+        raise RuntimeError(f"{done - timed_encodes} of {done} compress_history rows have no avg_fps")
+    per_file = seconds / done if done else None
+    return {'compress': {'seconds': seconds, 'files': done, 'seconds_per_file': per_file,
+                         # What the pipeline adds on top of the (fake) encode itself
+                         'overhead_per_file': per_file - params['handbrake-latency'] / params['jobs'] if done else None}}
+
+def get_git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(old, new):
+    for name, metrics in new['results'].items():
+        for metric, value in metrics.items():
+            before = old.get('results', {}).get(name, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(before, (int, float)) or not before:
+                continue
+            print(f"{name:18} {metric:20} {before:12.4f} -> {value:12.4f}  ({(value - before) / before:+.1%})")
+
+def parse_params(options):
+    params = dict(DEFAULTS)
+    for name, value in options.items():
+        if name not in DEFAULTS:
+            raise ValueError(f"Unknown option --{name}")
+        default = DEFAULTS[name]
+        params[name] = type(default)(float(value)) if isinstance(default, int) else type(default)(value)
+    return params
+
+def main():
+    args, options = mm.parse_options(sys.argv[1:])
+    output = options.pop('output', None)
+    compare = options.pop('compare', None)
+    verbose = options.pop('verbose', False)
+    try:
+        params = parse_params(options)
+    except ValueError as e:
+        print(f"Error: {e}")
+        print(f"Options: {', '.join('--' + name for name in DEFAULTS)} --output FILE --compare FILE --verbose")
+        sys.exit(1)
+    if not verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    workdir = params['workdir']
+    library = os.path.join(workdir, 'library')
+    compress_library = os.path.join(workdir, 'compress_library')
+    install_fake_tools(os.path.join(workdir, 'bin'), params)
+    shutil.rmtree(compress_library, ignore_errors=True)
+    shutil.rmtree(os.path.join(workdir, 'staging'), ignore_errors=True)
+
+    # Keep every side effect inside workdir
+    mm.STORAGE_BACKEND = 'local'
+    mm.BANDWIDTH_LIMITS = {}
+    mm.DESTINATION_DIR = os.path.join(workdir, 'staging')
+    mm.PROFILE_CACHE_DIR = os.path.join(mm.DESTINATION_DIR, 'profiles')
+    mm.HANDBRAKE_PRESET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compress.json')
+
+    generate_seconds = generate_library(library, params)
+    # Every run starts from an empty database and the generated tree without files added by an earlier run
+    for path in [os.path.join(workdir, 'files.db' + suffix) for suffix in ('', '-wal', '-shm')] + get_added_paths(library, params):
+        if os.path.exists(path):
+            os.remove(path)
+
+    conn = mm.setup_database(os.path.join(workdir, 'files.db'))
+    try:
+        results = {}
+        results.update(bench_scan(library, conn, params))
+        results.update(bench_review(conn, params))
+        if params['compress-files']:
+            results.update(bench_compress(compress_library, conn, params))
+    finally:
+        conn.close()
+
+    report = {'timestamp': int(time.time()), 'git_revision': get_git_revision(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'params': params,
+              'generate_seconds': generate_seconds, 'results': results}
+    print(json.dumps(results, indent=2))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if compare:
+        with open(compare) as f:
+            compare_results(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
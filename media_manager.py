@@ -10,6 +10,26 @@ import subprocess
 import logging
 import time
 import shutil
+import hashlib
+import errno
+import queue
+import threading
+import socket
+import collections
+import copy
+import ctypes
+import ctypes.util
+import select
+import struct
+import zlib
+import csv
+import bisect
+import contextlib
+import re
+try:
+    import fcntl
+except ImportError:  # Windows; bandwidth buckets are then per process
+    fcntl = None
 
 # Logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
@@ -20,10 +40,93 @@ SMB_SERVER = "mnemosyn._smb._tcp.local"
 SMB_PATH = "/media"
 MOUNT_POINT = "/Users/dstorey/Desktop/movie_processing/media"
 MAX_RETRIES = 3
-RETRY_DELAY = 5  # seconds
+RETRY_DELAY = 5  # seconds; doubled after every failed attempt
+STORAGE_BACKEND = 'smb'  # 'smb' keeps SMB_SERVER mounted at MOUNT_POINT; 'local' for a library the host already mounts
+MOUNT_CHECK_TTL = 10  # seconds a mount health check is reused
+# Bytes/s drawn from the NAS, per direction and per 'direction:class' (copy, probe, retag); absent means unlimited
+BANDWIDTH_LIMITS = {
+    'read': 80 * 1024 ** 2,
+    'write': 80 * 1024 ** 2,
+    'read:probe': 20 * 1024 ** 2,
+    'write:retag': 30 * 1024 ** 2,
+}
+BANDWIDTH_SCHEDULE = ((18, 24, 0.25),)  # (start hour, end hour, factor): limits are scaled in these local hours
+BANDWIDTH_BURST_SECONDS = 1.0  # A bucket holds at most this many seconds of its rate
 DB_WRITE_INTERVAL = 10  # Write to DB every 10 files processed
+SCAN_WORKERS = 1  # Concurrent mediainfo probes during scan
+SCAN_QUEUE_SIZE = 256  # Max files waiting for a probe worker
+FINGERPRINT_BLOCK_SIZE = 64 * 1024  # Bytes hashed from the head, middle and tail of each file
+METADATA_CACHE_MAX_AGE = 180 * 24 * 3600  # seconds; cache entries unused for longer are evicted
+METADATA_CACHE_MAX_ENTRIES = 500000
+DIR_MTIME_SETTLE = 2  # seconds; directories modified more recently than this are rescanned next time
+# seconds between scans that relist every directory; files rewritten in place leave their directory's mtime alone
+FULL_SCAN_INTERVAL = 7 * 24 * 3600
+WATCH_SETTLE_SECONDS = 10  # `watch` probes a file once its size has not changed for this long
+WATCH_POLL_INTERVAL = 30  # seconds between incremental scans when inotify is unavailable
+WATCH_RESCAN_INTERVAL = 3600  # seconds between safety-net incremental scans while inotify is active
+NATIVE_PROBE = True  # Read MKV/MP4 track headers in-process instead of running mediainfo
+HEADER_ELEMENT_LIMIT = 1024 * 1024  # Largest header element/box read by the native parsers; bigger ones fall back
+NETWORK_FILESYSTEMS = {'cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'afpfs', 'fuse.sshfs'}  # Don't deliver remote inotify events
 DESTINATION_DIR = '/Users/dstorey/Desktop/movie_processing/'
+BANDWIDTH_STATE_DIR = os.path.join(DESTINATION_DIR, 'bandwidth')  # Bucket files shared by every process on the host
 HANDBRAKE_PRESET = '/Users/dstorey/Desktop/movie_processing/compress.json'
+PROFILE_CACHE_DIR = os.path.join(DESTINATION_DIR, 'profiles')  # Per-source presets generated from HANDBRAKE_PRESET
+# Maximum output picture sizes (width, height), smallest first. A source gets the smallest one at least as wide as
+# itself, so it is never downscaled below its own size; only sources wider than the last tier are scaled down to it
+PROFILE_RESOLUTION_TIERS = ((854, 480), (1280, 720), (1920, 1080), (3840, 2160))
+MULTIPASS_MIN_WIDTH = 1600  # Narrower sources are encoded in a single pass
+X265_PRESETS = {'movie': 'faster', 'tv_show': 'veryfast'}  # x265 speed preset per content type
+HANDBRAKE_FRAME_RATES = (23.976, 24, 25, 29.97, 30, 48, 50, 59.94, 60)  # Rates HandBrake accepts for VideoFramerate
+STAGING_BUDGET_BYTES = 200 * 1024 ** 3  # Max local disk used by staged inputs and outputs during compress
+STAGING_FREE_SPACE_RATIO = 0.9  # Never plan to use more than this share of the free space in DESTINATION_DIR
+PREFETCH_DEPTH = 1  # Files copied in ahead of the one currently encoding
+ENCODE_JOBS = 1  # Concurrent HandBrakeCLI encodes
+CORES_PER_ENCODE = 8  # Cores one encode can keep busy; used by `--jobs auto`
+LARGE_FILE_BYTES = 10 * 1024 ** 3  # Files at least this big get a larger share of the core budget
+CHUNKED_ENCODE_MIN_BYTES = 20 * 1024 ** 3  # Files at least this big are split at keyframes and encoded in parallel
+CHUNK_SEGMENTS = None  # Segments per chunked encode; None gives one per CORES_PER_ENCODE cores granted to the encode
+CHUNK_DURATION_TOLERANCE = 2.0  # seconds a chunked encode's duration may differ from its source
+CLAIM_TIMEOUT = 48 * 3600  # seconds; claims older than this are considered abandoned
+LEASE_DURATION = 600  # seconds a `compress --worker` lease stays valid without a heartbeat
+LEASE_RENEW_INTERVAL = 120  # seconds between lease heartbeats
+MAX_JOB_ATTEMPTS = 3  # Leases handed out per queued job before it is marked failed
+ORPHAN_MIN_AGE = 3600  # seconds; untracked staging directories older than this are removed
+CHECKSUM_CHUNK_SIZE = 8 * 1024 * 1024
+COPY_BUFFER_SIZE = 16 * 1024 * 1024  # Bytes per read/write in copy_file
+COPY_RETRIES = 3  # Resumed attempts after a failed copy
+COPY_VERIFY = True  # Hash copies inline and compare sampled blocks of source and destination afterwards
+COPY_READ_BACK = True  # With COPY_VERIFY, re-read whole uploads from the share and compare them with the source hash
+# Expected video bit rate of a compress.json encode (x265 RF 24), keyed by minimum source width; height varies with cropping
+TARGET_VIDEO_BITRATES = ((3200, 8000000), (2200, 4500000), (1600, 2500000), (1100, 1200000), (0, 700000))
+AUDIO_OUTPUT_BITRATE = 160000  # compress.json keeps one AAC track at 160 kbps
+EFFICIENT_CODECS = {'HEVC', 'AV1', 'VP9'}
+EFFICIENT_CODEC_MIN_RATIO = 0.85  # Re-encoding these rarely saves more than this, whatever the bit rate
+COMPRESSION_RATIO_THRESHOLD = 0.7  # Files expected to end up larger than this share of their size are skipped
+TRIAL_SEGMENTS = 3  # Segments encoded by `estimate --trial`
+TRIAL_SEGMENT_SECONDS = 30
+# Encode speed (frames/s) per minimum source width, used until compress_history has enough samples
+DEFAULT_ENCODE_FPS = ((3200, 6.0), (1600, 25.0), (1100, 50.0), (0, 100.0))
+DEFAULT_FRAME_RATE = 24.0
+ASSUMED_SOURCE_BIT_RATE = 8000000  # bits/s; gives files without a probed duration a running time to plan with
+PLANNER_MIN_SAMPLES = 3  # Completed encodes needed before measured speeds and ratios replace the defaults
+PROGRESS_LOG_INTERVAL = 60  # seconds between progress lines for each running encode
+STDERR_TAIL_LINES = 50  # HandBrakeCLI log lines kept for the error report of a failed encode
+# Upper bounds (seconds) of the per-phase latency histogram buckets; one more bucket takes anything slower
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 14400)
+PROMETHEUS_TEXTFILE = None  # Path for node_exporter's textfile collector, rewritten after every run; None to disable
+DEDUPE_DURATION_TOLERANCE = 2.0  # seconds; `dedupe --similar` groups files of one content type this close in running time
+DEDUPE_SIZE_RATIO = 4.0  # ...whose sizes are within this factor of each other
+# Release tags that end the title part of a file name, e.g. "Movie.Name.2010.1080p.BluRay.x264"
+RELEASE_TAG_PATTERN = re.compile(r'\b(?:\d{3,4}p|[xh] ?26[45]|hevc|avc|blu ?ray|bdrip|brrip|web ?dl|web ?rip|hdtv|dvdrip|'
+                                 r'remux|proper|repack|hdr|10 ?bit)\b.*')
+REVIEW_CACHE_DIR = os.path.join(DESTINATION_DIR, 'review_cache')  # Contact sheets and audio snippets for `review`
+REVIEW_CACHE_MAX_BYTES = 2 * 1024 ** 3  # Least recently used previews are evicted beyond this
+REVIEW_PREFETCH_DEPTH = 3  # Files previewed ahead of the one under review
+REVIEW_PREVIEW_WAIT = 60  # seconds review waits for a preview that is still being built
+CONTACT_SHEET_FRAMES = 12  # Keyframes per contact sheet, tiled CONTACT_SHEET_COLUMNS wide
+CONTACT_SHEET_COLUMNS = 4
+CONTACT_SHEET_THUMB_WIDTH = 480
+AUDIO_SNIPPET_SECONDS = 20  # Length of the clip cut from each audio track
 
 VIDEO_EXTENSIONS = {
     '.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.webm', '.m4v', 
@@ -53,6 +156,135 @@ def setup_database(db_path):
     )
     ''')
 
+    # Create scan_directories table (per-directory index for incremental scans)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scan_directories (
+        dir_path TEXT PRIMARY KEY,
+        parent_path TEXT,
+        mtime_ns INTEGER,
+        entry_count INTEGER,
+        last_scanned INTEGER
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_scan_directories_parent ON scan_directories (parent_path)")
+
+    # Create metadata_cache table (parsed track metadata keyed by content fingerprint)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS metadata_cache (
+        fingerprint TEXT PRIMARY KEY,
+        file_size INTEGER,
+        audio_metadata TEXT,
+        subtitle_metadata TEXT,
+        created INTEGER,
+        last_used INTEGER
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_metadata_cache_last_used ON metadata_cache (last_used)")
+
+    # Create audio_tracks and subtitle_tracks tables (one row per track of a media_files row)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS audio_tracks (
+        file_path TEXT,
+        track_index INTEGER,
+        language TEXT,
+        format TEXT,
+        channels TEXT,
+        bit_rate TEXT,
+        is_english BOOLEAN,
+        PRIMARY KEY (file_path, track_index)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_audio_tracks_language ON audio_tracks (language)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS subtitle_tracks (
+        file_path TEXT,
+        track_index INTEGER,
+        language TEXT,
+        format TEXT,
+        is_english BOOLEAN,
+        PRIMARY KEY (file_path, track_index)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_subtitle_tracks_language ON subtitle_tracks (language)")
+
+    # Create compress_jobs table (lease-based work queue shared by `compress --worker` processes)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS compress_jobs (
+        file_path TEXT PRIMARY KEY,
+        content_type TEXT,
+        file_size INTEGER,
+        status TEXT,
+        worker_id TEXT,
+        heartbeat INTEGER,
+        lease_expires INTEGER,
+        attempts INTEGER DEFAULT 0,
+        last_error TEXT,
+        enqueued_at INTEGER,
+        updated_at INTEGER
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_compress_jobs_status ON compress_jobs (status, file_size)")
+
+    # Create compress_state table (last completed phase of each compression, for crash recovery)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS compress_state (
+        file_path TEXT PRIMARY KEY,
+        phase TEXT,
+        artifact_path TEXT,
+        checksum TEXT,
+        host TEXT,
+        updated_at INTEGER
+    )
+    ''')
+
+    # Create compress_history table (one row per finished encode, used by the compress planner)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS compress_history (
+        id INTEGER PRIMARY KEY,
+        file_path TEXT,
+        content_type TEXT,
+        video_codec TEXT,
+        video_width INTEGER,
+        duration REAL,
+        frame_rate REAL,
+        original_size INTEGER,
+        compressed_size INTEGER,
+        encode_seconds REAL,
+        threads INTEGER,
+        completed_at INTEGER
+    )
+    ''')
+
+    # Create metric_runs, phase_metrics and run_counters tables (per-run instrumentation shown by `stats`)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS metric_runs (
+        id INTEGER PRIMARY KEY,
+        command TEXT,
+        host TEXT,
+        started_at INTEGER,
+        finished_at INTEGER
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS phase_metrics (
+        run_id INTEGER,
+        phase TEXT,
+        count INTEGER,
+        total_seconds REAL,
+        max_seconds REAL,
+        buckets TEXT,
+        PRIMARY KEY (run_id, phase)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS run_counters (
+        run_id INTEGER,
+        name TEXT,
+        value INTEGER,
+        PRIMARY KEY (run_id, name)
+    )
+    ''')
+
     # Create metadata table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS metadata (
@@ -68,9 +300,125 @@ def setup_database(db_path):
         pass
 
     conn.commit()
+    migrate_database(conn)
     logging.info("Database schema created successfully")
     return conn
 
+def _get_columns(cursor, table):
+    return {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+
+def _migrate_track_tables(cursor):
+    # Adds media_files.has_english_audio and backfills it plus the track tables from the JSON columns
+    if 'has_english_audio' not in _get_columns(cursor, 'media_files'):
+        cursor.execute("ALTER TABLE media_files ADD COLUMN has_english_audio BOOLEAN")
+
+    last_rowid = 0
+    migrated = 0
+    while True:
+        rows = cursor.execute("""SELECT rowid, file_path, audio_metadata, subtitle_metadata FROM media_files
+                                 WHERE rowid > ? ORDER BY rowid LIMIT 1000""", (last_rowid,)).fetchall()
+        if not rows:
+            break
+        for rowid, file_path, audio_metadata, subtitle_metadata in rows:
+            audio_tracks = _load_tracks(audio_metadata)
+            subtitle_tracks = _load_tracks(subtitle_metadata)
+            write_track_rows(cursor, file_path, audio_tracks, subtitle_tracks)
+            cursor.execute("UPDATE media_files SET has_english_audio = ? WHERE rowid = ?",
+                           (has_english_audio(audio_tracks), rowid))
+            last_rowid = rowid
+        migrated += len(rows)
+    logging.info(f"Backfilled track tables for {migrated} files")
+
+    # Covers `review count` and the review queue without touching the base rows
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_media_files_review_queue ON media_files (file_path)
+    WHERE (has_been_reviewed IS NULL OR has_been_reviewed = 0) AND has_english_audio = 0
+    ''')
+
+def _migrate_compression_claims(cursor):
+    # Marks rows taken by a running compress job so concurrent jobs never encode the same file
+    columns = _get_columns(cursor, 'media_files')
+    if 'claimed_by' not in columns:
+        cursor.execute("ALTER TABLE media_files ADD COLUMN claimed_by TEXT")
+    if 'claimed_at' not in columns:
+        cursor.execute("ALTER TABLE media_files ADD COLUMN claimed_at INTEGER")
+
+# media_files columns holding the video_info keys of the same position
+VIDEO_COLUMNS = (('video_codec', 'TEXT'), ('video_width', 'INTEGER'), ('video_height', 'INTEGER'),
+                 ('frame_rate', 'REAL'), ('duration', 'REAL'), ('bit_rate', 'INTEGER'))
+VIDEO_INFO_KEYS = ('codec', 'width', 'height', 'frame_rate', 'duration', 'bit_rate')
+
+def _migrate_compression_estimates(cursor):
+    # Adds the probed video properties and the expected size ratio used to pick files worth compressing.
+    # Existing rows are filled in by the `estimate` command; cache entries without video metadata count as misses
+    columns = _get_columns(cursor, 'media_files')
+    for name, column_type in VIDEO_COLUMNS + (('estimated_ratio', 'REAL'), ('estimate_source', 'TEXT')):
+        if name not in columns:
+            cursor.execute(f"ALTER TABLE media_files ADD COLUMN {name} {column_type}")
+    if 'video_metadata' not in _get_columns(cursor, 'metadata_cache'):
+        cursor.execute("ALTER TABLE metadata_cache ADD COLUMN video_metadata TEXT")
+
+def _migrate_job_priority(cursor):
+    # Lets `compress --worker` lease queued jobs in planner order (bytes saved per encode-hour)
+    if 'priority' not in _get_columns(cursor, 'compress_jobs'):
+        cursor.execute("ALTER TABLE compress_jobs ADD COLUMN priority REAL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_compress_jobs_priority ON compress_jobs (status, priority)")
+
+def _migrate_encode_stats(cursor):
+    # Throughput and preset identity per encode, for hardware sizing and spotting preset regressions
+    columns = _get_columns(cursor, 'compress_history')
+    for name, column_type in (('avg_fps', 'REAL'), ('preset_name', 'TEXT'), ('preset_hash', 'TEXT'), ('host', 'TEXT')):
+        if name not in columns:
+            cursor.execute(f"ALTER TABLE compress_history ADD COLUMN {name} {column_type}")
+
+def _migrate_dedupe_index(cursor):
+    # Stores the scan fingerprint (size plus sampled-block hash) on each row so `dedupe` never rereads the library.
+    # Existing rows are fingerprinted by the first `dedupe` run
+    if 'fingerprint' not in _get_columns(cursor, 'media_files'):
+        cursor.execute("ALTER TABLE media_files ADD COLUMN fingerprint TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_files_fingerprint ON media_files (fingerprint) WHERE fingerprint IS NOT NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_files_duration ON media_files (content_type, duration) WHERE duration IS NOT NULL")
+
+def _migrate_report_indexes(cursor):
+    # Covering indexes for `report`/`query` aggregates and the compress selection, so neither reads the JSON-heavy rows
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_media_files_report ON media_files
+        (content_type, file_size, needs_compression, estimate_source, video_codec, has_been_reviewed,
+         has_english_audio, estimated_ratio)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_compress_history_completed ON compress_history
+        (completed_at, original_size, compressed_size)
+    ''')
+
+# Applied in order; the position in this list is the schema version reached after the migration
+SCHEMA_MIGRATIONS = [
+    _migrate_track_tables,
+    _migrate_compression_claims,
+    _migrate_compression_estimates,
+    _migrate_job_priority,
+    _migrate_encode_stats,
+    _migrate_dedupe_index,
+    _migrate_report_indexes,
+]
+
+def migrate_database(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM metadata WHERE key = 'schema_version'")
+    result = cursor.fetchone()
+    version = int(result[0]) if result else 0
+
+    for target_version, migration in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Migrating database to schema version {target_version}")
+        try:
+            migration(cursor)
+            cursor.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+                           ("schema_version", str(target_version)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
 def create_db_connection(db_path):
     try:
         conn = setup_database(db_path)
@@ -81,7 +429,31 @@ def create_db_connection(db_path):
 
 
 
-def get_file_metadata(file_path):
+def _parse_number(value):
+    # mediainfo reports numbers as strings, sometimes several separated by " / "
+    try:
+        return float(str(value).split('/')[0].strip())
+    except (TypeError, ValueError):
+        return None
+
+def get_video_info(tracks):
+    general = next((track for track in tracks if track.get('@type') == 'General'), {})
+    video = next((track for track in tracks if track.get('@type') == 'Video'), None)
+    if video is None:
+        return {}
+    width = _parse_number(video.get('Width'))
+    height = _parse_number(video.get('Height'))
+    bit_rate = _parse_number(video.get('BitRate'))
+    return {
+        'codec': video.get('Format', 'Unknown'),
+        'width': int(width) if width else None,
+        'height': int(height) if height else None,
+        'frame_rate': _parse_number(video.get('FrameRate')),
+        'duration': _parse_number(general.get('Duration')) or _parse_number(video.get('Duration')),
+        'bit_rate': int(bit_rate) if bit_rate else None
+    }
+
+def get_mediainfo_metadata(file_path):
     try:
         result = subprocess.run([
             'mediainfo',
@@ -93,8 +465,9 @@ def get_file_metadata(file_path):
         
         audio_tracks = []
         subtitle_tracks = []
+        tracks = data.get('media', {}).get('track', [])
         
-        for track in data.get('media', {}).get('track', []):
+        for track in tracks:
             if track.get('@type') == 'Audio':
                 audio_tracks.append({
                     'language': track.get('Language', 'Unknown'),
@@ -108,52 +481,687 @@ def get_file_metadata(file_path):
                     'format': track.get('Format', 'Unknown')
                 })
         
-        return audio_tracks, subtitle_tracks
+        return audio_tracks, subtitle_tracks, get_video_info(tracks)
     except subprocess.CalledProcessError:
         logging.error(f"Error: mediainfo failed for {file_path}")
-        return [], []
+        return [], [], {}
     except Exception as e:
         logging.error(f"Error processing {file_path}: {str(e)}")
-        return [], []
+        return [], [], {}
+
+# Container header parsing. Values are reported the way mediainfo's JSON output names them, so rows probed
+# either way look the same to review and compress.
+
+ISO_639_2_TO_1 = {
+    'eng': 'en', 'fre': 'fr', 'fra': 'fr', 'ger': 'de', 'deu': 'de', 'spa': 'es', 'ita': 'it', 'jpn': 'ja',
+    'chi': 'zh', 'zho': 'zh', 'kor': 'ko', 'rus': 'ru', 'por': 'pt', 'dut': 'nl', 'nld': 'nl', 'swe': 'sv',
+    'nor': 'no', 'nob': 'nb', 'nno': 'nn', 'dan': 'da', 'fin': 'fi', 'pol': 'pl', 'cze': 'cs', 'ces': 'cs',
+    'hun': 'hu', 'gre': 'el', 'ell': 'el', 'tur': 'tr', 'heb': 'he', 'ara': 'ar', 'hin': 'hi', 'tha': 'th',
+    'vie': 'vi', 'ind': 'id', 'may': 'ms', 'msa': 'ms', 'ukr': 'uk', 'rum': 'ro', 'ron': 'ro', 'bul': 'bg',
+    'hrv': 'hr', 'srp': 'sr', 'slo': 'sk', 'slk': 'sk', 'slv': 'sl', 'est': 'et', 'lav': 'lv', 'lit': 'lt',
+    'ice': 'is', 'isl': 'is', 'per': 'fa', 'fas': 'fa', 'tam': 'ta', 'tel': 'te', 'cat': 'ca', 'baq': 'eu',
+    'eus': 'eu', 'glg': 'gl', 'tgl': 'tl',
+}
+# QuickTime files may carry a Macintosh language code instead of a packed ISO 639-2 code
+MAC_LANGUAGES = {0: 'en', 1: 'fr', 2: 'de', 3: 'it', 4: 'nl', 5: 'sv', 6: 'es', 7: 'da', 8: 'pt', 9: 'no',
+                 10: 'he', 11: 'ja', 12: 'ar', 13: 'fi', 14: 'el', 19: 'zh', 23: 'ko', 32: 'ru'}
+
+def _normalize_language(code):
+    if not code or code == 'und':
+        return 'Unknown'
+    return ISO_639_2_TO_1.get(code.lower(), code)
+
+MKV_CODECS = {
+    'V_MPEG4/ISO/AVC': 'AVC', 'V_MPEGH/ISO/HEVC': 'HEVC', 'V_AV1': 'AV1', 'V_VP9': 'VP9', 'V_VP8': 'VP8',
+    'V_MPEG2': 'MPEG Video', 'V_MPEG4/ISO/ASP': 'MPEG-4 Visual', 'V_MS/VFW/FOURCC': 'VfW',
+    'A_AAC': 'AAC', 'A_AC3': 'AC-3', 'A_EAC3': 'E-AC-3', 'A_DTS': 'DTS', 'A_TRUEHD': 'MLP FBA', 'A_FLAC': 'FLAC',
+    'A_OPUS': 'Opus', 'A_VORBIS': 'Vorbis', 'A_MPEG/L3': 'MPEG Audio', 'A_MPEG/L2': 'MPEG Audio', 'A_PCM': 'PCM',
+    'A_ALAC': 'ALAC',
+    'S_TEXT/UTF8': 'UTF-8', 'S_TEXT/ASS': 'ASS', 'S_TEXT/SSA': 'SSA', 'S_HDMV/PGS': 'PGS', 'S_VOBSUB': 'VobSub',
+    'S_TEXT/WEBVTT': 'WebVTT', 'S_DVBSUB': 'DVB Subtitle', 'S_HDMV/TEXTST': 'TextST',
+}
+MP4_CODECS = {
+    'avc1': 'AVC', 'avc3': 'AVC', 'hvc1': 'HEVC', 'hev1': 'HEVC', 'dvh1': 'HEVC', 'dvhe': 'HEVC', 'av01': 'AV1',
+    'vp09': 'VP9', 'mp4v': 'MPEG-4 Visual', 'apch': 'ProRes', 'apcn': 'ProRes', 'apcs': 'ProRes', 'apco': 'ProRes',
+    'ap4h': 'ProRes', 'jpeg': 'JPEG',
+    'mp4a': 'AAC', 'ac-3': 'AC-3', 'ec-3': 'E-AC-3', 'ac-4': 'AC-4', 'alac': 'ALAC', 'Opus': 'Opus', 'fLaC': 'FLAC',
+    'dtsc': 'DTS', 'dtsh': 'DTS', 'dtsl': 'DTS', 'mlpa': 'MLP FBA', 'lpcm': 'PCM', 'sowt': 'PCM', 'twos': 'PCM',
+    'tx3g': 'Timed Text', 'wvtt': 'WebVTT', 'stpp': 'TTML', 'c608': 'EIA-608',
+}
+AC3_ACMOD_CHANNELS = (2, 1, 2, 3, 3, 4, 4, 5)
+AC3_BITRATES = (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384, 448, 512, 576, 640)
+
+def _make_tracks(tracks, duration):
+    """Split parsed (type, info) tracks into the (audio_tracks, subtitle_tracks, video_info) get_file_metadata returns."""
+    audio_tracks = []
+    subtitle_tracks = []
+    video_info = {}
+    for track_type, info in tracks:
+        if track_type == 'audio':
+            audio_tracks.append({
+                'language': info.get('language', 'Unknown'),
+                'format': info.get('format', 'Unknown'),
+                'channels': str(info['channels']) if info.get('channels') else 'Unknown',
+                'bit_rate': str(info['bit_rate']) if info.get('bit_rate') else 'Unknown'
+            })
+        elif track_type == 'text':
+            subtitle_tracks.append({
+                'language': info.get('language', 'Unknown'),
+                'format': info.get('format', 'Unknown')
+            })
+        elif track_type == 'video' and not video_info:
+            video_info = {
+                'codec': info.get('format', 'Unknown'),
+                'width': info.get('width'),
+                'height': info.get('height'),
+                'frame_rate': round(info['frame_rate'], 3) if info.get('frame_rate') else None,
+                'duration': round(duration, 3) if duration else None,
+                'bit_rate': info.get('bit_rate')
+            }
+    if not audio_tracks and not subtitle_tracks and not video_info:
+        return None
+    return audio_tracks, subtitle_tracks, video_info
+
+def _read_vint(data, pos, keep_marker=False):
+    # EBML variable-length integer; element IDs keep their length marker, sizes don't (None = unknown size)
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while not first & mask:
+        mask >>= 1
+        length += 1
+        if length > 8:
+            raise ValueError("invalid EBML vint")
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    if len(data) < pos + length:
+        raise ValueError("truncated EBML vint")
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, pos + length
+
+def _ebml_children(data, start=0, end=None):
+    end = len(data) if end is None else end
+    pos = start
+    while pos < end:
+        element_id, pos = _read_vint(data, pos, keep_marker=True)
+        size, pos = _read_vint(data, pos)
+        if size is None:
+            size = end - pos
+        yield element_id, data[pos:pos + size]
+        pos += size
+
+def _ebml_uint(payload):
+    return int.from_bytes(payload, 'big')
+
+def _ebml_float(payload):
+    return struct.unpack('>f' if len(payload) == 4 else '>d', payload)[0]
+
+def _ebml_string(payload):
+    return payload.split(b'\0', 1)[0].decode('utf-8', 'replace')
+
+def _read_ebml_header(f, offset):
+    f.seek(offset)
+    header = f.read(12)
+    element_id, pos = _read_vint(header, 0, keep_marker=True)
+    size, pos = _read_vint(header, pos)
+    return element_id, offset + pos, size
+
+def _read_ebml_element(f, offset, expected_id):
+    element_id, payload_start, size = _read_ebml_header(f, offset)
+    if element_id != expected_id or size is None or size > HEADER_ELEMENT_LIMIT:
+        return None
+    f.seek(payload_start)
+    return f.read(size)
+
+MKV_SEGMENT, MKV_SEEK_HEAD, MKV_INFO, MKV_TRACKS, MKV_TAGS, MKV_CLUSTER = (
+    0x18538067, 0x114D9B74, 0x1549A966, 0x1654AE6B, 0x1254C367, 0x1F43B675)
+
+def _matroska_layout(f):
+    """Header offsets of the Segment's top-level elements: those before the first cluster plus anything the
+    SeekHead points past it (usually Tags). None if this isn't a Matroska file."""
+    element_id, payload_start, size = _read_ebml_header(f, 0)
+    if element_id != 0x1A45DFA3 or size is None:
+        return None
+    element_id, segment_start, segment_size = _read_ebml_header(f, payload_start + size)
+    if element_id != MKV_SEGMENT:
+        return None
+    segment_end = segment_start + segment_size if segment_size is not None else os.fstat(f.fileno()).st_size
+
+    positions = {}
+    offset = segment_start
+    while offset < segment_end:
+        element_id, payload_start, size = _read_ebml_header(f, offset)
+        if element_id == MKV_CLUSTER or size is None:
+            break
+        positions.setdefault(element_id, offset)
+        if element_id == MKV_SEEK_HEAD and size <= HEADER_ELEMENT_LIMIT:
+            f.seek(payload_start)
+            for seek_id, seek in _ebml_children(f.read(size)):
+                if seek_id != 0x4DBB:
+                    continue
+                fields = dict(_ebml_children(seek))
+                if 0x53AB in fields and 0x53AC in fields:
+                    positions.setdefault(_ebml_uint(fields[0x53AB]), segment_start + _ebml_uint(fields[0x53AC]))
+        offset = payload_start + size
+    return positions
+
+def parse_matroska(file_path):
+    """Read track headers from an MKV/WebM file; None when they can't be found near the start."""
+    with open(file_path, 'rb') as raw:
+        f = ThrottledReader(raw, 'probe')
+        positions = _matroska_layout(f)
+        if positions is None or MKV_TRACKS not in positions:
+            return None
+
+        duration = None
+        info = _read_ebml_element(f, positions[MKV_INFO], MKV_INFO) if MKV_INFO in positions else None
+        if info:
+            fields = dict(_ebml_children(info))
+            if 0x4489 in fields:
+                timecode_scale = _ebml_uint(fields[0x2AD7B1]) if 0x2AD7B1 in fields else 1000000
+                duration = _ebml_float(fields[0x4489]) * timecode_scale / 1e9
+
+        # mkvmerge's statistics tags carry the per-track bit rate mediainfo reports
+        bit_rates = {}
+        tags = _read_ebml_element(f, positions[MKV_TAGS], MKV_TAGS) if MKV_TAGS in positions else None
+        for tag_id, tag in _ebml_children(tags or b''):
+            if tag_id != 0x7373:
+                continue
+            track_uids = []
+            for child_id, child in _ebml_children(tag):
+                if child_id == 0x63C0:
+                    track_uids += [_ebml_uint(value) for target_id, value in _ebml_children(child) if target_id == 0x63C5]
+                elif child_id == 0x67C8:
+                    simple = dict(_ebml_children(child))
+                    if _ebml_string(simple.get(0x45A3, b'')) == 'BPS' and 0x4487 in simple:
+                        for track_uid in track_uids:
+                            bit_rates[track_uid] = int(_ebml_string(simple[0x4487]) or 0)
+
+        tracks_data = _read_ebml_element(f, positions[MKV_TRACKS], MKV_TRACKS)
+    if tracks_data is None:
+        return None
+
+    tracks = []
+    for entry_id, entry in _ebml_children(tracks_data):
+        if entry_id != 0xAE:
+            continue
+        fields = dict(_ebml_children(entry))
+        track_type = {1: 'video', 2: 'audio', 0x11: 'text'}.get(_ebml_uint(fields.get(0x83, b'')))
+        if track_type is None:
+            continue
+        codec_id = _ebml_string(fields.get(0x86, b''))
+        codec_format = next((name for prefix, name in MKV_CODECS.items() if codec_id.startswith(prefix)), codec_id)
+        # LanguageBCP47 overrides Language, which defaults to English when absent
+        if 0x22B59D in fields:
+            language = _ebml_string(fields[0x22B59D])
+        else:
+            language = _normalize_language(_ebml_string(fields[0x22B59C]) if 0x22B59C in fields else 'eng')
+        track = {'format': codec_format, 'language': language,
+                 'bit_rate': bit_rates.get(_ebml_uint(fields.get(0x73C5, b'')))}
+        if track_type == 'audio':
+            audio = dict(_ebml_children(fields.get(0xE1, b'')))
+            track['channels'] = _ebml_uint(audio[0x9F]) if 0x9F in audio else 1
+        elif track_type == 'video':
+            video = dict(_ebml_children(fields.get(0xE0, b'')))
+            track['width'] = _ebml_uint(video[0xB0]) if 0xB0 in video else None
+            track['height'] = _ebml_uint(video[0xBA]) if 0xBA in video else None
+            default_duration = _ebml_uint(fields.get(0x23E383, b''))
+            track['frame_rate'] = 1e9 / default_duration if default_duration else None
+        tracks.append((track_type, track))
+    return _make_tracks(tracks, duration)
+
+MP4_CONTAINERS = {'trak', 'mdia', 'minf', 'stbl'}
+
+def _mp4_boxes(f, start, end):
+    # Yields (type, payload_start, payload_end) reading only box headers, so mdat is skipped with a seek
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header[:8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type.decode('latin-1'), offset + header_size, min(offset + size, end)
+        offset += size
+
+def _mp4_leaf_boxes(f, start, end, boxes):
+    # Collects payloads of the small boxes the track parser needs; stts is cut to its first entry
+    for box_type, payload_start, payload_end in _mp4_boxes(f, start, end):
+        if box_type in MP4_CONTAINERS:
+            _mp4_leaf_boxes(f, payload_start, payload_end, boxes)
+        elif box_type in ('mdhd', 'hdlr', 'stsd', 'stts'):
+            length = min(payload_end - payload_start, 16 if box_type == 'stts' else HEADER_ELEMENT_LIMIT)
+            f.seek(payload_start)
+            boxes[box_type] = f.read(length)
+
+def _mp4_children(data, start):
+    pos = start
+    while pos + 8 <= len(data):
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        if size < 8:
+            return
+        yield box_type.decode('latin-1'), data[pos + 8:pos + size]
+        pos += size
+
+def _mp4_descriptor(data, pos):
+    tag = data[pos]
+    pos += 1
+    length = 0
+    for _ in range(4):
+        byte = data[pos]
+        pos += 1
+        length = (length << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+    return tag, pos, pos + length
+
+def _parse_esds(payload, track):
+    # ES_Descriptor > DecoderConfigDescriptor (object type, avg bit rate) > AudioSpecificConfig (channels)
+    tag, pos, end = _mp4_descriptor(payload, 4)
+    if tag != 0x03:
+        return
+    flags = payload[pos + 2]
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + payload[pos]
+    if flags & 0x20:
+        pos += 2
+    tag, pos, end = _mp4_descriptor(payload, pos)
+    if tag != 0x04:
+        return
+    object_type = payload[pos]
+    if object_type in (0x69, 0x6B):
+        track['format'] = 'MPEG Audio'
+    avg_bit_rate = struct.unpack_from('>I', payload, pos + 9)[0]
+    if avg_bit_rate:
+        track['bit_rate'] = avg_bit_rate
+    tag, pos, end = _mp4_descriptor(payload, pos + 13)
+    if tag == 0x05 and end - pos >= 2:
+        bits = int.from_bytes(payload[pos:pos + 4].ljust(4, b'\0'), 'big')
+        shift = 32 - 5
+        if bits >> shift == 31:
+            shift -= 6
+        shift -= 4
+        if (bits >> shift) & 0xF == 15:
+            shift -= 24
+        channel_config = (bits >> (shift - 4)) & 0xF if shift >= 4 else 0
+        if channel_config:
+            track['channels'] = 8 if channel_config == 7 else channel_config
+
+def _parse_mp4_sample_entry(entry_type, entry, track_type, track):
+    track['format'] = MP4_CODECS.get(entry_type, entry_type)
+    if track_type == 'video' and len(entry) >= 78:
+        track['width'], track['height'] = struct.unpack_from('>HH', entry, 24)
+        children = _mp4_children(entry, 78)
+    elif track_type == 'audio' and len(entry) >= 28:
+        version = struct.unpack_from('>H', entry, 8)[0]
+        track['channels'] = struct.unpack_from('>H', entry, 16)[0]
+        if version == 2:
+            track['channels'] = struct.unpack_from('>I', entry, 40)[0]
+        children = _mp4_children(entry, {1: 44, 2: 64}.get(version, 28))
+    else:
+        return
+    for child_type, child in children:
+        if child_type == 'esds':
+            _parse_esds(child, track)
+        elif child_type == 'dac3' and len(child) >= 3:
+            bits = int.from_bytes(child[:3], 'big')
+            acmod, lfe, rate_code = (bits >> 11) & 0x7, (bits >> 10) & 0x1, (bits >> 5) & 0x1F
+            track['channels'] = AC3_ACMOD_CHANNELS[acmod] + lfe
+            if rate_code < len(AC3_BITRATES):
+                track['bit_rate'] = AC3_BITRATES[rate_code] * 1000
+        elif child_type == 'dec3' and len(child) >= 5:
+            track['bit_rate'] = (struct.unpack_from('>H', child, 0)[0] >> 3) * 1000
+            acmod, lfe = (child[3] >> 1) & 0x7, child[3] & 0x1
+            track['channels'] = AC3_ACMOD_CHANNELS[acmod] + lfe
+        elif child_type == 'btrt' and len(child) >= 12:
+            track['bit_rate'] = struct.unpack_from('>I', child, 8)[0] or track.get('bit_rate')
+
+def _parse_mp4_track(boxes):
+    hdlr = boxes.get('hdlr', b'')
+    handler = hdlr[8:12].decode('latin-1') if len(hdlr) >= 12 else ''
+    track_type = {'vide': 'video', 'soun': 'audio', 'sbtl': 'text', 'text': 'text', 'subt': 'text',
+                  'clcp': 'text'}.get(handler)
+    if track_type is None:
+        return None
+    track = {}
+    mdhd = boxes.get('mdhd', b'')
+    timescale = None
+    if mdhd:
+        # Version 1 uses 64-bit times
+        timescale_offset, language_offset = (20, 32) if mdhd[0] == 1 else (12, 20)
+        timescale = struct.unpack_from('>I', mdhd, timescale_offset)[0]
+        code = struct.unpack_from('>H', mdhd, language_offset)[0]
+        if code < 0x400:
+            track['language'] = MAC_LANGUAGES.get(code, 'Unknown')
+        elif code != 0x7FFF:
+            track['language'] = _normalize_language(''.join(chr(((code >> shift) & 0x1F) + 0x60)
+                                                            for shift in (10, 5, 0)))
+    stsd = boxes.get('stsd', b'')
+    entries = list(_mp4_children(stsd, 8))
+    if entries:
+        _parse_mp4_sample_entry(entries[0][0], entries[0][1], track_type, track)
+    stts = boxes.get('stts', b'')
+    if track_type == 'video' and timescale and len(stts) >= 16 and struct.unpack_from('>I', stts, 4)[0]:
+        sample_delta = struct.unpack_from('>I', stts, 12)[0]
+        track['frame_rate'] = timescale / sample_delta if sample_delta else None
+    return track_type, track
+
+def parse_mp4(file_path):
+    """Read track headers from an MP4/MOV file's moov box; None when it has none."""
+    with open(file_path, 'rb') as raw:
+        f = ThrottledReader(raw, 'probe')
+        file_end = os.fstat(f.fileno()).st_size
+        moov = next(((start, end) for box_type, start, end in _mp4_boxes(f, 0, file_end) if box_type == 'moov'), None)
+        if moov is None:
+            return None
+        duration = None
+        tracks = []
+        for box_type, start, end in _mp4_boxes(f, *moov):
+            if box_type == 'mvhd':
+                f.seek(start)
+                mvhd = f.read(32)
+                if mvhd[0] == 1:
+                    timescale, movie_duration = struct.unpack_from('>IQ', mvhd, 20)
+                else:
+                    timescale, movie_duration = struct.unpack_from('>II', mvhd, 12)
+                duration = movie_duration / timescale if timescale and movie_duration else None
+            elif box_type == 'trak':
+                boxes = {}
+                _mp4_leaf_boxes(f, start, end, boxes)
+                track = _parse_mp4_track(boxes)
+                if track is not None:
+                    tracks.append(track)
+    return _make_tracks(tracks, duration)
+
+CONTAINER_PARSERS = {
+    '.mkv': parse_matroska, '.webm': parse_matroska,
+    '.mp4': parse_mp4, '.m4v': parse_mp4, '.mov': parse_mp4, '.3gp': parse_mp4, '.3g2': parse_mp4, '.f4v': parse_mp4,
+}
+
+def get_file_metadata(file_path):
+    """Return (audio_tracks, subtitle_tracks, video_info), from the container headers when possible."""
+    parser = CONTAINER_PARSERS.get(os.path.splitext(file_path)[1].lower()) if NATIVE_PROBE else None
+    if parser is not None:
+        try:
+            with timed_phase('probe.native'):
+                result = parser(file_path)
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            logging.debug(f"Header parse failed for {file_path}: {e}")
+            result = None
+        if result is not None:
+            return result
+        logging.debug(f"Falling back to mediainfo for {file_path}")
+    with timed_phase('probe.mediainfo'):
+        return get_mediainfo_metadata(file_path)
+
+def get_db_path(db_conn):
+    # Path of the main database file, or None for in-memory connections
+    for _, name, path in db_conn.execute("PRAGMA database_list"):
+        if name == 'main':
+            return path or None
+    return None
+
+def increment_counter(db_conn, key, amount=1):
+    db_conn.execute("""INSERT INTO metadata (key, value) VALUES (?, ?)
+                       ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + ?""",
+                    (key, str(amount), amount))
+
+def compute_fingerprint(file_path, file_size=None):
+    if file_size is None:
+        file_size = get_storage().getsize(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as raw:
+        f = ThrottledReader(raw, 'probe')
+        if file_size <= FINGERPRINT_BLOCK_SIZE * 3:
+            digest.update(f.read())
+        else:
+            for offset in (0, file_size // 2 - FINGERPRINT_BLOCK_SIZE // 2, file_size - FINGERPRINT_BLOCK_SIZE):
+                f.seek(offset)
+                digest.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return f"{file_size}:{digest.hexdigest()}"
+
+def lookup_metadata_cache(db_conn, fingerprint):
+    row = db_conn.execute("""SELECT audio_metadata, subtitle_metadata, video_metadata FROM metadata_cache
+                             WHERE fingerprint = ? AND video_metadata IS NOT NULL""", (fingerprint,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0]), json.loads(row[1]), json.loads(row[2])
+
+def store_metadata_cache(db_conn, fingerprint, file_size, audio_tracks, subtitle_tracks, video_info):
+    # Empty results are indistinguishable from a failed probe, so they are never cached
+    if not audio_tracks and not subtitle_tracks and not video_info:
+        return
+    now = int(time.time())
+    db_conn.execute("""INSERT OR REPLACE INTO metadata_cache
+                       (fingerprint, file_size, audio_metadata, subtitle_metadata, video_metadata, created, last_used)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (fingerprint, file_size, json.dumps(audio_tracks), json.dumps(subtitle_tracks),
+                     json.dumps(video_info), now, now))
+
+def touch_metadata_cache(db_conn, fingerprint):
+    db_conn.execute("UPDATE metadata_cache SET last_used = ? WHERE fingerprint = ?", (int(time.time()), fingerprint))
 
-def is_smb_mounted(smb_server, smb_path, mount_point):
+def evict_metadata_cache(db_conn):
+    cursor = db_conn.cursor()
+    cursor.execute("DELETE FROM metadata_cache WHERE last_used < ?", (int(time.time()) - METADATA_CACHE_MAX_AGE,))
+    evicted = cursor.rowcount
+    cursor.execute("""DELETE FROM metadata_cache WHERE fingerprint IN (
+                          SELECT fingerprint FROM metadata_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+                   (METADATA_CACHE_MAX_ENTRIES,))
+    evicted += cursor.rowcount
+    db_conn.commit()
+    if evicted:
+        logging.info(f"Evicted {evicted} entries from the metadata cache")
+
+def probe_file_metadata(file_path, cache_conn, file_size=None):
+    """Return (audio_tracks, subtitle_tracks, video_info, fingerprint, cache_hit), consulting the fingerprint cache first."""
     try:
-        result = subprocess.run(['mount'], stdout=subprocess.PIPE, text=True)
-        output = result.stdout
-        
-        if f"//GUEST:@{smb_server}{smb_path} on {mount_point}" in output:
-            return True
-        return False
-    except Exception as e:
-        logging.error(f"Error checking mount status: {e}")
-        return False
+        with timed_phase('probe.fingerprint'):
+            fingerprint = compute_fingerprint(file_path, file_size)
+    except OSError as e:
+        logging.warning(f"Could not fingerprint {file_path}: {e}")
+        return get_file_metadata(file_path) + (None, False)
+
+    if cache_conn is not None:
+        cached = lookup_metadata_cache(cache_conn, fingerprint)
+        if cached is not None:
+            return cached + (fingerprint, True)
 
-def mount_smb(smb_server, smb_path, mount_point):
+    return get_file_metadata(file_path) + (fingerprint, False)
+
+def get_file_metadata_cached(file_path, db_conn, file_size=None):
+    if file_size is None:
+        file_size = get_storage().getsize(file_path)
+    audio_tracks, subtitle_tracks, video_info, fingerprint, hit = probe_file_metadata(file_path, db_conn, file_size)
+    if fingerprint is not None:
+        if hit:
+            touch_metadata_cache(db_conn, fingerprint)
+        else:
+            store_metadata_cache(db_conn, fingerprint, file_size, audio_tracks, subtitle_tracks, video_info)
+        increment_counter(db_conn, 'metadata_cache_hits' if hit else 'metadata_cache_misses')
+    return audio_tracks, subtitle_tracks, video_info
+
+def get_video_columns(video_info):
+    """Values for the VIDEO_COLUMNS of a media_files row."""
+    return tuple(video_info.get(key) for key in VIDEO_INFO_KEYS)
+
+def estimate_compression_ratio(video_info, file_size):
+    """Expected output/input size ratio of a compress.json encode, or None when the duration is unknown."""
+    duration = video_info.get('duration')
+    if not duration or not file_size:
+        return None
+    source_bit_rate = file_size * 8 / duration
+    width = video_info.get('width') or 0
+    target_bit_rate = next(rate for min_width, rate in TARGET_VIDEO_BITRATES if width >= min_width)
+    # The encode is constant-quality, so a low bit rate source stays roughly where it is
+    video_bit_rate = min(target_bit_rate, video_info.get('bit_rate') or source_bit_rate)
+    ratio = (video_bit_rate + AUDIO_OUTPUT_BITRATE) / source_bit_rate
+    if video_info.get('codec') in EFFICIENT_CODECS:
+        ratio = max(ratio, EFFICIENT_CODEC_MIN_RATIO)
+    return round(min(ratio, 1.0), 3)
+
+def needs_compression_for(ratio):
+    return None if ratio is None else int(ratio < COMPRESSION_RATIO_THRESHOLD)
+
+def _unescape_mount_path(path):
+    # The kernel writes space, tab, newline and backslash in mount paths as octal escapes
+    for escape, char in (('\\040', ' '), ('\\011', '\t'), ('\\012', '\n'), ('\\134', '\\')):
+        path = path.replace(escape, char)
+    return path
+
+def read_mount_table():
+    """(mount_point, fs_type, source) for every mount from /proc/self/mountinfo, or None where there is none."""
     try:
-        if not os.path.exists(mount_point):
-            os.makedirs(mount_point)
-        cmd = ['sudo', 'mount_smbfs', f"//GUEST@{smb_server}{smb_path}", mount_point]
-        logging.info(f"Running command: {' '.join(cmd)}")
-        subprocess.run(cmd, check=True)
-        logging.info(f"Mounted //GUEST@{smb_server}{smb_path} on {mount_point}")
+        with open('/proc/self/mountinfo') as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    mounts = []
+    for line in lines:
+        fields, _, tail = line.partition(' - ')
+        fields, tail = fields.split(), tail.split()
+        if len(fields) >= 5 and len(tail) >= 2:
+            mounts.append((_unescape_mount_path(fields[4]), tail[0], _unescape_mount_path(tail[1])))
+    return mounts
+
+class LocalStorage:
+    """The library on a filesystem the host already provides. Every copy, stat and delete of library files goes
+    through a storage object, so the SMB backend can keep the share mounted and retry around it."""
+
+    def ensure_available(self):
         return True
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error mounting SMB (exit status {e.returncode}): {e}")
-        return False
-    except Exception as e:
-        logging.error(f"Unexpected error: {e}")
-        return False
 
-def ensure_smb_mounted(smb_server, smb_path, mount_point):
-    for attempt in range(MAX_RETRIES):
-        if is_smb_mounted(smb_server, smb_path, mount_point):
+    def invalidate(self):
+        pass
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def getsize(self, path):
+        return os.path.getsize(path)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def scandir(self, path):
+        return os.scandir(path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def replace(self, src, dst):
+        os.replace(src, dst)
+
+    def copy(self, src, dst, bandwidth=None, read_back=False):
+        return copy_file(src, dst, bandwidth=bandwidth, read_back=read_back and COPY_READ_BACK)
+
+class SMBStorage(LocalStorage):
+    """The library on an SMB share mounted at mount_point.
+
+    Mount state comes from the kernel mount table (or a device-number check where there is none) plus a statvfs
+    health probe. The result is cached for MOUNT_CHECK_TTL seconds and shared by all threads.
+    """
+
+    def __init__(self, server, share_path, mount_point, ttl=MOUNT_CHECK_TTL):
+        self.server = server
+        self.share_path = share_path
+        self.mount_point = mount_point
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.mount_lock = threading.Lock()
+        self.checked_at = None
+        self.mounted = False
+
+    def is_mounted(self):
+        with self.lock:
+            # Threads arriving during a probe wait for it and reuse its result
+            if self.checked_at is None or time.monotonic() - self.checked_at >= self.ttl:
+                self.mounted = self._probe()
+                self.checked_at = time.monotonic()
+            return self.mounted
+
+    def invalidate(self):
+        with self.lock:
+            self.checked_at = None
+
+    def _probe(self):
+        mount_point = os.path.realpath(self.mount_point)
+        mounts = read_mount_table()
+        try:
+            if mounts is not None:
+                if not any(path == mount_point and fs_type in NETWORK_FILESYSTEMS for path, fs_type, _ in mounts):
+                    return False
+            elif not os.path.ismount(mount_point):
+                return False
+            # A dropped connection leaves the mount in the table, but statvfs on it fails
+            os.statvfs(mount_point)
             return True
-        logging.info(f"//GUEST@{smb_server}{smb_path} is not mounted. Mounting now... (Attempt {attempt + 1}/{MAX_RETRIES})")
-        if mount_smb(smb_server, smb_path, mount_point):
+        except OSError as e:
+            logging.warning(f"Share at {mount_point} is not responding: {e}")
+            return False
+
+    def mount(self):
+        source = f"//GUEST@{self.server}{self.share_path}"
+        try:
+            os.makedirs(self.mount_point, exist_ok=True)
+            if platform.system() == "Darwin":
+                cmd = ['sudo', 'mount_smbfs', source, self.mount_point]
+            else:
+                cmd = ['sudo', 'mount', '-t', 'cifs', f"//{self.server}{self.share_path}", self.mount_point, '-o', 'guest']
+            logging.info(f"Running command: {' '.join(cmd)}")
+            subprocess.run(cmd, check=True)
+            logging.info(f"Mounted {source} on {self.mount_point}")
             return True
-        time.sleep(RETRY_DELAY)
-    logging.error(f"Failed to mount SMB after {MAX_RETRIES} attempts")
-    return False
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Error mounting SMB (exit status {e.returncode}): {e}")
+            return False
+        except Exception as e:
+            logging.error(f"Unexpected error: {e}")
+            return False
+        finally:
+            self.invalidate()
+
+    def ensure_available(self):
+        for attempt in range(MAX_RETRIES):
+            if self.is_mounted():
+                return True
+            with self.mount_lock:
+                # Another thread may have mounted the share while this one waited
+                if self.is_mounted():
+                    return True
+                logging.info(f"//GUEST@{self.server}{self.share_path} is not mounted. Mounting now... "
+                             f"(Attempt {attempt + 1}/{MAX_RETRIES})")
+                if self.mount() and self.is_mounted():
+                    return True
+            time.sleep(min(RETRY_DELAY * 2 ** attempt, 60))
+        logging.error(f"Failed to mount SMB after {MAX_RETRIES} attempts")
+        return False
+
+_storage = None
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == 'smb':
+            _storage = SMBStorage(SMB_SERVER, SMB_PATH, MOUNT_POINT)
+        elif STORAGE_BACKEND == 'local':
+            _storage = LocalStorage()
+        else:
+            raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+    return _storage
 
 def retry_on_smb_failure(func):
     def wrapper(*args, **kwargs):
@@ -162,123 +1170,841 @@ def retry_on_smb_failure(func):
                 return func(*args, **kwargs)
             except OSError as e:
                 if attempt < MAX_RETRIES - 1:
-                    logging.warning(f"SMB operation failed: {e}. Attempting to remount... (Attempt {attempt + 1}/{MAX_RETRIES})")
-                    if ensure_smb_mounted(SMB_SERVER, SMB_PATH, MOUNT_POINT):
+                    logging.warning(f"Storage operation failed: {e}. Checking the share... (Attempt {attempt + 1}/{MAX_RETRIES})")
+                    storage = get_storage()
+                    storage.invalidate()
+                    time.sleep(min(RETRY_DELAY * 2 ** attempt, 60))
+                    if storage.ensure_available():
                         continue
-                logging.error(f"SMB operation failed after {MAX_RETRIES} attempts: {e}")
+                logging.error(f"Storage operation failed after {MAX_RETRIES} attempts: {e}")
                 raise
     return wrapper
 
-@retry_on_smb_failure
-def scan_files(scan_path, db_conn):
-    logging.info(f"Scanning for new files in {scan_path}")
-    cursor = db_conn.cursor()
-    files_processed = 0
-    start_time = int(time.time())
+class BandwidthLimiter:
+    """Token buckets shared by all processes on the host through locked files in state_dir.
 
-    # Get the timestamp of the last full scan
-    cursor.execute("SELECT value FROM metadata WHERE key = 'last_full_scan'")
-    result = cursor.fetchone()
-    last_full_scan = int(result[0]) if result else 0
+    A caller takes the tokens it needs even when that leaves the bucket in debt, then sleeps until the debt is
+    repaid. Requests of any size are served in arrival order at the configured average rate.
+    """
 
-    for root, _, files in os.walk(scan_path):
-        for file in files:
-            if any(file.lower().endswith(ext) for ext in VIDEO_EXTENSIONS):
-                try:
-                    file_path = os.path.join(root, file)
-                    last_modified = int(os.path.getmtime(file_path))
-                    
-                    # Check if the file was modified after the last full scan
-                    if last_modified > last_full_scan:
-                        # Check if the file already exists in the database
-                        cursor.execute("SELECT last_modified FROM media_files WHERE file_path = ?", (file_path,))
-                        result = cursor.fetchone()
-                        
-                        if not result or last_modified > result[0]:
-                            # File is new or has been modified, update it
-                            file_size = os.path.getsize(file_path)
-                            content_type = "movie" if "movies" in root.lower() else "tv_show"
-                            audio_tracks, subtitle_tracks = get_file_metadata(file_path)
-                            
-                            cursor.execute("""INSERT OR REPLACE INTO media_files 
-                                              (file_path, file_basename, file_size, last_modified, 
-                                               content_type, audio_metadata, subtitle_metadata, needs_compression, has_been_reviewed) 
-                                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                                           (file_path, os.path.basename(file_path), file_size, last_modified,
-                                            content_type, json.dumps(audio_tracks), json.dumps(subtitle_tracks), None, None))
-                            
-                            logging.info(f"Added/Updated file: {file_path}")
-                            files_processed += 1
-                    
-                    if files_processed % DB_WRITE_INTERVAL == 0:
-                        db_conn.commit()
-                        logging.info(f"Committed {files_processed} files to database")
-                    
-                except Exception as e:
-                    logging.error(f"Error processing file {file_path}: {e}")
+    STATE = struct.Struct('dd')  # tokens, time of the last refill
 
-    # Update the last full scan timestamp
-    cursor.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", ("last_full_scan", str(start_time)))
-    
-    db_conn.commit()  # Final commit for any remaining files
-    logging.info(f"Scan completed. Total files processed: {files_processed}")
+    def __init__(self, limits, schedule=(), state_dir=BANDWIDTH_STATE_DIR):
+        self.limits = limits
+        self.schedule = schedule
+        self.state_dir = state_dir
+        self.lock = threading.Lock()
+        self.buckets = {}  # Used when the buckets can't be shared
+        self.shared = fcntl is not None
+        if self.shared and limits:
+            try:
+                os.makedirs(state_dir, exist_ok=True)
+            except OSError as e:
+                logging.warning(f"Bandwidth limits apply per process: cannot create {state_dir}: {e}")
+                self.shared = False
 
-def open_in_vlc(file_path):
-    system = platform.system()
-    
-    if system == "Darwin":  # macOS
-        vlc_command = "/Applications/VLC.app/Contents/MacOS/VLC"
-    elif system == "Windows":
-        vlc_command = r"C:\Program Files\VideoLAN\VLC\vlc.exe"
-    else:  # Linux and other Unix-like systems
-        vlc_command = "vlc"
+    def get_rate(self, name, now):
+        rate = self.limits.get(name)
+        if not rate:
+            return None
+        hour = time.localtime(now).tm_hour
+        for start, end, factor in self.schedule:
+            if (start <= hour < end) if start <= end else (hour >= start or hour < end):
+                rate *= factor
+        return rate
+
+    def consume(self, direction, op_class, nbytes):
+        if not self.limits or nbytes <= 0:
+            return
+        now = time.time()
+        wait = 0
+        for name in (direction, f'{direction}:{op_class}'):
+            rate = self.get_rate(name, now)
+            if rate:
+                wait = max(wait, self._take(name, rate, nbytes, now))
+        if wait > 0:
+            time.sleep(wait)
 
+    def _take(self, name, rate, nbytes, now):
+        """Remove nbytes from the bucket; returns the seconds until it is out of debt."""
+        capacity = rate * BANDWIDTH_BURST_SECONDS
+        if not self.shared:
+            with self.lock:
+                tokens, last = self.buckets.get(name, (capacity, now))
+                tokens = min(capacity, tokens + max(now - last, 0) * rate) - nbytes
+                self.buckets[name] = (tokens, now)
+        else:
+            fd = os.open(os.path.join(self.state_dir, name.replace(':', '_') + '.bucket'), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.pread(fd, self.STATE.size, 0)
+                tokens, last = self.STATE.unpack(data) if len(data) == self.STATE.size else (capacity, now)
+                tokens = min(capacity, tokens + max(now - last, 0) * rate) - nbytes
+                os.pwrite(fd, self.STATE.pack(tokens, now), 0)
+            finally:
+                os.close(fd)  # Also releases the lock
+        return -tokens / rate if tokens < 0 else 0
+
+_bandwidth_limiter = None
+
+def throttle(direction, op_class, nbytes):
+    """Block until nbytes of NAS traffic fit the bandwidth limits for direction ('read'/'write') and op_class."""
+    global _bandwidth_limiter
+    if _bandwidth_limiter is None:
+        _bandwidth_limiter = BandwidthLimiter(BANDWIDTH_LIMITS, BANDWIDTH_SCHEDULE)
+    _bandwidth_limiter.consume(direction, op_class, nbytes)
+
+class ThrottledReader:
+    """Read-only file wrapper that charges every read to the bandwidth limiter."""
+
+    def __init__(self, f, op_class):
+        self.f = f
+        self.op_class = op_class
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        throttle('read', self.op_class, len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+class PhaseMetrics:
+    """Counters and per-phase latency histograms for the running command, shared by all of its threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, command):
+        with self.lock:
+            self.command = command
+            self.run_id = None
+            self.started_at = int(time.time())
+            self.phases = {}  # phase -> [count, total seconds, max seconds, bucket counts]
+            self.counters = {}
+
+    def observe(self, phase, seconds):
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = [0, 0.0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3][index] += 1
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+metrics = PhaseMetrics()
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    """Time a block (or, as a decorator, every call) into the histogram for phase."""
+    start = time.perf_counter()
     try:
-        # Use shlex.quote to properly escape the file path
-        quoted_path = shlex.quote(file_path)
-        full_command = f"{vlc_command} {quoted_path}"
-        
-        logging.info(f"Attempting to open VLC with command: {full_command}")
-        
-        process = subprocess.Popen(
-            full_command,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        
-        # Wait for a short time to see if the process immediately exits
+        yield
+    finally:
+        metrics.observe(phase, time.perf_counter() - start)
+
+def begin_metrics_run(command):
+    metrics.reset(command)
+
+def save_metrics_run(db_conn, finished=False):
+    """Write the current run's metrics; safe to call repeatedly, e.g. after every pass of a long `watch`."""
+    with metrics.lock:
+        if metrics.command is None:
+            return
+        phases = {phase: (stats[0], stats[1], stats[2], list(stats[3])) for phase, stats in metrics.phases.items()}
+        counters = dict(metrics.counters)
+    cursor = db_conn.cursor()
+    finished_at = int(time.time()) if finished else None
+    if metrics.run_id is None:
+        cursor.execute("INSERT INTO metric_runs (command, host, started_at, finished_at) VALUES (?, ?, ?, ?)",
+                       (metrics.command, socket.gethostname(), metrics.started_at, finished_at))
+        metrics.run_id = cursor.lastrowid
+    else:
+        cursor.execute("UPDATE metric_runs SET finished_at = ? WHERE id = ?", (finished_at, metrics.run_id))
+    cursor.executemany("INSERT OR REPLACE INTO phase_metrics VALUES (?, ?, ?, ?, ?, ?)",
+                       [(metrics.run_id, phase, count, total, maximum, json.dumps(buckets))
+                        for phase, (count, total, maximum, buckets) in phases.items()])
+    cursor.executemany("INSERT OR REPLACE INTO run_counters VALUES (?, ?, ?)",
+                       [(metrics.run_id, name, value) for name, value in counters.items()])
+    db_conn.commit()
+    if finished and PROMETHEUS_TEXTFILE:
         try:
-            process.wait(timeout=5)
-            stdout, stderr = process.communicate()
-            if process.returncode != 0:
-                logging.error(f"VLC process exited with code {process.returncode}")
-                logging.error(f"stdout: {stdout.decode('utf-8', errors='replace')}")
-                logging.error(f"stderr: {stderr.decode('utf-8', errors='replace')}")
-                return False
-        except subprocess.TimeoutExpired:
-            # Process is still running, which is good
-            logging.info("VLC process started successfully")
-            return True
-        
+            write_prometheus_textfile(db_conn, PROMETHEUS_TEXTFILE)
+        except OSError as e:
+            logging.error(f"Could not write {PROMETHEUS_TEXTFILE}: {e}")
+
+def estimate_quantile(buckets, count, max_seconds, q):
+    """Interpolate quantile q from histogram bucket counts; the overflow bucket is capped at max_seconds."""
+    if not count:
+        return None
+    target = q * count
+    seen = 0
+    for index, bucket_count in enumerate(buckets):
+        if bucket_count and seen + bucket_count >= target:
+            lower = LATENCY_BUCKETS[index - 1] if index > 0 else 0.0
+            upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else max_seconds
+            return min(lower + (upper - lower) * (target - seen) / bucket_count, max_seconds)
+        seen += bucket_count
+    return max_seconds
+
+def load_run_metrics(db_conn, run_id):
+    phases = [(phase, count, total, maximum, json.loads(buckets)) for phase, count, total, maximum, buckets in
+              db_conn.execute("""SELECT phase, count, total_seconds, max_seconds, buckets FROM phase_metrics
+                                 WHERE run_id = ? ORDER BY phase""", (run_id,))]
+    counters = db_conn.execute("SELECT name, value FROM run_counters WHERE run_id = ? ORDER BY name", (run_id,)).fetchall()
+    return phases, counters
+
+def print_stats(db_conn, runs=5):
+    for run_id, command, host, started_at, finished_at in db_conn.execute(
+            "SELECT id, command, host, started_at, finished_at FROM metric_runs ORDER BY id DESC LIMIT ?", (runs,)).fetchall():
+        ended = f"{finished_at - started_at}s" if finished_at else "running or interrupted"
+        print(f"\nRun {run_id}: {command} on {host} at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started_at))} "
+              f"({ended})")
+        phases, counters = load_run_metrics(db_conn, run_id)
+        if phases:
+            print(f"  {'phase':28} {'count':>8} {'total s':>10} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}")
+        for phase, count, total, maximum, buckets in phases:
+            p50 = estimate_quantile(buckets, count, maximum, 0.5)
+            p95 = estimate_quantile(buckets, count, maximum, 0.95)
+            print(f"  {phase:28} {count:8d} {total:10.1f} {p50 * 1000:10.1f} {p95 * 1000:10.1f} {maximum * 1000:10.1f}")
+        for name, value in counters:
+            print(f"  {name:28} {value:8d}")
+
+def write_prometheus_textfile(db_conn, path):
+    """Export the latest run of each command in the Prometheus text format, replacing path atomically."""
+    # Samples of one metric family have to be contiguous, so they are collected per family first
+    families = {'media_manager_run_finished_timestamp_seconds': ('gauge', []),
+                'media_manager_run_duration_seconds': ('gauge', []),
+                'media_manager_phase_seconds': ('histogram', []),
+                'media_manager_run_counter': ('gauge', [])}
+    latest = db_conn.execute("""SELECT id, command, started_at, finished_at FROM metric_runs
+                                WHERE id IN (SELECT MAX(id) FROM metric_runs WHERE finished_at IS NOT NULL
+                                             GROUP BY command)""").fetchall()
+    for run_id, command, started_at, finished_at in latest:
+        families['media_manager_run_finished_timestamp_seconds'][1].append(f'{{command="{command}"}} {finished_at}')
+        families['media_manager_run_duration_seconds'][1].append(f'{{command="{command}"}} {finished_at - started_at}')
+        phases, counters = load_run_metrics(db_conn, run_id)
+        for phase, count, total, _, buckets in phases:
+            labels = f'command="{command}",phase="{phase}"'
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                cumulative += bucket_count
+                families['media_manager_phase_seconds'][1].append(f'_bucket{{{labels},le="{bound}"}} {cumulative}')
+            families['media_manager_phase_seconds'][1].append(f'_sum{{{labels}}} {total}')
+            families['media_manager_phase_seconds'][1].append(f'_count{{{labels}}} {count}')
+        for name, value in counters:
+            families['media_manager_run_counter'][1].append(f'{{command="{command}",name="{name}"}} {value}')
+    lines = []
+    for family, (metric_type, samples) in families.items():
+        lines.append(f"# TYPE {family} {metric_type}")
+        lines.extend(family + sample for sample in samples)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, path)
+
+def _path_range(dir_path):
+    # Bounds for a primary-key range scan over every path below dir_path
+    prefix = os.path.join(dir_path, '')
+    return prefix, prefix + '\U0010ffff'
+
+def is_settled(pending, file_path, file_size, now, mtime=None):
+    """Debounce for files still being written: True once file_size has held for WATCH_SETTLE_SECONDS.
+
+    A file last modified longer ago than that (the backlog a `watch` catches up on) is settled straight away.
+    """
+    if mtime is not None and now - mtime >= WATCH_SETTLE_SECONDS:
+        pending.pop(file_path, None)
         return True
-    except Exception as e:
-        logging.error(f"Error opening file in VLC: {e}")
+    seen = pending.get(file_path)
+    if seen is None or seen[0] != file_size:
+        pending[file_path] = (file_size, now)
+        return False
+    if now - seen[1] < WATCH_SETTLE_SECONDS:
         return False
+    del pending[file_path]
+    return True
 
-def delete_file(file_path, db_conn):
+def _scan_walker(scan_path, known_files, dir_index, task_queue, result_queue, workers, stop_event, state,
+                 pending=None, full=False):
+    # Group known files and indexed directories by parent so changed directories can be diffed
+    files_by_dir = {}
+    for file_path in known_files:
+        files_by_dir.setdefault(os.path.dirname(file_path), set()).add(file_path)
+    children_by_dir = {}
+    for dir_path, (parent_path, _, _) in dir_index.items():
+        children_by_dir.setdefault(parent_path, set()).add(dir_path)
+
+    def remove_subtree(dir_path):
+        low, high = _path_range(dir_path)
+        for file_path in known_files:
+            if low < file_path < high:
+                result_queue.put(('delete', file_path))
+        result_queue.put(('drop_dir', dir_path))
 
-    rv = True
     try:
-        os.remove(file_path)
-        logging.info(f"Deleted file: {file_path}")
-    except Exception as e:
-        logging.error(f"Error deleting file {file_path}: {e}")
-        rv = False
-        
+        storage = get_storage()
+        settle_ns = (time.time() - DIR_MTIME_SETTLE) * 1e9
+        stack = [(scan_path, None, storage.stat(scan_path).st_mtime_ns)]
+        while stack:
+            if stop_event.is_set():
+                return
+            dir_path, parent_path, mtime_ns = stack.pop()
+            state['dirs_checked'] += 1
+            indexed = dir_index.get(dir_path)
+
+            if not full and indexed is not None and indexed[1] == mtime_ns:
+                # No entries were added, removed or renamed here; only descend into known subdirectories
+                for child in children_by_dir.get(dir_path, ()):
+                    try:
+                        stack.append((child, dir_path, storage.stat(child).st_mtime_ns))
+                    except FileNotFoundError:
+                        remove_subtree(child)
+                continue
+
+            try:
+                with timed_phase('scan.list_dir'), storage.scandir(dir_path) as it:
+                    entries = list(it)
+            except OSError as e:
+                if dir_path == scan_path:
+                    raise
+                logging.error(f"Error listing directory {dir_path}: {e}")
+                state['walk_errors'] += 1
+                continue
+            state['dirs_listed'] += 1
+
+            seen_files = set()
+            seen_dirs = set()
+            entry_errors = False
+            unsettled = False
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        seen_dirs.add(entry.path)
+                        stack.append((entry.path, dir_path, entry.stat(follow_symlinks=False).st_mtime_ns))
+                        continue
+                    if os.path.splitext(entry.name)[1].lower() not in VIDEO_EXTENSIONS:
+                        continue
+                    with timed_phase('scan.stat'):
+                        stat = entry.stat()
+                except OSError as e:
+                    logging.error(f"Error processing file {entry.path}: {e}")
+                    state['walk_errors'] += 1
+                    entry_errors = True
+                    continue
+
+                seen_files.add(entry.path)
+                last_modified = int(stat.st_mtime)
+                known_mtime = known_files.get(entry.path)
+                if known_mtime is not None and last_modified <= known_mtime:
+                    continue
+                if pending is not None and not is_settled(pending, entry.path, stat.st_size, time.time(), stat.st_mtime):
+                    unsettled = True
+                    continue
+                # Time spent here means the probe workers are the bottleneck
+                with timed_phase('scan.queue_wait'):
+                    task_queue.put((entry.path, dir_path, last_modified, stat.st_size))
+
+            # Anything indexed under this directory that is no longer listed has been deleted
+            for file_path in files_by_dir.get(dir_path, set()) - seen_files:
+                result_queue.put(('delete', file_path))
+            for child in children_by_dir.get(dir_path, set()) - seen_dirs:
+                remove_subtree(child)
+
+            # Directories still settling, with unreadable entries or with files still being written get no mtime
+            # so they are listed again next scan
+            stored_mtime = mtime_ns if mtime_ns < settle_ns and not entry_errors and not unsettled else None
+            result_queue.put(('dir', dir_path, parent_path, stored_mtime, len(entries)))
+    except Exception as e:
+        # Surfaced to scan_files so retry_on_smb_failure can remount and retry
+        state['fatal'] = e
+    finally:
+        for _ in range(workers):
+            task_queue.put(None)
+
+def build_media_row(file_path, root, last_modified, file_size, cache_conn):
+    """Probe a file and return its media_files row plus the (fingerprint, hit, tracks..., video_info) cache tuple."""
+    content_type = "movie" if "movies" in root.lower() else "tv_show"
+    audio_tracks, subtitle_tracks, video_info, fingerprint, hit = probe_file_metadata(file_path, cache_conn, file_size)
+    ratio = estimate_compression_ratio(video_info, file_size)
+    row = ((file_path, os.path.basename(file_path), file_size, last_modified,
+            content_type, json.dumps(audio_tracks), json.dumps(subtitle_tracks),
+            needs_compression_for(ratio), None, has_english_audio(audio_tracks))
+           + get_video_columns(video_info) + (ratio, 'model' if ratio is not None else None))
+    return row, (fingerprint, hit, audio_tracks, subtitle_tracks, video_info)
+
+def write_media_row(db_conn, cursor, row, cache):
+    """Upsert a build_media_row result; returns whether the metadata came from the cache (None if unfingerprinted)."""
+    fingerprint, hit, audio_tracks, subtitle_tracks, video_info = cache
+    cursor.execute("""INSERT OR REPLACE INTO media_files
+                      (file_path, file_basename, file_size, last_modified,
+                       content_type, audio_metadata, subtitle_metadata, needs_compression, has_been_reviewed,
+                       has_english_audio, video_codec, video_width, video_height, frame_rate, duration,
+                       bit_rate, estimated_ratio, estimate_source, fingerprint)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", row + (fingerprint,))
+    write_track_rows(cursor, row[0], audio_tracks, subtitle_tracks)
+    if fingerprint is None:
+        return None
+    if hit:
+        touch_metadata_cache(db_conn, fingerprint)
+    else:
+        store_metadata_cache(db_conn, fingerprint, row[2], audio_tracks, subtitle_tracks, video_info)
+    return hit
+
+def remove_media_file(cursor, file_path):
+    cursor.execute("DELETE FROM media_files WHERE file_path = ?", (file_path,))
+    delete_track_rows(cursor, file_path)
+
+def _scan_worker(task_queue, result_queue, db_path):
+    # Each worker reads the metadata cache through its own connection; only the writer modifies it
+    cache_conn = None
+    if db_path:
+        try:
+            cache_conn = sqlite3.connect(db_path, timeout=30)
+        except sqlite3.Error as e:
+            logging.warning(f"Metadata cache unavailable to scan worker: {e}")
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                return
+            file_path, root, last_modified, file_size = task
+            try:
+                row, cache = build_media_row(file_path, root, last_modified, file_size, cache_conn)
+                result_queue.put(('file', file_path, row, None, cache))
+            except Exception as e:
+                result_queue.put(('file', file_path, None, e, None))
+    finally:
+        if cache_conn is not None:
+            cache_conn.close()
+        result_queue.put(None)
+
+@retry_on_smb_failure
+def scan_files(scan_path, db_conn, workers=SCAN_WORKERS, pending=None, full=None):
+    """Incrementally scan scan_path into media_files.
+
+    With a `pending` dict (used by `watch`), new or changed files are only probed once is_settled() says their
+    size is stable; the dict carries the observed sizes from one scan to the next.
+    With `full`, every directory is listed and every file's mtime checked, as if the directory index were empty;
+    None does so when the last full pass over scan_path is older than FULL_SCAN_INTERVAL.
+    """
+    scan_path = os.path.normpath(scan_path)
+    cursor = db_conn.cursor()
+    full_scan_key = f"last_full_relist:{scan_path}"
+    if full is None:
+        row = cursor.execute("SELECT value FROM metadata WHERE key = ?", (full_scan_key,)).fetchone()
+        full = row is None or int(row[0]) < time.time() - FULL_SCAN_INTERVAL
+    logging.info(f"Scanning for new files in {scan_path} with {workers} worker(s)"
+                 + (", relisting every directory" if full else ""))
+    files_processed = 0
+    files_removed = 0
+    cache_hits = 0
+    cache_misses = 0
+    writes = 0
+    start_time = int(time.time())
+
+    # Load known modification times and the directory index once so the walker never touches the connection
+    low, high = _path_range(scan_path)
+    cursor.execute("SELECT file_path, last_modified FROM media_files WHERE file_path > ? AND file_path < ?", (low, high))
+    known_files = dict(cursor.fetchall())
+    cursor.execute("""SELECT dir_path, parent_path, mtime_ns, entry_count FROM scan_directories
+                      WHERE dir_path = ? OR (dir_path > ? AND dir_path < ?)""", (scan_path, low, high))
+    dir_index = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    # Walker -> probe workers -> this thread, which is the only writer on db_conn
+    task_queue = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    result_queue = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    stop_event = threading.Event()
+    state = {'errors': 0, 'walk_errors': 0, 'dirs_checked': 0, 'dirs_listed': 0, 'fatal': None}
+    failed_dirs = set()
+
+    threads = [threading.Thread(target=_scan_walker, daemon=True,
+                                args=(scan_path, known_files, dir_index, task_queue, result_queue,
+                                      workers, stop_event, state, pending, full))]
+    db_path = get_db_path(db_conn)
+    threads += [threading.Thread(target=_scan_worker, args=(task_queue, result_queue, db_path), daemon=True)
+                for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    finished_workers = 0
+    try:
+        while finished_workers < workers:
+            item = result_queue.get()
+            if item is None:
+                finished_workers += 1
+                continue
+
+            kind = item[0]
+            try:
+                if kind == 'file':
+                    _, file_path, row, error, cache = item
+                    if error is not None:
+                        raise error
+                    with timed_phase('scan.db_write'):
+                        hit = write_media_row(db_conn, cursor, row, cache)
+                    if hit:
+                        cache_hits += 1
+                    elif hit is not None:
+                        cache_misses += 1
+                    logging.info(f"Added/Updated file: {file_path}")
+                    files_processed += 1
+                elif kind == 'delete':
+                    _, file_path = item
+                    remove_media_file(cursor, file_path)
+                    if pending is not None:
+                        pending.pop(file_path, None)
+                    logging.info(f"Removed deleted file from database: {file_path}")
+                    files_removed += 1
+                elif kind == 'dir':
+                    _, dir_path, parent_path, mtime_ns, entry_count = item
+                    cursor.execute("""INSERT OR REPLACE INTO scan_directories
+                                      (dir_path, parent_path, mtime_ns, entry_count, last_scanned)
+                                      VALUES (?, ?, ?, ?, ?)""",
+                                   (dir_path, parent_path, mtime_ns, entry_count, start_time))
+                elif kind == 'drop_dir':
+                    _, dir_path = item
+                    dir_low, dir_high = _path_range(dir_path)
+                    cursor.execute("DELETE FROM scan_directories WHERE dir_path = ? OR (dir_path > ? AND dir_path < ?)",
+                                   (dir_path, dir_low, dir_high))
+            except Exception as e:
+                logging.error(f"Error processing file {item[1]}: {e}")
+                state['errors'] += 1
+                if kind == 'file':
+                    failed_dirs.add(os.path.dirname(item[1]))
+                continue
+
+            writes += 1
+            if writes % DB_WRITE_INTERVAL == 0:
+                with timed_phase('scan.commit'):
+                    db_conn.commit()
+                logging.info(f"Committed {files_processed} files to database")
+    finally:
+        # Unblock the walker and workers if the writer is bailing out early
+        stop_event.set()
+        while finished_workers < workers:
+            try:
+                item = result_queue.get(timeout=RETRY_DELAY)
+            except queue.Empty:
+                break
+            if item is None:
+                finished_workers += 1
+        # Failed files must be picked up again, so their directories are forced back to "changed"
+        for dir_path in failed_dirs:
+            cursor.execute("UPDATE scan_directories SET mtime_ns = NULL WHERE dir_path = ?", (dir_path,))
+        db_conn.commit()
+
+    if state['fatal'] is not None:
+        raise state['fatal']
+
+    cursor.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", ("last_full_scan", str(start_time)))
+    if full:
+        cursor.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (full_scan_key, str(start_time)))
+    increment_counter(db_conn, 'metadata_cache_hits', cache_hits)
+    increment_counter(db_conn, 'metadata_cache_misses', cache_misses)
+    db_conn.commit()
+    evict_metadata_cache(db_conn)
+    for name, value in (('files_processed', files_processed), ('files_removed', files_removed),
+                        ('dirs_checked', state['dirs_checked']), ('dirs_listed', state['dirs_listed']),
+                        ('metadata_cache_hits', cache_hits), ('metadata_cache_misses', cache_misses),
+                        ('errors', state['errors'] + state['walk_errors'])):
+        metrics.increment(f'scan.{name}', value)
+    save_metrics_run(db_conn)
+
+    error_count = state['errors'] + state['walk_errors']
+    if error_count:
+        logging.warning(f"Scan finished with {error_count} error(s)")
+    logging.info(f"Scan completed. Checked {state['dirs_checked']} directories, listed {state['dirs_listed']}. "
+                 f"Total files processed: {files_processed}, removed: {files_removed}. "
+                 f"Metadata cache hits: {cache_hits}, misses: {cache_misses}")
+
+def is_network_filesystem(path):
+    # Longest mount table entry containing path; unknown (non-Linux) counts as local
+    mounts = read_mount_table()
+    if mounts is None:
+        return False
+    path = os.path.realpath(path)
+    best, fs_type = '', None
+    for mount_point, mount_type, _ in mounts:
+        if (path == mount_point or path.startswith(os.path.join(mount_point, ''))) and len(mount_point) > len(best):
+            best, fs_type = mount_point, mount_type
+    return fs_type in NETWORK_FILESYSTEMS
+
+class InotifyWatcher:
+    """Recursive inotify watch over a directory tree, through libc (Linux only)."""
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x800
+    IN_CLOEXEC = 0x80000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, root):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+        self.add_tree(root)
+
+    def add_tree(self, dir_path):
+        """Watch dir_path and every directory below it; returns the files found on the way."""
+        files = []
+        for current, dirs, names in os.walk(dir_path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(current), self.WATCH_MASK)
+            if wd < 0:
+                # Usually fs.inotify.max_user_watches; the caller falls back to polling
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {current}")
+            self.paths[wd] = current
+            files.extend(os.path.join(current, name) for name in names)
+        return files
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds; returns (mask, path) pairs, with path None for a queue overflow."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((mask, None))
+            elif mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif wd in self.paths:
+                events.append((mask, os.path.join(self.paths[wd], name) if name else self.paths[wd]))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def remove_media_subtree(cursor, dir_path):
+    low, high = _path_range(dir_path)
+    cursor.execute("SELECT file_path FROM media_files WHERE file_path > ? AND file_path < ?", (low, high))
+    for (file_path,) in cursor.fetchall():
+        remove_media_file(cursor, file_path)
+    cursor.execute("DELETE FROM scan_directories WHERE dir_path = ? OR (dir_path > ? AND dir_path < ?)",
+                   (dir_path, low, high))
+
+def _feed_tasks(tasks, task_queue, workers):
+    for task in tasks:
+        task_queue.put(task)
+    for _ in range(workers):
+        task_queue.put(None)
+
+def probe_files(tasks, db_conn, workers=SCAN_WORKERS):
+    """Probe (file_path, root, last_modified, file_size) tasks with scan's worker pool; this thread writes the rows.
+
+    Commits every DB_WRITE_INTERVAL files like scan_files. Returns the number of files written.
+    """
+    task_queue = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    result_queue = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    db_path = get_db_path(db_conn)
+    threads = [threading.Thread(target=_feed_tasks, args=(tasks, task_queue, workers), daemon=True)]
+    threads += [threading.Thread(target=_scan_worker, args=(task_queue, result_queue, db_path), daemon=True)
+                for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    cursor = db_conn.cursor()
+    written = 0
+    finished_workers = 0
+    try:
+        while finished_workers < workers:
+            item = result_queue.get()
+            if item is None:
+                finished_workers += 1
+                continue
+            _, file_path, row, error, cache = item
+            if error is not None:
+                logging.error(f"Error processing file {file_path}: {error}")
+                continue
+            try:
+                with timed_phase('scan.db_write'):
+                    write_media_row(db_conn, cursor, row, cache)
+            except sqlite3.Error as e:
+                logging.error(f"Error processing file {file_path}: {e}")
+                continue
+            logging.info(f"Added/Updated file: {file_path}")
+            written += 1
+            if written % DB_WRITE_INTERVAL == 0:
+                with timed_phase('scan.commit'):
+                    db_conn.commit()
+    finally:
+        db_conn.commit()
+    return written
+
+def update_settled_files(pending, db_conn, workers=SCAN_WORKERS):
+    # Probe and upsert every pending file whose size has held for WATCH_SETTLE_SECONDS, in one batch
+    cursor = db_conn.cursor()
+    now = time.time()
+    tasks = []
+    for file_path in list(pending):
+        try:
+            stat = get_storage().stat(file_path)
+        except FileNotFoundError:
+            pending.pop(file_path, None)
+            continue
+        if not is_settled(pending, file_path, stat.st_size, now, stat.st_mtime):
+            continue
+        known = cursor.execute("SELECT file_size, last_modified FROM media_files WHERE file_path = ?",
+                               (file_path,)).fetchone()
+        if known is not None and known[0] == stat.st_size and known[1] >= int(stat.st_mtime):
+            continue
+        tasks.append((file_path, os.path.dirname(file_path), int(stat.st_mtime), stat.st_size))
+    if tasks:
+        probe_files(tasks, db_conn, workers)
+
+def watch_inotify(scan_path, db_conn, watcher, workers=SCAN_WORKERS):
+    pending = {}
+    last_scan = 0
+    while True:
+        if time.time() - last_scan >= WATCH_RESCAN_INTERVAL:
+            # Catches up on changes made while nothing was watching, then acts as a safety net for missed events.
+            # Unchanged directories are skipped by the directory index; new files join `pending` to settle
+            scan_files(scan_path, db_conn, workers=workers, pending=pending)
+            last_scan = time.time()
+
+        # Wake up often enough to notice settled files without waiting for another event
+        for mask, path in watcher.read_events(1 if pending else WATCH_SETTLE_SECONDS):
+            if path is None:
+                logging.warning("inotify queue overflowed; running an incremental scan")
+                last_scan = 0
+                continue
+            cursor = db_conn.cursor()
+            is_dir = mask & watcher.IN_ISDIR
+            if mask & (watcher.IN_DELETE | watcher.IN_MOVED_FROM):
+                if is_dir:
+                    remove_media_subtree(cursor, path)
+                    logging.info(f"Removed deleted directory from database: {path}")
+                elif os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS:
+                    remove_media_file(cursor, path)
+                    pending.pop(path, None)
+                    logging.info(f"Removed deleted file from database: {path}")
+                db_conn.commit()
+            elif is_dir:
+                if mask & (watcher.IN_CREATE | watcher.IN_MOVED_TO):
+                    # Files may have landed before the watch existed
+                    for file_path in watcher.add_tree(path):
+                        if os.path.splitext(file_path)[1].lower() in VIDEO_EXTENSIONS:
+                            pending.setdefault(file_path, (None, 0))
+            elif os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS:
+                pending.setdefault(path, (None, 0))
+        update_settled_files(pending, db_conn, workers)
+
+def watch_polling(scan_path, db_conn, workers=SCAN_WORKERS):
+    pending = {}
+    while True:
+        scan_files(scan_path, db_conn, workers=workers, pending=pending)
+        # Come back sooner while files are waiting to settle
+        time.sleep(WATCH_SETTLE_SECONDS if pending else WATCH_POLL_INTERVAL)
+
+def watch_directory(scan_path, db_conn, workers=SCAN_WORKERS, poll=False):
+    """Keep media_files current for scan_path until interrupted, with inotify or periodic incremental scans."""
+    scan_path = os.path.normpath(scan_path)
+    watcher = None
+    if poll:
+        logging.info("Polling requested")
+    elif is_network_filesystem(scan_path):
+        logging.info(f"{scan_path} is on a network filesystem that doesn't deliver inotify events; polling")
+    else:
+        try:
+            watcher = InotifyWatcher(scan_path)
+        except (OSError, AttributeError) as e:
+            logging.info(f"inotify unavailable ({e}); polling")
+
+    try:
+        if watcher is None:
+            logging.info(f"Watching {scan_path} with an incremental scan every {WATCH_POLL_INTERVAL} seconds")
+            watch_polling(scan_path, db_conn, workers)
+        else:
+            logging.info(f"Watching {scan_path} with inotify ({len(watcher.paths)} directories)")
+            watch_inotify(scan_path, db_conn, watcher, workers)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+def open_in_vlc(file_path):
+    system = platform.system()
+    
+    if system == "Darwin":  # macOS
+        vlc_command = "/Applications/VLC.app/Contents/MacOS/VLC"
+    elif system == "Windows":
+        vlc_command = r"C:\Program Files\VideoLAN\VLC\vlc.exe"
+    else:  # Linux and other Unix-like systems
+        vlc_command = "vlc"
+
+    try:
+        # Use shlex.quote to properly escape the file path
+        quoted_path = shlex.quote(file_path)
+        full_command = f"{vlc_command} {quoted_path}"
+        
+        logging.info(f"Attempting to open VLC with command: {full_command}")
+        
+        process = subprocess.Popen(
+            full_command,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        
+        # Wait for a short time to see if the process immediately exits
+        try:
+            process.wait(timeout=5)
+            stdout, stderr = process.communicate()
+            if process.returncode != 0:
+                logging.error(f"VLC process exited with code {process.returncode}")
+                logging.error(f"stdout: {stdout.decode('utf-8', errors='replace')}")
+                logging.error(f"stderr: {stderr.decode('utf-8', errors='replace')}")
+                return False
+        except subprocess.TimeoutExpired:
+            # Process is still running, which is good
+            logging.info("VLC process started successfully")
+            return True
+        
+        return True
+    except Exception as e:
+        logging.error(f"Error opening file in VLC: {e}")
+        return False
+
+def delete_file(file_path, db_conn):
+
+    rv = True
+    try:
+        get_storage().remove(file_path)
+        logging.info(f"Deleted file: {file_path}")
+    except Exception as e:
+        logging.error(f"Error deleting file {file_path}: {e}")
+        rv = False
+        
     try:
         cursor = db_conn.cursor()
         cursor.execute("DELETE FROM media_files WHERE file_path = ?", (file_path,))
+        delete_track_rows(cursor, file_path)
         db_conn.commit()
         logging.info(f"Dropping file: {file_path} from database")
     except Exception as e:
@@ -307,25 +2033,243 @@ def is_english_language(language):
     ]
     return any(indicator in language or language.startswith(indicator) for indicator in english_indicators)
 
-def update_language_metadata(file_path, stream_type, stream_index, language):
-    try:
-        # Construct the FFmpeg command
-        cmd = [
-            'ffmpeg',
-            '-i', file_path,
-            '-map', '0',
-            '-c', 'copy',
-            f'-metadata:s:{stream_type}:{stream_index}', f'language={language}',
-            f'{file_path}.temp'
-        ]
-        
-        # Run the FFmpeg command
+def has_english_audio(audio_tracks):
+    return any(is_english_language(track.get('language', '')) for track in audio_tracks)
+
+def _load_tracks(metadata):
+    # Invalid JSON is treated as "no tracks" so the file lands in the review queue
+    try:
+        tracks = json.loads(metadata) if metadata else []
+    except json.JSONDecodeError:
+        return []
+    return tracks if isinstance(tracks, list) else []
+
+def delete_track_rows(cursor, file_path):
+    cursor.execute("DELETE FROM audio_tracks WHERE file_path = ?", (file_path,))
+    cursor.execute("DELETE FROM subtitle_tracks WHERE file_path = ?", (file_path,))
+
+def write_track_rows(cursor, file_path, audio_tracks, subtitle_tracks):
+    delete_track_rows(cursor, file_path)
+    cursor.executemany("""INSERT INTO audio_tracks
+                          (file_path, track_index, language, format, channels, bit_rate, is_english)
+                          VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                       [(file_path, i, track.get('language'), track.get('format'), str(track.get('channels')),
+                         str(track.get('bit_rate')), is_english_language(track.get('language', '')))
+                        for i, track in enumerate(audio_tracks)])
+    cursor.executemany("""INSERT INTO subtitle_tracks
+                          (file_path, track_index, language, format, is_english)
+                          VALUES (?, ?, ?, ?, ?)""",
+                       [(file_path, i, track.get('language'), track.get('format'),
+                         is_english_language(track.get('language', '')))
+                        for i, track in enumerate(subtitle_tracks)])
+
+MKV_TRACK_TYPES = {1: 'v', 2: 'a', 0x11: 's'}  # TrackType -> ffmpeg stream type letter
+MP4_TRACK_TYPES = {'vide': 'v', 'soun': 'a', 'sbtl': 's', 'text': 's', 'subt': 's', 'clcp': 's'}
+
+def get_iso_639_2(language, terminology=False):
+    """Three-letter code for a language given as e.g. `en`, `eng`, `fre` or `en-US`.
+
+    Matroska uses the bibliographic codes (`fre`), MP4 the terminology ones (`fra`).
+    """
+    base = language.strip().lower().split('-')[0]
+    two_letter = ISO_639_2_TO_1.get(base, base)
+    # ISO_639_2_TO_1 lists the bibliographic code first where the two differ
+    codes = [code for code, short in ISO_639_2_TO_1.items() if short == two_letter]
+    if codes:
+        return codes[-1] if terminology else codes[0]
+    if len(base) == 3 and base.isalpha():
+        return base
+    raise ValueError(f"Unsupported language code: {language}")
+
+def _ebml_encode(element_id, payload, size_length=None):
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+    length = size_length or next(n for n in range(1, 9) if len(payload) < (1 << (7 * n)) - 1)
+    return id_bytes + ((1 << (7 * length)) | len(payload)).to_bytes(length, 'big') + payload
+
+def _ebml_void(length):
+    # Void element filling exactly `length` (>= 2) bytes
+    size_length = 1 if length - 2 < 127 else 8
+    return _ebml_encode(0xEC, b'\0' * (length - 1 - size_length), size_length)
+
+def retag_matroska(file_path, edits):
+    """Rewrite the Tracks element in place with new Language values. False when it would no longer fit."""
+    with open(file_path, 'r+b') as f:
+        positions = _matroska_layout(f)
+        if positions is None or MKV_TRACKS not in positions:
+            return False
+        tracks_offset = positions[MKV_TRACKS]
+        _, payload_start, size = _read_ebml_header(f, tracks_offset)
+        if size is None or size > HEADER_ELEMENT_LIMIT:
+            return False
+        f.seek(payload_start)
+        payload = f.read(size)
+        # A Void right after Tracks (mkvmerge and mkvpropedit leave one) can absorb growth
+        available = payload_start + size - tracks_offset
+        try:
+            next_id, next_payload_start, next_size = _read_ebml_header(f, payload_start + size)
+            if next_id == 0xEC and next_size is not None:
+                available = next_payload_start + next_size - tracks_offset
+        except (ValueError, IndexError):
+            pass
+
+        remaining = dict(edits)
+        counters = {}
+        children = []
+        for child_id, child in _ebml_children(payload):
+            if child_id == 0xAE:
+                fields = list(_ebml_children(child))
+                track_type = MKV_TRACK_TYPES.get(_ebml_uint(dict(fields).get(0x83, b'')))
+                index = counters.get(track_type, 0)
+                counters[track_type] = index + 1
+                language = remaining.pop((track_type, index), None)
+                if language is not None:
+                    # LanguageBCP47 would override Language, so the edited track keeps only Language
+                    fields = [field for field in fields if field[0] not in (0x22B59C, 0x22B59D)]
+                    fields.append((0x22B59C, get_iso_639_2(language).encode('ascii')))
+                    child = b''.join(_ebml_encode(field_id, value) for field_id, value in fields)
+            children.append((child_id, child))
+        if remaining:
+            raise ValueError(f"No such stream(s) in {file_path}: {sorted(remaining)}")
+
+        body = b''.join(_ebml_encode(child_id, child) for child_id, child in children if child_id != 0xBF)
+        if children and children[0][0] == 0xBF:
+            # Muxers like ffmpeg protect level 1 elements with a CRC-32 of the rest of the payload
+            body = _ebml_encode(0xBF, struct.pack('<I', zlib.crc32(body))) + body
+        new_tracks = _ebml_encode(MKV_TRACKS, body)
+        leftover = available - len(new_tracks)
+        if leftover == 1:
+            # Too small for a Void; spend the byte on a longer size field instead
+            new_tracks = _ebml_encode(MKV_TRACKS, body, len(new_tracks) - len(body) - 3)
+            leftover = 0
+        if leftover < 0:
+            return False
+        throttle('write', 'retag', available)
+        f.seek(tracks_offset)
+        f.write(new_tracks + (_ebml_void(leftover) if leftover else b''))
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+def retag_mp4(file_path, edits):
+    """Patch the packed language code of each edited track's mdhd box in place."""
+    patches = []
+    remaining = dict(edits)
+    with open(file_path, 'r+b') as f:
+        file_end = os.fstat(f.fileno()).st_size
+        moov = next(((start, end) for box_type, start, end in _mp4_boxes(f, 0, file_end) if box_type == 'moov'), None)
+        if moov is None:
+            return False
+        counters = {}
+        for box_type, start, end in list(_mp4_boxes(f, *moov)):
+            if box_type != 'trak':
+                continue
+            mdia = next(((s, e) for t, s, e in _mp4_boxes(f, start, end) if t == 'mdia'), None)
+            if mdia is None:
+                continue
+            boxes = {t: (s, e) for t, s, e in _mp4_boxes(f, *mdia)}
+            if 'hdlr' not in boxes or 'mdhd' not in boxes:
+                continue
+            f.seek(boxes['hdlr'][0] + 8)
+            track_type = MP4_TRACK_TYPES.get(f.read(4).decode('latin-1'))
+            if track_type is None:
+                continue
+            index = counters.get(track_type, 0)
+            counters[track_type] = index + 1
+            language = remaining.pop((track_type, index), None)
+            if language is None:
+                continue
+            code = get_iso_639_2(language, terminology=True)
+            packed = sum((ord(char) - 0x60) << shift for char, shift in zip(code, (10, 5, 0)))
+            mdhd_start = boxes['mdhd'][0]
+            f.seek(mdhd_start)
+            patches.append((mdhd_start + (32 if f.read(1) == b'\x01' else 20), struct.pack('>H', packed)))
+            if 'elng' in boxes:
+                # An extended language box overrides mdhd; turning it into a free box drops it in place
+                patches.append((boxes['elng'][0] - 4, b'free'))
+        if remaining:
+            raise ValueError(f"No such stream(s) in {file_path}: {sorted(remaining)}")
+        for offset, data in patches:
+            throttle('write', 'retag', len(data))
+            f.seek(offset)
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+CONTAINER_RETAGGERS = {
+    '.mkv': retag_matroska, '.webm': retag_matroska,
+    '.mp4': retag_mp4, '.m4v': retag_mp4, '.mov': retag_mp4, '.3gp': retag_mp4, '.3g2': retag_mp4, '.f4v': retag_mp4,
+}
+
+def remux_languages(file_path, edits):
+    # One combined stream copy for every edit; temp files keep the extension so ffmpeg picks the same muxer.
+    # ffmpeg writes to local disk and the result goes back to the share through the bandwidth limiter
+    base, ext = os.path.splitext(file_path)
+    local_dir = os.path.join(DESTINATION_DIR, 'retag')
+    os.makedirs(local_dir, exist_ok=True)
+    local_file = os.path.join(local_dir, hashlib.sha1(file_path.encode('utf-8')).hexdigest()[:12] + ext)
+    temp_file = f"{base}.temp{ext}"
+    cmd = ['ffmpeg', '-y', '-i', file_path, '-map', '0', '-c', 'copy']
+    for (stream_type, stream_index), language in sorted(edits.items()):
+        cmd += [f'-metadata:s:{stream_type}:{stream_index}', f'language={get_iso_639_2(language)}']
+    cmd.append(local_file)
+    storage = get_storage()
+    try:
         subprocess.run(cmd, check=True, capture_output=True, text=True)
-        
-        # Replace the original file with the new one
-        os.replace(f'{file_path}.temp', file_path)
-        
-        logging.info(f"Updated {stream_type} stream {stream_index} language to {language} for {file_path}")
+        storage.copy(local_file, temp_file, bandwidth=('write', 'retag'), read_back=True)
+        storage.replace(temp_file, file_path)
+    except Exception:
+        if storage.exists(temp_file):
+            storage.remove(temp_file)
+        raise
+    finally:
+        if os.path.exists(local_file):
+            os.remove(local_file)
+
+def refresh_media_row(db_conn, file_path):
+    # Re-probe after an edit; review flags are kept and the new mtime stops the next scan from re-adding the row
+    stat = get_storage().stat(file_path)
+    audio_tracks, subtitle_tracks, video_info = get_file_metadata(file_path)
+    fingerprint = None
+    try:
+        # The edit may not touch the fingerprinted blocks, so the cache entry is replaced rather than trusted
+        fingerprint = compute_fingerprint(file_path, stat.st_size)
+        store_metadata_cache(db_conn, fingerprint, stat.st_size, audio_tracks, subtitle_tracks, video_info)
+    except OSError as e:
+        logging.warning(f"Could not fingerprint {file_path}: {e}")
+    cursor = db_conn.cursor()
+    cursor.execute("""UPDATE media_files SET file_size = ?, last_modified = ?, audio_metadata = ?, subtitle_metadata = ?,
+                                             has_english_audio = ?, fingerprint = ?
+                      WHERE file_path = ?""",
+                   (stat.st_size, int(stat.st_mtime), json.dumps(audio_tracks), json.dumps(subtitle_tracks),
+                    has_english_audio(audio_tracks), fingerprint, file_path))
+    delete_track_rows(cursor, file_path)
+    write_track_rows(cursor, file_path, audio_tracks, subtitle_tracks)
+    db_conn.commit()
+    return audio_tracks, subtitle_tracks
+
+def retag_languages(file_path, edits, db_conn=None):
+    """Set stream languages; edits maps (stream_type, stream_index) such as ('a', 0) to a language code.
+
+    Matroska and MP4 headers are edited in place; anything else, or Matroska track headers that no longer fit,
+    gets a single ffmpeg remux covering all edits.
+    """
+    try:
+        for language in edits.values():
+            get_iso_639_2(language)
+        retagger = CONTAINER_RETAGGERS.get(os.path.splitext(file_path)[1].lower())
+        in_place = False
+        if retagger is not None:
+            try:
+                in_place = retagger(file_path, edits)
+            except (OSError, IndexError, struct.error) as e:
+                logging.warning(f"In-place retag of {file_path} failed ({e}); remuxing")
+        if not in_place:
+            remux_languages(file_path, edits)
+        logging.info(f"Updated {len(edits)} stream language(s) for {file_path}"
+                     + (" in place" if in_place else " by remuxing"))
+        if db_conn is not None:
+            refresh_media_row(db_conn, file_path)
         return True
     except subprocess.CalledProcessError as e:
         logging.error(f"Error updating language metadata: {e}")
@@ -335,32 +2279,260 @@ def update_language_metadata(file_path, stream_type, stream_index, language):
         logging.error(f"Unexpected error updating language metadata: {e}")
         return False
 
+def update_language_metadata(file_path, stream_type, stream_index, language, db_conn=None):
+    return retag_languages(file_path, {(stream_type, int(stream_index)): language}, db_conn)
 
-def get_files_without_english_audio(db_conn):
-    cursor = db_conn.cursor()
-    cursor.execute("""
-        SELECT file_path, audio_metadata, subtitle_metadata
-        FROM media_files
-        WHERE has_been_reviewed IS NULL OR has_been_reviewed = 0
-    """)
-    
-    files_to_review = []
-    for file_path, audio_metadata, subtitle_metadata in cursor.fetchall():
+def parse_language_edits(text):
+    """Parse `a:0=eng s:1=spa` into retag_languages edits."""
+    edits = {}
+    for item in text.split():
+        stream, sep, language = item.partition('=')
+        stream_type, _, stream_index = stream.partition(':')
+        if not sep or stream_type not in ('a', 's') or not stream_index.isdigit() or not language:
+            raise ValueError(f"Invalid edit '{item}', expected e.g. a:0=eng")
+        edits[(stream_type, int(stream_index))] = language
+    return edits
+
+
+def get_review_cache_dir(file_path):
+    return os.path.join(REVIEW_CACHE_DIR, hashlib.sha1(file_path.encode('utf-8')).hexdigest()[:12])
+
+def load_review_preview(file_path):
+    """Manifest of a cached preview, or None when there is none or the file changed since it was built."""
+    manifest_path = os.path.join(get_review_cache_dir(file_path), 'manifest.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        stat = get_storage().stat(file_path)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('file_size') != stat.st_size or manifest.get('mtime') != int(stat.st_mtime):
+        return None
+    # The manifest's mtime is the last use, which eviction orders by
+    os.utime(manifest_path)
+    return manifest
+
+def _run_ffmpeg(args):
+    result = subprocess.run(['ffmpeg', '-v', 'error', '-y'] + args, capture_output=True, text=True)
+    if result.returncode != 0:
+        logging.debug(f"ffmpeg {' '.join(args)} failed: {result.stderr.strip()}")
+    return result.returncode == 0
+
+def build_review_preview(file_path, duration, audio_count):
+    """Cut a keyframe contact sheet and one snippet per audio track into the review cache; returns the manifest."""
+    cached = load_review_preview(file_path)
+    if cached is not None:
+        return cached
+    stat = get_storage().stat(file_path)
+    cache_dir = get_review_cache_dir(file_path)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+
+    # Seeking before -i jumps straight to a keyframe, so each thumbnail reads a few MB rather than the whole file
+    frames = 0
+    for i in range(CONTACT_SHEET_FRAMES if duration else 0):
+        frame_path = os.path.join(cache_dir, f'frame_{frames:02d}.jpg')
+        position = duration * (i + 1) / (CONTACT_SHEET_FRAMES + 1)
+        if _run_ffmpeg(['-ss', f'{position:.1f}', '-skip_frame', 'nokey', '-i', file_path, '-frames:v', '1',
+                        '-vf', f'scale={CONTACT_SHEET_THUMB_WIDTH}:-2', frame_path]) and os.path.exists(frame_path):
+            frames += 1
+    contact_sheet = None
+    if frames:
+        rows = -(-frames // CONTACT_SHEET_COLUMNS)
+        contact_sheet = os.path.join(cache_dir, 'contact_sheet.jpg')
+        if not _run_ffmpeg(['-i', os.path.join(cache_dir, 'frame_%02d.jpg'), '-frames:v', '1',
+                            '-vf', f'tile={CONTACT_SHEET_COLUMNS}x{rows}', contact_sheet]):
+            contact_sheet = None
+        for i in range(frames):
+            os.remove(os.path.join(cache_dir, f'frame_{i:02d}.jpg'))
+
+    # Snippets come from a third of the way in, past intros and studio logos
+    start = duration / 3 if duration and duration > AUDIO_SNIPPET_SECONDS * 3 else 0
+    audio_snippets = {}
+    for i in range(audio_count):
+        snippet = os.path.join(cache_dir, f'audio_{i}.m4a')
+        if _run_ffmpeg(['-ss', f'{start:.1f}', '-i', file_path, '-map', f'0:a:{i}', '-t', str(AUDIO_SNIPPET_SECONDS),
+                        '-vn', '-ac', '2', '-c:a', 'aac', '-b:a', '96k', snippet]):
+            audio_snippets[str(i)] = snippet
+
+    manifest = {'file_path': file_path, 'file_size': stat.st_size, 'mtime': int(stat.st_mtime),
+                'contact_sheet': contact_sheet, 'audio_snippets': audio_snippets}
+    with open(os.path.join(cache_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+def discard_review_preview(file_path):
+    shutil.rmtree(get_review_cache_dir(file_path), ignore_errors=True)
+
+def evict_review_cache(keep=()):
+    """Remove least recently used previews until the cache fits REVIEW_CACHE_MAX_BYTES."""
+    keep = {get_review_cache_dir(file_path) for file_path in keep}
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(REVIEW_CACHE_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        cache_dir = os.path.join(REVIEW_CACHE_DIR, name)
+        size = 0
+        last_used = 0
         try:
-            audio_tracks = json.loads(audio_metadata)
-            has_english_audio = any(is_english_language(track.get('language', '')) for track in audio_tracks)
-            if not has_english_audio:
-                files_to_review.append((file_path, audio_metadata, subtitle_metadata))
-        except json.JSONDecodeError:
-            logging.warning(f"Invalid JSON in audio_metadata for {file_path}")
-            files_to_review.append((file_path, audio_metadata, subtitle_metadata))
-    
-    return files_to_review
+            for entry in os.scandir(cache_dir):
+                stat = entry.stat()
+                size += stat.st_size
+                if entry.name == 'manifest.json':
+                    last_used = stat.st_mtime
+        except OSError:
+            continue
+        total += size
+        entries.append((last_used, size, cache_dir))
+    # Directories without a manifest are half-built leftovers and sort first
+    for last_used, size, cache_dir in sorted(entries):
+        if total <= REVIEW_CACHE_MAX_BYTES:
+            break
+        if cache_dir in keep:
+            continue
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        total -= size
+
+class ReviewPrefetcher:
+    """Builds review previews on a background thread, ahead of the file the reviewer is looking at."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.ready = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        os.makedirs(REVIEW_CACHE_DIR, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Files still queued are skipped; whatever was built stays cached for the next session
+        with self.lock:
+            self.ready.clear()
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, file_path, duration, audio_count):
+        with self.lock:
+            self.ready[file_path] = threading.Event()
+            self.pending.append(file_path)
+        self.queue.put((file_path, duration, audio_count))
+
+    def wait(self, file_path, timeout):
+        """Manifest for a submitted file, or None if it failed or is not ready within timeout."""
+        event = self.ready.get(file_path)
+        if event is None or not event.wait(timeout):
+            return None
+        return load_review_preview(file_path)
+
+    def done(self, file_path):
+        with self.lock:
+            self.ready.pop(file_path, None)
+            if file_path in self.pending:
+                self.pending.remove(file_path)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            file_path, duration, audio_count = item
+            with self.lock:
+                event = self.ready.get(file_path)
+            if event is None:
+                continue
+            try:
+                build_review_preview(file_path, duration, audio_count)
+            except Exception as e:
+                logging.warning(f"Could not build review preview for {file_path}: {e}")
+            event.set()
+            with self.lock:
+                keep = list(self.pending)
+            evict_review_cache(keep)
+
+def open_with_default_app(path):
+    system = platform.system()
+    try:
+        if system == "Darwin":
+            subprocess.Popen(['open', path])
+        elif system == "Windows":
+            os.startfile(path)
+        else:
+            subprocess.Popen(['xdg-open', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
+    except Exception as e:
+        logging.error(f"Error opening {path}: {e}")
+        return False
+
+def play_audio_snippet(path):
+    # Blocks until the snippet ends, which is only AUDIO_SNIPPET_SECONDS
+    system = platform.system()
+    if system == "Windows":
+        return open_with_default_app(path)
+    cmd = ['afplay', path] if system == "Darwin" else ['ffplay', '-nodisp', '-autoexit', '-loglevel', 'quiet', path]
+    try:
+        subprocess.run(cmd, check=True)
+        return True
+    except Exception as e:
+        logging.error(f"Error playing {path}: {e}")
+        return False
+
+
+REVIEW_QUEUE_FILTER = "(has_been_reviewed IS NULL OR has_been_reviewed = 0) AND has_english_audio = 0"
+
+def count_files_without_english_audio(db_conn):
+    cursor = db_conn.cursor()
+    cursor.execute(f"SELECT COUNT(*) FROM media_files WHERE {REVIEW_QUEUE_FILTER}")
+    return cursor.fetchone()[0]
+
+def get_files_without_english_audio(db_conn, batch_size=100):
+    # Keyset pagination keeps memory flat and lets the caller update rows between batches
+    cursor = db_conn.cursor()
+    last_path = ''
+    while True:
+        cursor.execute(f"""
+            SELECT file_path, audio_metadata, subtitle_metadata, duration
+            FROM media_files
+            WHERE {REVIEW_QUEUE_FILTER} AND file_path > ?
+            ORDER BY file_path
+            LIMIT ?
+        """, (last_path, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        yield from rows
+        last_path = rows[-1][0]
 
 def review_files(db_conn):
-    files_to_review = get_files_without_english_audio(db_conn)
-    
-    for file_path, audio_metadata, subtitle_metadata in files_to_review:
+    # Previews are cut from the share in the background, so mount it up front
+    get_storage().ensure_available()
+    prefetcher = ReviewPrefetcher()
+    prefetcher.start()
+    try:
+        _review_queue(db_conn, prefetcher)
+    finally:
+        prefetcher.stop()
+
+def _review_queue(db_conn, prefetcher):
+    files = get_files_without_english_audio(db_conn)
+    upcoming = collections.deque()
+    while True:
+        # Keep REVIEW_PREFETCH_DEPTH files submitted beyond the one being reviewed
+        while len(upcoming) <= REVIEW_PREFETCH_DEPTH:
+            row = next(files, None)
+            if row is None:
+                break
+            upcoming.append(row)
+            prefetcher.submit(row[0], row[3], len(_load_tracks(row[1])))
+        if not upcoming:
+            return
+        file_path, audio_metadata, subtitle_metadata, duration = upcoming.popleft()
         print(f"\nReviewing file: {file_path}")
         
         # Print file metadata
@@ -386,16 +2558,51 @@ def review_files(db_conn):
                 print("  No English subtitles found")
         except json.JSONDecodeError:
             print("  Unable to parse subtitle metadata")
-        
-        # Ask if user wants to open in VLC
+
+        # Mis-tagged tracks are fixed in the file headers, which costs kilobytes rather than a full rewrite
         while True:
-            choice = input("Do you want to open this file in VLC? (y/n): ").lower()
-            if choice in ['y', 'n']:
+            edits = input("Relabel track languages? Enter edits like 'a:0=eng s:1=spa', or press Enter to skip: ")
+            if not edits.strip():
                 break
-            print("Invalid input. Please enter 'y' or 'n'.")
+            try:
+                edits = parse_language_edits(edits)
+            except ValueError as e:
+                print(e)
+                continue
+            if get_storage().ensure_available() and retag_languages(file_path, edits, db_conn):
+                print("Languages updated")
+            else:
+                print("Failed to update languages")
+            break
+        
+        preview = prefetcher.wait(file_path, REVIEW_PREVIEW_WAIT)
+        if preview and (preview['contact_sheet'] or preview['audio_snippets']):
+            # Cached previews cover most decisions; VLC stays available for the rest
+            if preview['contact_sheet']:
+                print(f"Contact sheet: {preview['contact_sheet']}")
+            for i, snippet in sorted(preview['audio_snippets'].items(), key=lambda item: int(item[0])):
+                print(f"  Audio snippet {i}: {snippet}")
+            while True:
+                choice = input("Show contact sheet (s), play audio snippet (a<N>), open in VLC (v) or continue (c): ").lower()
+                if choice == 's' and preview['contact_sheet']:
+                    open_with_default_app(preview['contact_sheet'])
+                elif choice.startswith('a') and choice[1:] in preview['audio_snippets']:
+                    play_audio_snippet(preview['audio_snippets'][choice[1:]])
+                elif choice in ['v', 'c']:
+                    break
+                else:
+                    print("Invalid input.")
+            choice = 'y' if choice == 'v' else 'n'
+        else:
+            # Ask if user wants to open in VLC
+            while True:
+                choice = input("Do you want to open this file in VLC? (y/n): ").lower()
+                if choice in ['y', 'n']:
+                    break
+                print("Invalid input. Please enter 'y' or 'n'.")
         
         if choice == 'y':
-            if ensure_smb_mounted(SMB_SERVER, SMB_PATH, MOUNT_POINT):            
+            if get_storage().ensure_available():
                 open_in_vlc(file_path)
                 input("Press Enter when you're done reviewing the file in VLC...")
             else:
@@ -420,188 +2627,1930 @@ def review_files(db_conn):
                 print(f"File deleted: {file_path}")
             else:
                 print(f"Failed to delete file: {file_path}")
+        prefetcher.done(file_path)
+        discard_review_preview(file_path)
         
         print("\n--- End of file review ---\n")
 
 
-def copy_with_retries(src, dst, retries=2):
+# errnos meaning the kernel can't do an in-kernel copy between these two files
+_ZERO_COPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+def _write_all(fdst, view):
+    while view:
+        written = fdst.write(view)
+        view = view[written:]
+
+def _copy_range(fsrc, fdst, offset, total, buffer_size, digest, state, bandwidth=None):
+    """Copy bytes from offset to total, updating state['offset'] after every confirmed write.
+
+    bandwidth is the (direction, op_class) each chunk is charged to, or None for an unthrottled copy.
+    """
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    if digest is None and state['zero_copy']:
+        try:
+            while offset < total:
+                if bandwidth is not None:
+                    throttle(*bandwidth, min(buffer_size, total - offset))
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(src_fd, dst_fd, min(buffer_size, total - offset), offset, offset)
+                else:
+                    os.lseek(dst_fd, offset, os.SEEK_SET)
+                    copied = os.sendfile(dst_fd, src_fd, offset, min(buffer_size, total - offset))
+                if copied == 0:
+                    break
+                offset += copied
+                state['offset'] = offset
+            return
+        except (OSError, AttributeError) as e:
+            if isinstance(e, OSError) and e.errno not in _ZERO_COPY_UNSUPPORTED:
+                raise
+            state['zero_copy'] = False
+
+    # Buffered path: the data passes through userspace once, so it is hashed on the way
+    view = memoryview(bytearray(buffer_size))
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    while offset < total:
+        if bandwidth is not None:
+            throttle(*bandwidth, min(buffer_size, total - offset))
+        read = fsrc.readinto(view[:min(buffer_size, total - offset)])
+        if not read:
+            break
+        _write_all(fdst, view[:read])
+        if digest is not None:
+            digest.update(view[:read])
+        offset += read
+        state['offset'] = offset
+
+def read_back_checksum(path, op_class=None):
+    """BLAKE2 checksum of path as stored, read through the bandwidth limiter when op_class is given."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb', buffering=0) as raw:
+        # Pages this host just wrote would otherwise be served from its own cache instead of the destination
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(raw.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        f = ThrottledReader(raw, op_class) if op_class else raw
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def copy_file(src, dst, retries=COPY_RETRIES, verify=COPY_VERIFY, buffer_size=COPY_BUFFER_SIZE, bandwidth=None,
+              read_back=False):
+    """Copy src to dst and return the BLAKE2 checksum of the data (None when verify is off).
+
+    A failed attempt resumes from the last byte confirmed written instead of starting over. With read_back (and
+    verify), the whole destination is read again and must hash the same as the source, instead of sampled blocks.
+    """
+    total = os.path.getsize(src)
+    digest = hashlib.blake2b(digest_size=16) if verify else None
+    # Without hashing, the kernel can move the bytes directly (copy_file_range/sendfile)
+    state = {'offset': 0, 'zero_copy': not verify and hasattr(os, 'sendfile')}
+    start = time.monotonic()
     attempt = 0
-    while attempt <= retries:
+    while True:
         try:
-            shutil.copy2(src, dst)
-            return True
-        except Exception as e:
-            logging.error(f"Copy attempt {attempt + 1} failed: {e}")
+            # Unbuffered files so every completed write really is on its way to the destination
+            dst_fd = os.open(dst, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+            with open(src, 'rb', buffering=0) as fsrc, open(dst_fd, 'r+b', buffering=0) as fdst:
+                # Anything past the last confirmed write may be garbage from the failed attempt
+                fdst.truncate(state['offset'])
+                _copy_range(fsrc, fdst, state['offset'], total, buffer_size, digest, state, bandwidth)
+                os.fsync(fdst.fileno())
+
+            if os.path.getsize(dst) != total:
+                raise OSError(errno.EIO, f"size mismatch after copy ({os.path.getsize(dst)} of {total} bytes)")
+            if verify and read_back:
+                mismatch = read_back_checksum(dst, bandwidth and bandwidth[1]) != digest.hexdigest()
+            else:
+                mismatch = verify and compute_fingerprint(dst, total) != compute_fingerprint(src, total)
+            if mismatch:
+                # Corruption can be anywhere, so the next attempt starts from scratch
+                state['offset'] = 0
+                digest = hashlib.blake2b(digest_size=16)
+                raise OSError(errno.EIO, "destination differs from the source after copy")
+            break
+        except OSError as e:
             attempt += 1
-            time.sleep(1)  # Backoff before retry
-    return False
+            if attempt > retries:
+                raise Exception(f"Failed to copy {src} after {attempt} attempts: {e}")
+            logging.error(f"Copy attempt {attempt} of {src} failed at byte {state['offset']}: {e}")
+            time.sleep(min(RETRY_DELAY * 2 ** (attempt - 1), 60))  # Backoff before resuming
+            storage = get_storage()
+            storage.invalidate()
+            storage.ensure_available()
 
-def compress_file(file_path, db_conn):
     try:
-        logging.info(f"Beginning to compress {os.path.basename(file_path)}")
+        shutil.copystat(src, dst)
+    except OSError:
+        pass
 
-        # Copy the file to local directory
-        input_file = os.path.join(DESTINATION_DIR, os.path.basename(file_path))
-        
-        # Replace extension with .mp4
-        base, ext = os.path.splitext(input_file)
-        if ext.lower() == '.mp4':
-            output_file = base + '.mp42'
-            logging.info(f"Destination path {input_file} already ends with .mp4. Using .mp42 for temporary output.")
-        else:
-            output_file = base + '.mp4'
-
-        logging.info(f"Copying {os.path.basename(file_path)}")
-        ensure_smb_mounted(SMB_SERVER, SMB_PATH, MOUNT_POINT)
-        if not copy_with_retries(file_path, input_file):
-            raise Exception(f"Failed to copy {file_path}")
-
-        # Process the file with HandBrakeCLI
-        handbrake_command = [
-            'HandBrakeCLI',
-            '--preset-import-gui', HANDBRAKE_PRESET,
-            '-i', input_file,
-            '-o', output_file
-        ]
-
-        logging.info(f"Running the following command {handbrake_command}")
-        process = subprocess.Popen(handbrake_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        # Read and log output in real-time
-        line_counter = 0
-        while True:
-            output = process.stdout.readline()
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                if "encoding" in output.lower():
-                    line_counter += 1
-                    if line_counter % 1000 == 0:
-                        logging.info(output.strip())
-                        continue
-                else:
-                    logging.info(output.strip())
+    elapsed = max(time.monotonic() - start, 1e-6)
+    logging.info(f"Copied {os.path.basename(src)}: {total / 1e6:.1f} MB in {elapsed:.1f}s "
+                 f"({total / 1e6 / elapsed:.1f} MB/s)")
+    return digest.hexdigest() if digest is not None else None
 
-        stderr = process.communicate()[1]
-        if stderr:
-            logging.error(stderr.strip())
+def get_staging_paths(file_path):
+    # Each job gets its own staging directory so same-named episodes from different shows never collide
+    job_dir = os.path.join(DESTINATION_DIR, hashlib.sha1(file_path.encode('utf-8')).hexdigest()[:12])
+    input_file = os.path.join(job_dir, os.path.basename(file_path))
 
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, handbrake_command)
+    # Replace extension with .mp4
+    base, ext = os.path.splitext(input_file)
+    if ext.lower() == '.mp4':
+        output_file = base + '.mp42'
+        logging.info(f"Destination path {input_file} already ends with .mp4. Using .mp42 for temporary output.")
+    else:
+        output_file = base + '.mp4'
+    return job_dir, input_file, output_file
 
-        # Remove the input_file
-        os.remove(input_file)
+def file_checksum(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-        # Rename .mp42 back to .mp4 if necessary
-        if output_file.endswith('.mp42'):
-            final_output_file = output_file.replace('.mp42', '.mp4')
-            os.rename(output_file, final_output_file)
-            output_file = final_output_file
+# Phases of a compression in the order they complete; each is persisted in compress_state
+COMPRESS_PHASES = ('copied_in', 'encoded', 'uploaded', 'original_removed', 'db_updated')
 
-        # Copy the output file to the original file directory and remove the original file
-        logging.info(f"Compression of {os.path.basename(file_path)} completed, copying {output_file} to original directory")
-        ensure_smb_mounted(SMB_SERVER, SMB_PATH, MOUNT_POINT)
-        if not copy_with_retries(output_file, os.path.join(os.path.dirname(file_path), os.path.basename(output_file))):
-            raise Exception(f"Failed to copy {output_file}")
+def _write_phase(cursor, file_path, phase, artifact_path, checksum):
+    cursor.execute("""INSERT OR REPLACE INTO compress_state (file_path, phase, artifact_path, checksum, host, updated_at)
+                      VALUES (?, ?, ?, ?, ?, ?)""",
+                   (file_path, phase, artifact_path, checksum, socket.gethostname(), int(time.time())))
 
-        # Remove the output file
-        logging.info(f"Unlinking {output_file}")
-        os.remove(output_file)
+def record_phase(db_conn, file_path, phase, artifact_path, checksum=None):
+    if db_conn is None:
+        return
+    _write_phase(db_conn.cursor(), file_path, phase, artifact_path, checksum)
+    db_conn.commit()
 
-        # Remove the original file
-        logging.info(f"Unlinking {file_path}")
-        ensure_smb_mounted(SMB_SERVER, SMB_PATH, MOUNT_POINT)
-        os.remove(file_path)
+def get_upload_path(file_path, output_file):
+    return os.path.join(os.path.dirname(file_path), os.path.basename(output_file).replace('.mp42', '.mp4'))
 
-        # Update the database with new file size and metadata
-        new_file_path = os.path.join(os.path.dirname(file_path), os.path.basename(output_file))
-        new_file_size = os.path.getsize(new_file_path)
-        new_audio_tracks, new_subtitle_tracks = get_file_metadata(new_file_path)
+def discard_compress_state(db_conn, file_path):
+    job_dir, _, output_file = get_staging_paths(file_path)
+    cleanup_staging(job_dir)
+    partial_upload = get_upload_path(file_path, output_file) + '.partial'
+    storage = get_storage()
+    if storage.exists(partial_upload):
+        storage.remove(partial_upload)
+    db_conn.execute("DELETE FROM compress_state WHERE file_path = ?", (file_path,))
+    db_conn.commit()
 
-        cursor = db_conn.cursor()
-        cursor.execute("""
-            UPDATE media_files 
-            SET file_path = ?, file_size = ?, last_modified = ?, 
-                audio_metadata = ?, subtitle_metadata = ?, needs_compression = 0
-            WHERE file_path = ?
-        """, (new_file_path, new_file_size, int(time.time()), 
-              json.dumps(new_audio_tracks), json.dumps(new_subtitle_tracks), file_path))
-        db_conn.commit()
+def load_resume_point(db_conn, file_path):
+    """Return (phase, artifact_path) of a verified unfinished compression of file_path, or (None, None)."""
+    row = db_conn.execute("SELECT phase, artifact_path, checksum, host FROM compress_state WHERE file_path = ?",
+                          (file_path,)).fetchone()
+    if row is None or row[0] == 'db_updated':
+        return None, None
+    phase, artifact_path, checksum, host = row
 
-        logging.info(f"Successfully compressed and updated database for {file_path}")
-        return True
-    except Exception as e:
-        logging.error(f"Failed to compress file {file_path}: {e}")
-        return False
+    # Staged artifacts only exist on the host that made them
+    if phase in ('copied_in', 'encoded') and host != socket.gethostname():
+        return None, None
 
-def compress_files(file_type, size_threshold, db_conn):
-    cursor = db_conn.cursor()
-    
-    # Select files of the specified type that need compression
-    query = """
-        SELECT file_path 
-        FROM media_files 
+    if db_conn.execute("SELECT 1 FROM media_files WHERE file_path = ?", (file_path,)).fetchone() is None:
+        logging.info(f"Dropping stale compression state for {file_path}: no longer in the library")
+        discard_compress_state(db_conn, file_path)
+        return None, None
+
+    # Uploaded artifacts live on the share, staged ones on local disk
+    exists = get_storage().exists if phase in ('uploaded', 'original_removed') else os.path.exists
+    if phase == 'original_removed':
+        valid = exists(artifact_path)
+    else:
+        valid = exists(artifact_path) and file_checksum(artifact_path) == checksum
+    if not valid:
+        if phase == 'original_removed':
+            logging.error(f"Compressed copy {artifact_path} is missing and the original {file_path} was removed")
+        else:
+            logging.warning(f"Artifact {artifact_path} for {file_path} failed verification; starting over")
+        discard_compress_state(db_conn, file_path)
+        return None, None
+    return phase, artifact_path
+
+@timed_phase('compress.copy_in')
+def stage_in(file_path, input_file, state_conn=None):
+    logging.info(f"Copying {os.path.basename(file_path)}")
+    os.makedirs(os.path.dirname(input_file), exist_ok=True)
+    storage = get_storage()
+    storage.ensure_available()
+    checksum = storage.copy(file_path, input_file, bandwidth=('read', 'copy'))
+    metrics.increment('compress.bytes_in', os.path.getsize(input_file))
+    if state_conn is not None:
+        record_phase(state_conn, file_path, 'copied_in', input_file, checksum or file_checksum(input_file))
+
+_handbrake_preset = None
+_handbrake_preset_hash = None
+
+def load_handbrake_preset():
+    global _handbrake_preset
+    if _handbrake_preset is None:
+        with open(HANDBRAKE_PRESET) as f:
+            _handbrake_preset = json.load(f)['PresetList'][0]
+    return _handbrake_preset
+
+def get_preset_hash():
+    # Identifies the preset revision an encode ran with
+    global _handbrake_preset_hash
+    if _handbrake_preset_hash is None:
+        with open(HANDBRAKE_PRESET, 'rb') as f:
+            _handbrake_preset_hash = hashlib.sha1(f.read()).hexdigest()[:12]
+    return _handbrake_preset_hash
+
+_encode_profiles = {}
+_encode_profiles_lock = threading.Lock()
+
+def get_profile_frame_rate(frame_rate, peak):
+    # The nearest rate HandBrake knows, capped at the preset's; None leaves the source's own timing
+    if not frame_rate:
+        return None
+    rate = min(HANDBRAKE_FRAME_RATES, key=lambda candidate: abs(candidate - frame_rate))
+    if abs(rate - frame_rate) > 0.05:
+        return None
+    return f"{min(rate, peak):g}"
+
+def get_encode_profile(content_type, width, frame_rate):
+    """Preset for a source, derived from HANDBRAKE_PRESET and cached by its characteristics.
+
+    Returns {'path', 'name', 'hash', 'preset'}, or None when the source was never probed and the base preset applies.
+    """
+    if not width:
+        return None
+    base = load_handbrake_preset()
+    try:
+        peak = float(base.get('VideoFramerate'))
+    except (TypeError, ValueError):
+        peak = max(HANDBRAKE_FRAME_RATES)
+    tier_width, tier_height = next((tier for tier in PROFILE_RESOLUTION_TIERS if tier[0] >= width),
+                                   PROFILE_RESOLUTION_TIERS[-1])
+    rate = get_profile_frame_rate(frame_rate, peak)
+    multipass = width >= MULTIPASS_MIN_WIDTH
+    key = (content_type, tier_width, rate, multipass, get_preset_hash())
+    with _encode_profiles_lock:
+        profile = _encode_profiles.get(key)
+        if profile is not None:
+            return profile
+
+        preset = copy.deepcopy(base)
+        name = f"{base.get('PresetName', 'compress')}-{content_type}-{tier_height}p-{rate or 'source'}"
+        preset['PresetName'] = name
+        preset.update({
+            'PictureWidth': tier_width,
+            'PictureHeight': tier_height,
+            'PictureDARWidth': tier_width,
+            # Fixed crops belong to the source the preset was saved from; auto crop still applies
+            'PictureTopCrop': 0,
+            'PictureBottomCrop': 0,
+            'PictureLeftCrop': 0,
+            'PictureRightCrop': 0,
+            'VideoFramerate': rate or 'auto',
+            'VideoFramerateMode': 'pfr' if rate else 'vfr',
+        })
+        if not multipass:
+            preset['VideoMultiPass'] = False
+            preset['VideoTurboMultiPass'] = False
+        if 'x265' in preset.get('VideoEncoder', '') and content_type in X265_PRESETS:
+            preset['VideoPreset'] = X265_PRESETS[content_type]
+
+        with open(HANDBRAKE_PRESET) as f:
+            document = json.load(f)
+        document['PresetList'] = [preset]
+        content = json.dumps(document, indent=2, sort_keys=True)
+        profile_hash = hashlib.sha1(content.encode()).hexdigest()[:12]
+        path = os.path.join(PROFILE_CACHE_DIR, f"{name}-{profile_hash}.json")
+        if not os.path.exists(path):
+            # Written under a temporary name so concurrent compress jobs never read half a preset
+            os.makedirs(PROFILE_CACHE_DIR, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+            logging.info(f"Generated encode profile {name}")
+        profile = {'path': path, 'name': name, 'hash': profile_hash, 'preset': preset}
+        _encode_profiles[key] = profile
+    return profile
+
+def get_file_encode_profile(db_conn, file_path):
+    if db_conn is None:
+        return None
+    row = db_conn.execute("SELECT content_type, video_width, frame_rate FROM media_files WHERE file_path = ?",
+                          (file_path,)).fetchone()
+    return get_encode_profile(*row) if row is not None else None
+
+def get_thread_options(threads):
+    # --encopts replaces the preset's VideoOptionExtra, so the thread cap is appended to it
+    preset = load_handbrake_preset()
+    extra = preset.get('VideoOptionExtra', '')
+    if 'x265' in preset.get('VideoEncoder', ''):
+        cap = f"pools={threads}"
+    else:
+        cap = f"threads={threads}"
+    return f"{extra}:{cap}" if extra else cap
+
+def _drain_stream(stream, lines):
+    # Runs on its own thread so a chatty stderr can never fill its pipe and stall HandBrakeCLI
+    for line in stream:
+        line = line.rstrip()
+        if line:
+            lines.append(line)
+            logging.debug(line)
+
+def read_handbrake_json(stream):
+    """Yield (label, object) for each top-level `Label: {...}` block HandBrakeCLI --json writes to stdout."""
+    label = None
+    block = []
+    for line in stream:
+        line = line.rstrip()
+        if label is None:
+            name, sep, rest = line.partition(': ')
+            if sep and rest == '{':
+                label, block = name, ['{']
+            elif line:
+                logging.info(line)
+            continue
+        block.append(line)
+        # Nested objects are indented, so a bare closing brace ends the block
+        if line == '}':
+            try:
+                yield label, json.loads('\n'.join(block))
+            except ValueError:
+                logging.warning(f"Unparseable HandBrakeCLI {label} block")
+            label = None
+
+def update_encode_progress(progress, working, elapsed):
+    # Progress and the rates are per pass; percent and ETA cover the whole job
+    pass_count = max(working.get('PassCount') or 1, 1)
+    current_pass = min(max(working.get('Pass') or 1, 1), pass_count)
+    percent = ((current_pass - 1) + working.get('Progress', 0)) / pass_count * 100
+    progress.update({
+        'percent': round(percent, 2),
+        'fps': working.get('Rate', 0),
+        'avg_fps': working.get('RateAvg', 0),
+        'pass': current_pass,
+        'pass_count': pass_count,
+        'eta_seconds': int(elapsed * (100 - percent) / percent) if percent > 0 else None,
+        'elapsed': int(elapsed)
+    })
+    progress.setdefault('pass_avg_fps', {})[current_pass] = working.get('RateAvg', 0)
+
+def encode_file(input_file, output_file, threads=None, segment=None, profile=None, crop=None):
+    """Run HandBrakeCLI; segment is an optional (start, length) in seconds, profile one from get_encode_profile
+    and crop an optional (top, bottom, left, right) that replaces the preset's auto crop.
+
+    Returns {'wall_seconds', 'avg_fps', 'profile'} for the whole encode.
+    """
+    handbrake_command = [
+        'HandBrakeCLI',
+        '--preset-import-gui', profile['path'] if profile else HANDBRAKE_PRESET,
+        '--json',
+        '-i', input_file,
+        '-o', output_file
+    ]
+    if threads:
+        handbrake_command += ['--encopts', get_thread_options(threads)]
+    if segment:
+        start, length = segment
+        handbrake_command += ['--start-at', f"seconds:{start:g}", '--stop-at', f"seconds:{length:g}"]
+    if crop is not None:
+        handbrake_command += ['--crop', ':'.join(str(edge) for edge in crop)]
+
+    logging.info(f"Running the following command {handbrake_command}")
+    process = subprocess.Popen(handbrake_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+    stderr_thread = threading.Thread(target=_drain_stream, args=(process.stderr, stderr_tail), daemon=True)
+    stderr_thread.start()
+
+    name = os.path.basename(output_file)
+    progress = {'percent': 0.0, 'fps': 0.0, 'avg_fps': 0.0, 'eta_seconds': None, 'elapsed': 0}
+    start_time = time.monotonic()
+    last_logged = start_time
+    try:
+        for label, data in read_handbrake_json(process.stdout):
+            if label != 'Progress' or data.get('State') != 'WORKING':
+                continue
+            now = time.monotonic()
+            update_encode_progress(progress, data.get('Working', {}), now - start_time)
+            if now - last_logged >= PROGRESS_LOG_INTERVAL:
+                last_logged = now
+                eta = progress['eta_seconds']
+                logging.info(f"Encoding {name}: {progress['percent']:.1f}% (pass {progress['pass']}/"
+                             f"{progress['pass_count']}) at {progress['fps']:.1f} fps, avg {progress['avg_fps']:.1f} fps, "
+                             f"ETA {eta // 60 if eta is not None else '?'} min")
+        process.wait()
+        stderr_thread.join()
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+    if process.returncode != 0:
+        for line in stderr_tail:
+            logging.error(line)
+        raise subprocess.CalledProcessError(process.returncode, handbrake_command)
+
+    wall_seconds = time.monotonic() - start_time
+    # Every pass processes every frame, so the job's rate combines the per-pass averages harmonically
+    pass_rates = [rate for rate in progress.get('pass_avg_fps', {}).values() if rate]
+    avg_fps = 1 / sum(1 / rate for rate in pass_rates) if pass_rates else None
+    logging.info(f"Encoded {name} in {wall_seconds / 60:.1f} min"
+                 + (f" at {avg_fps:.1f} fps" if avg_fps else ""))
+    return {'wall_seconds': wall_seconds, 'avg_fps': avg_fps, 'profile': profile}
+
+def get_chunk_count(threads):
+    if CHUNK_SEGMENTS:
+        return CHUNK_SEGMENTS
+    return max(1, (threads or os.cpu_count() or 1) // CORES_PER_ENCODE)
+
+def get_remux_audio_args(audio_tracks, preset):
+    # The preset's first audio entry applied to the first track, as HandBrake would with AudioTrackSelectionBehavior 'first'
+    if not audio_tracks:
+        return []
+    settings = (preset.get('AudioList') or [{}])[0]
+    args = ['-map', '1:a:0']
+    if audio_tracks[0].get('format') == 'AAC' and 'copy:aac' in preset.get('AudioCopyMask', []):
+        return args + ['-c:a', 'copy']
+    args += ['-c:a', 'aac', '-b:a', f"{settings.get('AudioBitrate', AUDIO_OUTPUT_BITRATE // 1000)}k"]
+    if settings.get('AudioMixdown') == 'stereo':
+        args += ['-ac', '2']
+    return args
+
+def get_remux_subtitle_args(subtitle_tracks, preset):
+    # Soft subtitles only; presets that burn subtitles in are never chunked (see preset_burns_subtitles)
+    behavior = preset.get('SubtitleTrackSelectionBehavior', 'none')
+    if not subtitle_tracks or behavior == 'none':
+        return [], 0
+    count = 1 if behavior == 'first' else len(subtitle_tracks)
+    args = []
+    for index in range(count):
+        args += ['-map', f'1:s:{index}']
+    return args + ['-c:s', 'mov_text'], count
+
+def preset_burns_subtitles(preset):
+    # Foreign audio search looks for forced subtitles across the whole film; a segment would only search itself
+    return bool(preset.get('SubtitleAddForeignAudioSearch')) or preset.get('SubtitleBurnBehavior', 'none') != 'none'
+
+def detect_crop(input_file, profile=None):
+    """(top, bottom, left, right) HandBrakeCLI's auto crop picks for the whole of input_file."""
+    handbrake_command = ['HandBrakeCLI', '--preset-import-gui', profile['path'] if profile else HANDBRAKE_PRESET,
+                         '--json', '--scan', '-i', input_file]
+    process = subprocess.Popen(handbrake_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    crop = None
+    try:
+        for label, data in read_handbrake_json(process.stdout):
+            if label == 'JSON Title Set' and data.get('TitleList'):
+                crop = data['TitleList'][0].get('Crop')
+        process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+    if process.returncode != 0 or not crop or len(crop) != 4:
+        raise RuntimeError(f"Could not detect the crop of {input_file}")
+    return tuple(int(edge) for edge in crop)
+
+def chunked_encode_file(input_file, output_file, chunk_count, threads=None, profile=None):
+    """Encode the video of input_file as chunk_count keyframe-aligned segments in parallel HandBrakeCLI runs.
+
+    The encoded segments are concatenated without re-encoding and the audio and subtitles are muxed in once.
+    Returns the same stats as encode_file; raises when the segments differ in picture size or the result's
+    duration or stream count is off.
+    """
+    audio_tracks, subtitle_tracks, video_info = get_file_metadata(input_file)
+    duration = video_info.get('duration')
+    if not duration:
+        raise ValueError(f"Unknown duration of {input_file}")
+    # Auto crop on each segment could pick a different crop per segment, which the stream copy concat can't join
+    crop = detect_crop(input_file, profile)
+    chunk_dir = os.path.join(os.path.dirname(output_file), 'chunks')
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    os.makedirs(chunk_dir)
+    start_time = time.monotonic()
+    try:
+        # A stream copy can only cut at keyframes, so each segment starts at the first one after its split time
+        split_times = ','.join(f"{duration * i / chunk_count:.3f}" for i in range(1, chunk_count))
+        if not _run_ffmpeg(['-i', input_file, '-map', '0:v:0', '-c', 'copy', '-f', 'segment',
+                            '-segment_times', split_times, '-reset_timestamps', '1',
+                            os.path.join(chunk_dir, 'source-%03d.mkv')]):
+            raise RuntimeError(f"Could not split {input_file} into segments")
+        sources = sorted(os.path.join(chunk_dir, name) for name in os.listdir(chunk_dir) if name.startswith('source-'))
+        logging.info(f"Encoding {os.path.basename(input_file)} as {len(sources)} segments in parallel")
+
+        chunk_threads = max(1, (threads or os.cpu_count() or 1) // len(sources))
+        results = [None] * len(sources)
+        errors = []
+
+        def encode_chunk(index, source):
+            try:
+                results[index] = encode_file(source, os.path.join(chunk_dir, f"encoded-{index:03d}.mp4"),
+                                             chunk_threads, profile=profile, crop=crop)
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=encode_chunk, args=(index, source), daemon=True)
+                   for index, source in enumerate(sources)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+
+        encoded = [os.path.join(chunk_dir, f"encoded-{index:03d}.mp4") for index in range(len(sources))]
+        sizes = {(info.get('width'), info.get('height')) for info in (get_file_metadata(path)[2] for path in encoded)}
+        if len(sizes) != 1 or None in next(iter(sizes)):
+            raise RuntimeError(f"Segments of {input_file} differ in picture size: "
+                               + ', '.join(f"{width}x{height}" for width, height in sizes))
+
+        list_file = os.path.join(chunk_dir, 'segments.txt')
+        with open(list_file, 'w') as f:
+            for path in encoded:
+                path = path.replace("'", "'\\''")
+                f.write(f"file '{path}'\n")
+        video_file = os.path.join(chunk_dir, 'video.mp4')
+        if not _run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', video_file]):
+            raise RuntimeError(f"Could not concatenate the segments of {input_file}")
+
+        preset = profile['preset'] if profile else load_handbrake_preset()
+        subtitle_args, subtitle_count = get_remux_subtitle_args(subtitle_tracks, preset)
+        if not _run_ffmpeg(['-i', video_file, '-i', input_file, '-map', '0:v:0', '-c:v', 'copy']
+                           + get_remux_audio_args(audio_tracks, preset) + subtitle_args
+                           + ['-map_metadata', '1', '-map_chapters', '1', '-movflags', '+faststart', '-f', 'mp4', output_file]):
+            raise RuntimeError(f"Could not mux audio and subtitles into {output_file}")
+
+        new_audio_tracks, new_subtitle_tracks, new_video_info = get_file_metadata(output_file)
+        expected_streams = 1 + min(len(audio_tracks), 1) + subtitle_count
+        streams = int(bool(new_video_info)) + len(new_audio_tracks) + len(new_subtitle_tracks)
+        new_duration = new_video_info.get('duration') or 0
+        if streams != expected_streams or abs(new_duration - duration) > CHUNK_DURATION_TOLERANCE:
+            raise RuntimeError(f"Chunked encode of {input_file} has {streams} streams and {new_duration:.1f}s, "
+                               f"expected {expected_streams} streams and {duration:.1f}s")
+    except Exception:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    wall_seconds = time.monotonic() - start_time
+    # Frames encoded by all segments over the wall-clock time of the whole job
+    frames = sum(result['avg_fps'] * result['wall_seconds'] for result in results if result['avg_fps'])
+    avg_fps = frames / wall_seconds if frames else None
+    logging.info(f"Encoded {os.path.basename(output_file)} from {len(sources)} segments in {wall_seconds / 60:.1f} min")
+    return {'wall_seconds': wall_seconds, 'avg_fps': avg_fps, 'profile': profile}
+
+def record_encode_history(db_conn, file_path, original_size, compressed_size, stats, threads=None):
+    # Video properties are copied from the media_files row as it was before the encode
+    profile = stats.get('profile') or {'name': load_handbrake_preset().get('PresetName'), 'hash': get_preset_hash()}
+    db_conn.execute("""INSERT INTO compress_history
+                       (file_path, content_type, video_codec, video_width, duration, frame_rate,
+                        original_size, compressed_size, encode_seconds, threads, completed_at,
+                        avg_fps, preset_name, preset_hash, host)
+                       SELECT file_path, content_type, video_codec, video_width, duration, frame_rate,
+                              ?, ?, ?, ?, ?, ?, ?, ?, ?
+                       FROM media_files WHERE file_path = ?""",
+                    (original_size, compressed_size, stats['wall_seconds'], threads, int(time.time()),
+                     stats['avg_fps'], profile['name'], profile['hash'],
+                     socket.gethostname(), file_path))
+    db_conn.commit()
+
+@timed_phase('compress.encode')
+def encode_phase(file_path, input_file, output_file, threads=None, state_conn=None):
+    input_size = os.path.getsize(input_file)
+    profile = get_file_encode_profile(state_conn, file_path)
+    chunk_count = get_chunk_count(threads)
+    stats = None
+    chunked = input_size >= CHUNKED_ENCODE_MIN_BYTES and chunk_count > 1
+    if chunked and preset_burns_subtitles(profile['preset'] if profile else load_handbrake_preset()):
+        logging.info(f"Encoding {os.path.basename(input_file)} in one run: the preset burns in subtitles")
+        chunked = False
+    if chunked:
+        try:
+            stats = chunked_encode_file(input_file, output_file, chunk_count, threads, profile)
+        except Exception as e:
+            logging.warning(f"Chunked encode of {os.path.basename(input_file)} failed, encoding it in one run: {e}")
+    if stats is None:
+        stats = encode_file(input_file, output_file, threads, profile=profile)
+
+    # Remove the input_file
+    os.remove(input_file)
+
+    # Rename .mp42 back to .mp4 if necessary
+    if output_file.endswith('.mp42'):
+        final_output_file = output_file.replace('.mp42', '.mp4')
+        os.rename(output_file, final_output_file)
+        output_file = final_output_file
+
+    record_phase(state_conn, file_path, 'encoded', output_file, file_checksum(output_file) if state_conn else None)
+    if state_conn is not None:
+        record_encode_history(state_conn, file_path, input_size, os.path.getsize(output_file), stats, threads)
+    return output_file
+
+@timed_phase('compress.upload')
+def upload_phase(file_path, output_file, state_conn=None):
+    # Copy the output file to the original file directory
+    logging.info(f"Compression of {os.path.basename(file_path)} completed, copying {output_file} to original directory")
+    new_file_path = get_upload_path(file_path, output_file)
+    partial_file_path = new_file_path + '.partial'
+    storage = get_storage()
+    storage.ensure_available()
+    checksum = storage.copy(output_file, partial_file_path, bandwidth=('write', 'copy'), read_back=True)
+    metrics.increment('compress.bytes_out', os.path.getsize(output_file))
+    if checksum is not None and state_conn is not None:
+        # The bytes read for the upload must match what the encode phase recorded
+        row = state_conn.execute("SELECT checksum FROM compress_state WHERE file_path = ? AND phase = 'encoded'",
+                                 (file_path,)).fetchone()
+        if row is not None and row[0] and row[0] != checksum:
+            storage.remove(partial_file_path)
+            raise Exception(f"Staged output {output_file} changed since it was encoded")
+    # Renaming into place means an interrupted upload never leaves a truncated file under the real name
+    storage.replace(partial_file_path, new_file_path)
+    if state_conn is not None:
+        record_phase(state_conn, file_path, 'uploaded', new_file_path, checksum or file_checksum(output_file))
+
+    # Remove the output file
+    logging.info(f"Unlinking {output_file}")
+    os.remove(output_file)
+    return new_file_path
+
+@timed_phase('compress.remove_original')
+def remove_original_phase(file_path, new_file_path, state_conn=None):
+    # Remove the original file (unless the upload just replaced it in place)
+    if new_file_path != file_path:
+        logging.info(f"Unlinking {file_path}")
+        storage = get_storage()
+        storage.ensure_available()
+        try:
+            storage.remove(file_path)
+        except FileNotFoundError:
+            pass
+    record_phase(state_conn, file_path, 'original_removed', new_file_path)
+
+def stage_out(file_path, output_file, state_conn=None):
+    new_file_path = upload_phase(file_path, output_file, state_conn)
+    remove_original_phase(file_path, new_file_path, state_conn)
+    return new_file_path
+
+@timed_phase('compress.db_update')
+def record_compressed_file(file_path, new_file_path, db_conn):
+    # Update the database with new file size and metadata
+    new_file_size = get_storage().getsize(new_file_path)
+    new_audio_tracks, new_subtitle_tracks, new_video_info = get_file_metadata_cached(new_file_path, db_conn, new_file_size)
+
+    cursor = db_conn.cursor()
+    # A scan between the upload and this update may already have a row for the new file. The original's row
+    # (with its review state) wins; if a scan removed that row instead, the upload's row becomes the record
+    target_path = file_path
+    if new_file_path != file_path:
+        if cursor.execute("SELECT 1 FROM media_files WHERE file_path = ?", (file_path,)).fetchone() is not None:
+            remove_media_file(cursor, new_file_path)
+        else:
+            target_path = new_file_path
+    cursor.execute("""
+        UPDATE media_files 
+        SET file_path = ?, file_size = ?, last_modified = ?, 
+            audio_metadata = ?, subtitle_metadata = ?, needs_compression = 0, has_english_audio = ?,
+            claimed_by = NULL, claimed_at = NULL,
+            video_codec = ?, video_width = ?, video_height = ?, frame_rate = ?, duration = ?, bit_rate = ?,
+            estimated_ratio = NULL, estimate_source = NULL, fingerprint = NULL
+        WHERE file_path = ?
+    """, (new_file_path, new_file_size, int(time.time()), 
+          json.dumps(new_audio_tracks), json.dumps(new_subtitle_tracks),
+          has_english_audio(new_audio_tracks)) + get_video_columns(new_video_info) + (target_path,))
+    delete_track_rows(cursor, target_path)
+    write_track_rows(cursor, new_file_path, new_audio_tracks, new_subtitle_tracks)
+    _write_phase(cursor, file_path, 'db_updated', new_file_path, None)
+    db_conn.commit()
+
+def cleanup_staging(job_dir):
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+def compress_file(file_path, db_conn):
+    job_dir, input_file, output_file = get_staging_paths(file_path)
+    phase = None
+    try:
+        # Pick up after the last completed phase of an interrupted run
+        phase, artifact = load_resume_point(db_conn, file_path)
+        if phase is None:
+            logging.info(f"Beginning to compress {os.path.basename(file_path)}")
+            stage_in(file_path, input_file, db_conn)
+            phase, artifact = 'copied_in', input_file
+        else:
+            logging.info(f"Resuming compression of {os.path.basename(file_path)} after phase {phase}")
+
+        if phase == 'copied_in':
+            artifact = encode_phase(file_path, input_file, output_file, state_conn=db_conn)
+            phase = 'encoded'
+        if phase == 'encoded':
+            artifact = upload_phase(file_path, artifact, db_conn)
+            phase = 'uploaded'
+        if phase == 'uploaded':
+            remove_original_phase(file_path, artifact, db_conn)
+            phase = 'original_removed'
+        record_compressed_file(file_path, artifact, db_conn)
+        cleanup_staging(job_dir)
+
+        logging.info(f"Successfully compressed and updated database for {file_path}")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to compress file {file_path}: {e}")
+        # Encoded output is kept for the next run; anything earlier is cheaper to redo than to trust
+        if phase in (None, 'copied_in'):
+            discard_compress_state(db_conn, file_path)
+        return False
+
+def get_unfinished_compressions(db_conn):
+    cursor = db_conn.cursor()
+    cursor.execute("""SELECT file_path FROM compress_state
+                      WHERE phase != 'db_updated' AND (host = ? OR phase IN ('uploaded', 'original_removed'))
+                      ORDER BY updated_at""", (socket.gethostname(),))
+    return [file_path for (file_path,) in cursor.fetchall()]
+
+def cleanup_orphaned_staging(db_conn):
+    # Staging directories are named after the file they belong to; anything untracked and idle is left over
+    tracked = {os.path.basename(get_staging_paths(file_path)[0]) for file_path in get_unfinished_compressions(db_conn)}
+    if not os.path.isdir(DESTINATION_DIR):
+        return
+    cutoff = time.time() - ORPHAN_MIN_AGE
+    for entry in os.scandir(DESTINATION_DIR):
+        if not entry.is_dir(follow_symlinks=False) or entry.name in tracked or len(entry.name) != 12:
+            continue
+        try:
+            newest = max([entry.stat().st_mtime] + [child.stat().st_mtime for child in os.scandir(entry.path)])
+        except OSError:
+            continue
+        if newest < cutoff:
+            logging.info(f"Removing orphaned staging directory {entry.path}")
+            cleanup_staging(entry.path)
+
+def finish_rescanned_upload(db_conn, file_path):
+    """Complete an uploaded compression whose original's row a scan has since removed; returns whether it did.
+
+    Nothing can claim a row that is gone, and only the database update is left to do.
+    """
+    row = db_conn.execute("SELECT phase, artifact_path FROM compress_state WHERE file_path = ?", (file_path,)).fetchone()
+    if row is None or row[0] not in ('uploaded', 'original_removed'):
+        return False
+    phase, artifact_path = row
+    if db_conn.execute("SELECT 1 FROM media_files WHERE file_path = ?", (file_path,)).fetchone() is not None:
+        return False
+    storage = get_storage()
+    storage.ensure_available()
+    if not storage.exists(artifact_path):
+        return False
+    logging.info(f"Finishing compression of {file_path}: a scan already replaced its row with {artifact_path}")
+    if phase == 'uploaded':
+        remove_original_phase(file_path, artifact_path, db_conn)
+    record_compressed_file(file_path, artifact_path, db_conn)
+    db_conn.execute("""UPDATE compress_jobs SET status = 'done', lease_expires = NULL, last_error = NULL, updated_at = ?
+                       WHERE file_path = ?""", (int(time.time()), file_path))
+    db_conn.commit()
+    cleanup_staging(get_staging_paths(file_path)[0])
+    return True
+
+def resume_unfinished_compressions(job_source, db_conn):
+    for file_path in get_unfinished_compressions(db_conn):
+        if finish_rescanned_upload(db_conn, file_path):
+            continue
+        if not job_source.reclaim(db_conn, file_path):
+            logging.info(f"Not resuming {file_path}: claimed by another job")
+            continue
+        logging.info(f"Resuming unfinished compression of {file_path}")
+        succeeded = compress_file(file_path, db_conn)
+        job_source.finish(db_conn, file_path, None if succeeded else Exception("resume failed"))
+    cleanup_orphaned_staging(db_conn)
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_file(db_conn, file_path, worker_id):
+    # Atomic test-and-set; an abandoned claim can be taken over after CLAIM_TIMEOUT
+    now = int(time.time())
+    cursor = db_conn.cursor()
+    cursor.execute("""UPDATE media_files SET claimed_by = ?, claimed_at = ?
+                      WHERE file_path = ? AND (needs_compression IS NULL OR needs_compression = 1)
+                        AND (claimed_by IS NULL OR claimed_by = ? OR claimed_at < ?)""",
+                   (worker_id, now, file_path, worker_id, now - CLAIM_TIMEOUT))
+    db_conn.commit()
+    return cursor.rowcount == 1
+
+def release_claim(db_conn, file_path, worker_id):
+    db_conn.execute("UPDATE media_files SET claimed_by = NULL, claimed_at = NULL WHERE file_path = ? AND claimed_by = ?",
+                    (file_path, worker_id))
+    db_conn.commit()
+
+def enqueue_compress_jobs(db_conn, file_type, size_threshold):
+    now = int(time.time())
+    cursor = db_conn.cursor()
+    cursor.execute(f"""
+        SELECT {PLANNER_COLUMNS}
+        FROM media_files
         WHERE content_type = ? AND file_size > ? AND (needs_compression IS NULL OR needs_compression = 1)
-        ORDER BY file_size DESC
+    """, (file_type, size_threshold))
+    plan = plan_compression(db_conn, cursor.fetchall())
+    # Jobs still waiting are re-prioritised with the latest measurements
+    cursor.executemany("""
+        INSERT INTO compress_jobs (file_path, content_type, file_size, status, attempts, enqueued_at, updated_at, priority)
+        VALUES (?, ?, ?, 'queued', 0, ?, ?, ?)
+        ON CONFLICT(file_path) DO UPDATE SET priority = excluded.priority WHERE status = 'queued'
+    """, [(file_path, file_type, file_size, now, now, get_plan_score(encode_seconds, saved_bytes))
+          for file_path, file_size, encode_seconds, saved_bytes in plan])
+    db_conn.commit()
+    logging.info(f"Queued {len(plan)} {file_type} files for compression")
+    return len(plan)
+
+def lease_next_job(db_conn, worker_id, file_path=None):
+    # With file_path, leases that job only if it is free (used when resuming an interrupted compression)
+    now = int(time.time())
+    cursor = db_conn.cursor()
+    db_conn.commit()
+    # BEGIN IMMEDIATE takes the write lock up front so two workers can't select the same row
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("""UPDATE compress_jobs SET status = 'failed', worker_id = NULL, last_error = 'lease expired',
+                                                   updated_at = ?
+                          WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?""",
+                       (now, now, MAX_JOB_ATTEMPTS))
+        if file_path is None:
+            cursor.execute("""SELECT file_path FROM compress_jobs
+                              WHERE (status = 'queued' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ?
+                              ORDER BY priority DESC, file_size DESC
+                              LIMIT 1""", (now, MAX_JOB_ATTEMPTS))
+        else:
+            cursor.execute("""SELECT file_path FROM compress_jobs
+                              WHERE file_path = ? AND (status IN ('queued', 'failed')
+                                                       OR worker_id = ? OR lease_expires < ?)""",
+                           (file_path, worker_id, now))
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute("""UPDATE compress_jobs
+                              SET status = 'leased', worker_id = ?, heartbeat = ?, lease_expires = ?,
+                                  attempts = attempts + 1, updated_at = ?
+                              WHERE file_path = ?""", (worker_id, now, now + LEASE_DURATION, now, row[0]))
+            cursor.execute("UPDATE media_files SET claimed_by = ?, claimed_at = ? WHERE file_path = ?",
+                           (worker_id, now, row[0]))
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+    return row[0] if row else None
+
+def renew_leases(db_conn, worker_id, file_paths=None):
+    """Extend this worker's leases; returns the file paths it still holds."""
+    now = int(time.time())
+    cursor = db_conn.cursor()
+    cursor.execute("""UPDATE compress_jobs SET heartbeat = ?, lease_expires = ?
+                      WHERE worker_id = ? AND status = 'leased'""", (now, now + LEASE_DURATION, worker_id))
+    cursor.execute("UPDATE media_files SET claimed_at = ? WHERE claimed_by = ?", (now, worker_id))
+    db_conn.commit()
+    cursor.execute("SELECT file_path FROM compress_jobs WHERE worker_id = ? AND status = 'leased'", (worker_id,))
+    return {file_path for (file_path,) in cursor.fetchall()}
+
+def complete_job(db_conn, file_path, worker_id):
+    db_conn.execute("""UPDATE compress_jobs SET status = 'done', lease_expires = NULL, last_error = NULL, updated_at = ?
+                       WHERE file_path = ? AND worker_id = ?""", (int(time.time()), file_path, worker_id))
+    db_conn.commit()
+
+def fail_job(db_conn, file_path, worker_id, error):
+    db_conn.execute("""UPDATE compress_jobs
+                       SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                           worker_id = NULL, lease_expires = NULL, last_error = ?, updated_at = ?
+                       WHERE file_path = ? AND worker_id = ?""",
+                    (MAX_JOB_ATTEMPTS, str(error), int(time.time()), file_path, worker_id))
+    db_conn.commit()
+    release_claim(db_conn, file_path, worker_id)
+
+def return_job(db_conn, file_path, worker_id):
+    # Hands back a lease that was never worked on, without spending one of the job's attempts
+    db_conn.execute("""UPDATE compress_jobs
+                       SET status = 'queued', attempts = MAX(attempts - 1, 0), worker_id = NULL, lease_expires = NULL,
+                           updated_at = ?
+                       WHERE file_path = ? AND worker_id = ? AND status = 'leased'""",
+                    (int(time.time()), file_path, worker_id))
+    db_conn.commit()
+    release_claim(db_conn, file_path, worker_id)
+
+class ClaimedFileList:
+    """Compress job source over a fixed list of files, each claimed in media_files just before it is staged."""
+
+    def __init__(self, file_paths, worker_id, deadline=None):
+        self.file_paths = file_paths
+        self.worker_id = worker_id
+        self.deadline = deadline
+        self.position = 0
+
+    def start(self, db_path):
+        pass
+
+    def stop(self):
+        pass
+
+    def next_job(self, conn):
+        if self.deadline is not None and time.time() >= self.deadline and self.position < len(self.file_paths):
+            logging.info(f"Compress window closed; leaving {len(self.file_paths) - self.position} planned files")
+            self.position = len(self.file_paths)
+        while self.position < len(self.file_paths):
+            file_path = self.file_paths[self.position]
+            self.position += 1
+            if conn is None or claim_file(conn, file_path, self.worker_id):
+                return file_path
+            logging.info(f"Skipping {file_path}: already compressed or claimed by another job")
+        return None
+
+    def reclaim(self, conn, file_path):
+        return claim_file(conn, file_path, self.worker_id)
+
+    def confirm(self, file_path):
+        return True
+
+    def finish(self, db_conn, file_path, error):
+        if error is not None:
+            release_claim(db_conn, file_path, self.worker_id)
+
+    def release(self, db_conn, file_path):
+        release_claim(db_conn, file_path, self.worker_id)
+
+class LeaseQueue:
+    """Compress job source backed by compress_jobs leases, so workers on any host can drain one queue."""
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.db_path = None
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self, db_path):
+        if not db_path:
+            raise ValueError("compress --worker needs a file-backed database")
+        self.db_path = db_path
+        self.thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _heartbeat(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            while not self.stop_event.wait(LEASE_RENEW_INTERVAL):
+                try:
+                    still_held = renew_leases(conn, self.worker_id)
+                except sqlite3.Error as e:
+                    logging.warning(f"Lease heartbeat failed: {e}")
+                    continue
+                with self.lock:
+                    for file_path in self.held - still_held:
+                        logging.error(f"Lost lease on {file_path}; another worker may take it over")
+                    self.held &= still_held
+        finally:
+            conn.close()
+
+    def next_job(self, conn):
+        file_path = lease_next_job(conn, self.worker_id)
+        if file_path is not None:
+            with self.lock:
+                self.held.add(file_path)
+        return file_path
+
+    def reclaim(self, conn, file_path):
+        # Files compressed outside the queue have no job row and can be resumed directly
+        if conn.execute("SELECT 1 FROM compress_jobs WHERE file_path = ?", (file_path,)).fetchone() is None:
+            return claim_file(conn, file_path, self.worker_id)
+        if lease_next_job(conn, self.worker_id, file_path) is None:
+            return False
+        with self.lock:
+            self.held.add(file_path)
+        return True
+
+    def confirm(self, file_path):
+        # Renew synchronously before destructive steps so a stalled worker never overwrites a re-leased file
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            still_held = renew_leases(conn, self.worker_id)
+        finally:
+            conn.close()
+        with self.lock:
+            self.held &= still_held
+            return file_path in self.held
+
+    def finish(self, db_conn, file_path, error):
+        with self.lock:
+            self.held.discard(file_path)
+        if error is None:
+            complete_job(db_conn, file_path, self.worker_id)
+        else:
+            fail_job(db_conn, file_path, self.worker_id, error)
+
+    def release(self, db_conn, file_path):
+        with self.lock:
+            self.held.discard(file_path)
+        return_job(db_conn, file_path, self.worker_id)
+
+PLANNER_COLUMNS = ("file_path, file_size, content_type, video_codec, video_width, duration, frame_rate, "
+                   "estimated_ratio, estimate_source")
+
+def get_width_class(width):
+    return next(min_width for min_width, _ in DEFAULT_ENCODE_FPS if (width or 0) >= min_width)
+
+def load_planner_stats(db_conn):
+    """Return measured encode fps per width class and size ratios per (codec, content type) from compress_history."""
+    frames = {}
+    seconds = {}
+    samples = {}
+    cursor = db_conn.execute("""SELECT video_width, duration, frame_rate, encode_seconds FROM compress_history
+                                WHERE encode_seconds > 0 AND duration > 0""")
+    for width, duration, frame_rate, encode_seconds in cursor:
+        width_class = get_width_class(width)
+        frames[width_class] = frames.get(width_class, 0) + duration * (frame_rate or DEFAULT_FRAME_RATE)
+        seconds[width_class] = seconds.get(width_class, 0) + encode_seconds
+        samples[width_class] = samples.get(width_class, 0) + 1
+    encode_fps = {width_class: frames[width_class] / seconds[width_class]
+                  for width_class in frames if samples[width_class] >= PLANNER_MIN_SAMPLES}
+
+    cursor = db_conn.execute("""SELECT video_codec, content_type, SUM(compressed_size) * 1.0 / SUM(original_size)
+                                FROM compress_history WHERE original_size > 0
+                                GROUP BY video_codec, content_type HAVING COUNT(*) >= ?""", (PLANNER_MIN_SAMPLES,))
+    ratios = {(codec, content_type): ratio for codec, content_type, ratio in cursor}
+    return encode_fps, ratios
+
+def get_plan_score(encode_seconds, saved_bytes):
+    # Bytes reclaimed per encode-hour
+    return saved_bytes * 3600 / max(encode_seconds, 1)
+
+def plan_compression(db_conn, candidates):
+    """Order PLANNER_COLUMNS rows by bytes saved per encode-hour.
+
+    Returns (file_path, file_size, encode_seconds, saved_bytes) tuples, best first.
+    """
+    encode_fps, ratios = load_planner_stats(db_conn)
+    plan = []
+    for (file_path, file_size, content_type, codec, width, duration, frame_rate,
+         estimated_ratio, estimate_source) in candidates:
+        # A trial encode of this file beats history for its codec, which beats the scan-time model
+        if estimate_source == 'trial' and estimated_ratio is not None:
+            ratio = estimated_ratio
+        elif (codec, content_type) in ratios:
+            ratio = ratios[(codec, content_type)]
+        elif estimated_ratio is not None:
+            ratio = estimated_ratio
+        else:
+            ratio = COMPRESSION_RATIO_THRESHOLD
+        if not duration:
+            duration = file_size * 8 / ASSUMED_SOURCE_BIT_RATE
+        width_class = get_width_class(width)
+        fps = encode_fps.get(width_class) or dict(DEFAULT_ENCODE_FPS)[width_class]
+        encode_seconds = duration * (frame_rate or DEFAULT_FRAME_RATE) / fps
+        plan.append((file_path, file_size, encode_seconds, max(0, file_size * (1 - ratio))))
+    plan.sort(key=lambda item: get_plan_score(item[2], item[3]), reverse=True)
+    return plan
+
+def fit_plan_to_budget(plan, budget_seconds, jobs=1):
+    # Greedy by score: skip files that no longer fit and keep filling the window with smaller ones
+    capacity = budget_seconds * jobs
+    fitted = []
+    for item in plan:
+        if item[2] <= capacity:
+            fitted.append(item)
+            capacity -= item[2]
+    return fitted
+
+def get_encode_jobs(value):
+    if value == 'auto':
+        return max(1, (os.cpu_count() or 1) // CORES_PER_ENCODE)
+    jobs = int(value)
+    if jobs < 1:
+        raise ValueError("jobs must be a positive integer")
+    return jobs
+
+def parse_duration(value):
+    """Seconds in a duration such as `8h`, `90m`, `1d` or `3600`."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    value = str(value).strip().lower()
+    multiplier = units.get(value[-1:])
+    seconds = float(value[:-1] if multiplier else value) * (multiplier or 1)
+    if seconds <= 0:
+        raise ValueError("duration must be positive")
+    return seconds
+
+def interleave_by_size(files):
+    # Alternate the largest and smallest remaining files so big movies run alongside short episodes
+    ordered = sorted(files, key=lambda item: item[1], reverse=True)
+    interleaved = []
+    low, high = 0, len(ordered) - 1
+    while low <= high:
+        interleaved.append(ordered[low])
+        if low != high:
+            interleaved.append(ordered[high])
+        low += 1
+        high -= 1
+    return interleaved
+
+class CoreBudget:
+    """Shared pool of CPU threads handed out to concurrent encodes."""
+
+    def __init__(self, total, jobs):
+        self.total = total
+        self.available = total
+        self.jobs = jobs
+        self.share = max(1, total // jobs)
+        self.condition = threading.Condition()
+
+    def acquire(self, file_size):
+        # Large files may take up to two shares when cores are idle; small ones settle for half a share
+        if file_size >= LARGE_FILE_BYTES:
+            minimum, maximum = self.share, self.share * 2
+        else:
+            minimum, maximum = max(1, self.share // 2), self.share
+        minimum = min(minimum, self.total)
+        with self.condition:
+            while self.available < minimum:
+                self.condition.wait()
+            granted = min(maximum, self.available)
+            self.available -= granted
+            return granted
+
+    def release(self, threads):
+        with self.condition:
+            self.available += threads
+            self.condition.notify_all()
+
+class StagingBudget:
+    """Byte budget for DESTINATION_DIR shared by the prefetch, encode and upload stages."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount, stop_event):
+        with self.condition:
+            # A file larger than the whole budget is still allowed through once the stage is empty
+            while self.used and self.used + amount > self.limit:
+                if stop_event.is_set():
+                    return False
+                self.condition.wait(timeout=1)
+            self.used += amount
+            return True
+
+    def release(self, amount):
+        with self.condition:
+            self.used = max(0, self.used - amount)
+            self.condition.notify_all()
+
+def _pipeline_prefetch(job_source, budget, prefetch_slots, encode_queue, done_queue, stop_event, db_path, workers):
+    # Claims go through a separate connection; the caller's connection belongs to the coordinating thread
+    claim_conn = sqlite3.connect(db_path, timeout=30) if db_path else None
+    try:
+        while True:
+            # Wait until the encoder has taken the previously prefetched file
+            while not prefetch_slots.acquire(timeout=1):
+                if stop_event.is_set():
+                    return
+            if stop_event.is_set():
+                return
+            try:
+                file_path = job_source.next_job(claim_conn)
+            except sqlite3.Error as e:
+                logging.error(f"Could not claim the next compress job: {e}")
+                return
+            if file_path is None:
+                return
+            try:
+                file_size = get_storage().getsize(file_path)
+            except OSError as e:
+                prefetch_slots.release()
+                done_queue.put((file_path, None, e))
+                continue
+
+            # Input plus an output of at most the same size live in staging until the encode finishes
+            reserved = file_size * 2
+            if not budget.acquire(reserved, stop_event):
+                # Shutting down before the file was staged; give the claim back rather than wait out its timeout
+                prefetch_slots.release()
+                if claim_conn is not None:
+                    job_source.release(claim_conn, file_path)
+                break
+            job_dir, input_file, output_file = get_staging_paths(file_path)
+            try:
+                logging.info(f"Prefetching {os.path.basename(file_path)}")
+                stage_in(file_path, input_file, claim_conn)
+            except Exception as e:
+                cleanup_staging(job_dir)
+                budget.release(reserved)
+                prefetch_slots.release()
+                done_queue.put((file_path, None, e))
+                continue
+            encode_queue.put((file_path, job_dir, input_file, output_file, file_size, reserved))
+    finally:
+        if claim_conn is not None:
+            claim_conn.close()
+        for _ in range(workers):
+            encode_queue.put(None)
+
+def _pipeline_encode(budget, cores, prefetch_slots, encode_queue, upload_queue, done_queue, upload_lock, state,
+                     db_path):
+    state_conn = sqlite3.connect(db_path, timeout=30) if db_path else None
+    try:
+        while True:
+            job = encode_queue.get()
+            if job is None:
+                return
+            prefetch_slots.release()
+            file_path, job_dir, input_file, output_file, file_size, reserved = job
+            threads = cores.acquire(file_size)
+            try:
+                logging.info(f"Beginning to compress {os.path.basename(file_path)} with {threads} threads")
+                # A single encode keeps HandBrake's own threading defaults
+                output_file = encode_phase(file_path, input_file, output_file,
+                                           threads if cores.jobs > 1 else None, state_conn)
+                output_size = os.path.getsize(output_file)
+            except Exception as e:
+                if state_conn is not None:
+                    discard_compress_state(state_conn, file_path)
+                cleanup_staging(job_dir)
+                budget.release(reserved)
+                done_queue.put((file_path, None, e))
+                continue
+            finally:
+                cores.release(threads)
+
+            # The input is gone; keep only the real output size reserved until the upload completes
+            budget.release(max(0, reserved - output_size))
+            upload_queue.put((file_path, job_dir, output_file, min(output_size, reserved)))
+    finally:
+        if state_conn is not None:
+            state_conn.close()
+        # The last encoder to finish closes the upload queue
+        with upload_lock:
+            state['encoders'] -= 1
+            if state['encoders'] == 0:
+                upload_queue.put(None)
+
+def _pipeline_upload(job_source, budget, upload_queue, done_queue, db_path):
+    state_conn = sqlite3.connect(db_path, timeout=30) if db_path else None
+    try:
+        while True:
+            job = upload_queue.get()
+            if job is None:
+                return
+            file_path, job_dir, output_file, reserved = job
+            try:
+                if not job_source.confirm(file_path):
+                    raise Exception("claim on the file was lost before upload")
+                new_file_path = stage_out(file_path, output_file, state_conn)
+                cleanup_staging(job_dir)
+                done_queue.put((file_path, new_file_path, None))
+            except Exception as e:
+                # With persisted state the encoded output stays staged so the next run resumes the upload
+                if state_conn is None:
+                    cleanup_staging(job_dir)
+                done_queue.put((file_path, None, e))
+            finally:
+                budget.release(reserved)
+    finally:
+        if state_conn is not None:
+            state_conn.close()
+        done_queue.put(None)
+
+def compress_files_pipelined(job_source, db_conn, jobs=ENCODE_JOBS):
+    """Copy in, encode and upload concurrently; this thread applies the database updates.
+
+    `job_source` is a ClaimedFileList or LeaseQueue handing out the files to compress.
     """
-    cursor.execute(query, (file_type, size_threshold))
+    os.makedirs(DESTINATION_DIR, exist_ok=True)
+    limit = min(STAGING_BUDGET_BYTES, int(shutil.disk_usage(DESTINATION_DIR).free * STAGING_FREE_SPACE_RATIO))
+    total_cores = os.cpu_count() or 1
+    logging.info(f"Compress pipeline: {jobs} encode job(s) sharing {total_cores} cores, "
+                 f"staging budget {limit / 1024 ** 3:.1f} GiB")
+
+    db_path = get_db_path(db_conn)
+    job_source.start(db_path)
+    resume_unfinished_compressions(job_source, db_conn)
+    budget = StagingBudget(limit)
+    cores = CoreBudget(total_cores, jobs)
+    prefetch_slots = threading.Semaphore(PREFETCH_DEPTH * jobs)
+    encode_queue = queue.Queue()
+    upload_queue = queue.Queue()
+    done_queue = queue.Queue()
+    stop_event = threading.Event()
+    upload_lock = threading.Lock()
+    state = {'encoders': jobs}
+
+    threads = [
+        threading.Thread(target=_pipeline_prefetch, daemon=True,
+                         args=(job_source, budget, prefetch_slots, encode_queue, done_queue, stop_event,
+                               db_path, jobs)),
+        threading.Thread(target=_pipeline_upload, daemon=True,
+                         args=(job_source, budget, upload_queue, done_queue, db_path)),
+    ]
+    threads += [threading.Thread(target=_pipeline_encode, daemon=True,
+                                 args=(budget, cores, prefetch_slots, encode_queue, upload_queue, done_queue,
+                                       upload_lock, state, db_path))
+                for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+
+    succeeded = 0
+    failed = 0
+    try:
+        while True:
+            item = done_queue.get()
+            if item is None:
+                break
+            file_path, new_file_path, error = item
+            if error is None:
+                try:
+                    record_compressed_file(file_path, new_file_path, db_conn)
+                except Exception as e:
+                    error = e
+            if error is None:
+                logging.info(f"Successfully compressed {file_path}")
+                succeeded += 1
+            else:
+                logging.error(f"Failed to compress {file_path}: {error}")
+                failed += 1
+            metrics.increment('compress.succeeded' if error is None else 'compress.failed')
+            job_source.finish(db_conn, file_path, error)
+            save_metrics_run(db_conn)
+    finally:
+        stop_event.set()
+    for thread in threads:
+        thread.join()
+    job_source.stop()
+    logging.info(f"Compression finished: {succeeded} succeeded, {failed} failed")
+
+def compress_files(file_type, size_threshold, db_conn, jobs=ENCODE_JOBS, budget=None):
+    cursor = db_conn.cursor()
     
-    files_to_compress = cursor.fetchall()
+    # Select files of the specified type that need compression and aren't claimed by a live job
+    query = f"""
+        SELECT {PLANNER_COLUMNS}
+        FROM media_files 
+        WHERE content_type = ? AND file_size > ? AND (needs_compression IS NULL OR needs_compression = 1)
+          AND (claimed_by IS NULL OR claimed_at < ?)
+    """
+    cursor.execute(query, (file_type, size_threshold, int(time.time()) - CLAIM_TIMEOUT))
     
-    for (file_path,) in files_to_compress:
-        if compress_file(file_path, db_conn):
-            logging.info(f"Successfully compressed {file_path}")
+    plan = plan_compression(db_conn, cursor.fetchall())
+    deadline = None
+    if budget is not None:
+        plan = fit_plan_to_budget(plan, budget, jobs)
+        deadline = time.time() + budget
+    logging.info(f"Planned {len(plan)} files: {sum(item[2] for item in plan) / 3600:.1f} encode-hours, "
+                 f"{sum(item[3] for item in plan) / 1024 ** 3:.1f} GiB expected savings")
+    files_to_compress = [(file_path, file_size) for file_path, file_size, _, _ in plan]
+    if jobs > 1:
+        # Pair big and small files among neighbours in the plan without giving up its order
+        window = 2 * jobs
+        files_to_compress = [item for start in range(0, len(files_to_compress), window)
+                             for item in interleave_by_size(files_to_compress[start:start + window])]
+    job_source = ClaimedFileList([file_path for file_path, _ in files_to_compress], get_worker_id(), deadline)
+    compress_files_pipelined(job_source, db_conn, jobs)
+
+def run_compress_worker(db_conn, jobs=ENCODE_JOBS, file_type=None, size_threshold=None):
+    if file_type is not None:
+        enqueue_compress_jobs(db_conn, file_type, size_threshold)
+    worker_id = get_worker_id()
+    logging.info(f"Compress worker {worker_id} draining the job queue")
+    compress_files_pipelined(LeaseQueue(worker_id), db_conn, jobs)
+
+def trial_compression_ratio(file_path, duration, file_size, profile=None):
+    """Encode TRIAL_SEGMENTS evenly spaced segments with profile and return their output/input size ratio, or None."""
+    if not duration or duration < TRIAL_SEGMENTS * TRIAL_SEGMENT_SECONDS * 2:
+        return None
+    job_dir = get_staging_paths(file_path)[0]
+    os.makedirs(job_dir, exist_ok=True)
+    try:
+        encoded_bytes = 0
+        for i in range(TRIAL_SEGMENTS):
+            start = duration * (i + 1) / (TRIAL_SEGMENTS + 1) - TRIAL_SEGMENT_SECONDS / 2
+            output_file = os.path.join(job_dir, f"trial-{i}.mp4")
+            encode_file(file_path, output_file, segment=(start, TRIAL_SEGMENT_SECONDS), profile=profile)
+            encoded_bytes += os.path.getsize(output_file)
+        source_bytes = file_size * TRIAL_SEGMENTS * TRIAL_SEGMENT_SECONDS / duration
+        return round(min(encoded_bytes / source_bytes, 1.0), 3)
+    finally:
+        cleanup_staging(job_dir)
+
+def store_estimate(cursor, file_path, ratio, source):
+    cursor.execute("""UPDATE media_files SET estimated_ratio = ?, estimate_source = ?, needs_compression = ?
+                      WHERE file_path = ?""",
+                   (ratio, source if ratio is not None else None, needs_compression_for(ratio), file_path))
+
+def estimate_files(file_type, size_threshold, db_conn, trial=False):
+    # Candidates are the files compress would pick; rows already produced by compress have no estimate source
+    cursor = db_conn.cursor()
+    cursor.execute(f"""
+        SELECT file_path, file_size, estimate_source, {', '.join(name for name, _ in VIDEO_COLUMNS)}
+        FROM media_files
+        WHERE content_type = ? AND file_size > ?
+          AND (needs_compression IS NULL OR needs_compression = 1 OR estimate_source IS NOT NULL)
+        ORDER BY file_size DESC
+    """, (file_type, size_threshold))
+    files_to_estimate = cursor.fetchall()
+    worker_id = get_worker_id()
+    estimated = 0
+    skipped = 0
+
+    for file_path, file_size, estimate_source, *video_columns in files_to_estimate:
+        if trial and estimate_source == 'trial':
+            continue
+        try:
+            video_info = dict(zip(VIDEO_INFO_KEYS, video_columns))
+            if video_info['duration'] is None:
+                # Scanned before video properties were recorded
+                video_info = get_file_metadata_cached(file_path, db_conn, file_size)[2]
+                cursor.execute(f"""UPDATE media_files SET {', '.join(f'{name} = ?' for name, _ in VIDEO_COLUMNS)}
+                                   WHERE file_path = ?""", get_video_columns(video_info) + (file_path,))
+            ratio = estimate_compression_ratio(video_info, file_size)
+            source = 'model'
+            store_estimate(cursor, file_path, ratio, source)
+            db_conn.commit()
+            if ratio is None:
+                logging.warning(f"Could not estimate {file_path}: duration unknown")
+                continue
+            if trial and needs_compression_for(ratio) != 0:
+                # Only files the model would compress are worth a trial encode
+                if not claim_file(db_conn, file_path, worker_id):
+                    logging.info(f"Skipping trial of {file_path}: claimed by a compress job")
+                    continue
+                try:
+                    profile = get_encode_profile(file_type, video_info['width'], video_info['frame_rate'])
+                    trial_ratio = trial_compression_ratio(file_path, video_info['duration'], file_size, profile)
+                finally:
+                    release_claim(db_conn, file_path, worker_id)
+                if trial_ratio is not None:
+                    ratio, source = trial_ratio, 'trial'
+                    store_estimate(cursor, file_path, ratio, source)
+                    db_conn.commit()
+            logging.info(f"Estimated {file_path} at {ratio} of its size ({source})")
+            estimated += 1
+            if needs_compression_for(ratio) == 0:
+                skipped += 1
+        except Exception as e:
+            db_conn.rollback()
+            logging.error(f"Error estimating {file_path}: {str(e)}")
+
+    logging.info(f"Estimated {estimated} {file_type} files; {skipped} are below the expected savings threshold")
+
+def backfill_fingerprints(db_conn):
+    """Fingerprint rows scanned before the dedupe index existed or changed since; reads three blocks per file."""
+    cursor = db_conn.cursor()
+    last_path = ''
+    updated = 0
+    while True:
+        rows = cursor.execute("""SELECT file_path, file_size FROM media_files
+                                 WHERE (fingerprint IS NULL OR fingerprint NOT LIKE file_size || ':%') AND file_path > ?
+                                 ORDER BY file_path LIMIT 100""", (last_path,)).fetchall()
+        if not rows:
+            break
+        for file_path, file_size in rows:
+            try:
+                file_size = get_storage().getsize(file_path)
+                cursor.execute("UPDATE media_files SET fingerprint = ? WHERE file_path = ?",
+                               (compute_fingerprint(file_path, file_size), file_path))
+                updated += 1
+            except OSError as e:
+                logging.warning(f"Could not fingerprint {file_path}: {e}")
+            last_path = file_path
+        db_conn.commit()
+    if updated:
+        logging.info(f"Fingerprinted {updated} files for the dedupe index")
+
+DEDUPE_COLUMNS = ("file_path, file_size, fingerprint, content_type, video_codec, video_width, duration, "
+                  "has_english_audio, audio_metadata, subtitle_metadata")
+
+def normalize_title(file_path):
+    """Title part of a file name: `Movie.Name.2010.1080p.BluRay.mkv` and `Movie Name (2010).mkv` give `movie name 2010`."""
+    name = os.path.splitext(os.path.basename(file_path))[0].lower()
+    name = re.sub(r'\[[^\]]*\]', ' ', name)  # [group] and [hash] tags
+    name = re.sub(r'[\W_]+', ' ', name)
+    return RELEASE_TAG_PATTERN.sub('', name).strip()
+
+def is_similar_copy(row, anchor):
+    # Same content type and running time alone would pair up a season's episodes, which often share a length
+    smaller, larger = sorted((row[1], anchor[1]))
+    if row[6] - anchor[6] > DEDUPE_DURATION_TOLERANCE or larger > smaller * DEDUPE_SIZE_RATIO:
+        return False
+    if normalize_title(row[0]) == normalize_title(anchor[0]):
+        return True
+    # Movies usually get a directory each; a TV season directory holds many different episodes
+    return row[3] == 'movie' and os.path.dirname(row[0]) == os.path.dirname(anchor[0])
+
+def find_duplicate_groups(db_conn, similar=False):
+    """Lists of DEDUPE_COLUMNS rows that are the same content: identical fingerprints, plus with similar=True
+    files of one content type whose running times are within DEDUPE_DURATION_TOLERANCE, whose sizes are within
+    DEDUPE_SIZE_RATIO and that share a normalized title (or, for movies, a directory)."""
+    # Rows held by a running compress job are left alone
+    busy = f"(claimed_by IS NULL OR claimed_at < {int(time.time()) - CLAIM_TIMEOUT})"
+    cursor = db_conn.cursor()
+    groups = []
+    grouped = set()
+    fingerprints = cursor.execute(f"""SELECT fingerprint FROM media_files WHERE fingerprint IS NOT NULL AND {busy}
+                                      GROUP BY fingerprint HAVING COUNT(*) > 1""").fetchall()
+    for (fingerprint,) in fingerprints:
+        rows = cursor.execute(f"SELECT {DEDUPE_COLUMNS} FROM media_files WHERE fingerprint = ? AND {busy}",
+                              (fingerprint,)).fetchall()
+        groups.append(('identical', rows))
+        grouped.update(row[0] for row in rows)
+
+    if similar:
+        # Each group is anchored on its shortest file; groups close once the running time moves past the tolerance
+        open_groups = []
+        for row in cursor.execute(f"""SELECT {DEDUPE_COLUMNS} FROM media_files WHERE duration IS NOT NULL AND {busy}
+                                      ORDER BY content_type, duration"""):
+            open_groups = [rows for rows in open_groups
+                           if rows[0][3] == row[3] and row[6] - rows[0][6] <= DEDUPE_DURATION_TOLERANCE]
+            rows = next((rows for rows in open_groups if is_similar_copy(row, rows[0])), None)
+            if rows is None:
+                rows = []
+                open_groups.append(rows)
+            rows.append(row)
+            if len(rows) == 2:
+                groups.append(('similar', rows))
+        # Groups made up only of identical copies were reported above
+        groups = [(kind, rows) for kind, rows in groups
+                  if kind == 'identical' or len({row[2] for row in rows}) > 1 or not grouped.issuperset(row[0] for row in rows)]
+    return groups
+
+def rank_duplicates(rows):
+    """Best copy first: higher resolution, English audio, more tracks, then the smaller file."""
+    def quality(row):
+        file_path, file_size, _, _, _, width, _, english, audio_metadata, subtitle_metadata = row
+        tracks = len(_load_tracks(audio_metadata)) + len(_load_tracks(subtitle_metadata))
+        return (-(width or 0), -(english or 0), -tracks, file_size, file_path)
+    return sorted(rows, key=quality)
+
+def ask_delete_choice(prompt):
+    while True:
+        choice = input(prompt).lower()
+        if choice in ['y', 'n', 'q']:
+            return choice
+        print("Invalid input. Please enter 'y', 'n' or 'q'.")
+
+def dedupe_files(db_conn, similar=False):
+    backfill_fingerprints(db_conn)
+    groups = find_duplicate_groups(db_conn, similar)
+    logging.info(f"Found {len(groups)} groups of duplicates")
+    reclaimed = 0
+    deleted = set()
+
+    for kind, rows in groups:
+        # A file can sit in an identical and a similar group; don't offer it again once deleted
+        rows = [row for row in rows if row[0] not in deleted]
+        if len(rows) < 2:
+            continue
+        ranked = rank_duplicates(rows)
+        print(f"\n{kind.capitalize()} copies:")
+        for i, (file_path, file_size, _, _, codec, width, duration, _, _, _) in enumerate(ranked):
+            print(f"  {'keep  ' if i == 0 else 'delete'} {file_path} ({file_size / 1024 ** 3:.2f} GB, "
+                  f"{codec or 'unknown codec'}, {width or '?'} px, {duration or 0:.0f} s)")
+        if kind == 'identical':
+            choice = ask_delete_choice(f"Delete the {len(ranked) - 1} lower ranked copies? (y/n/q): ")
+            if choice == 'q':
+                break
+            if choice == 'n':
+                continue
+
+        keeper = ranked[0]
+        try:
+            # The index may be stale if a file was replaced since it was fingerprinted; check the blocks again
+            if kind == 'identical' and compute_fingerprint(keeper[0]) != keeper[2]:
+                print(f"Skipping group: {keeper[0]} changed since it was indexed")
+                continue
+        except OSError as e:
+            print(f"Skipping group: {keeper[0]} is unreadable ({e})")
+            continue
+        quit_dedupe = False
+        for file_path, file_size, fingerprint, *_ in ranked[1:]:
+            if kind == 'similar':
+                # Similar files may still be another cut or edition, so each deletion is confirmed on its own
+                choice = ask_delete_choice(f"Delete {file_path}? (y/n/q): ")
+                if choice == 'q':
+                    quit_dedupe = True
+                    break
+                if choice == 'n':
+                    continue
+            try:
+                if kind == 'identical' and compute_fingerprint(file_path) != fingerprint:
+                    print(f"Skipping {file_path}: changed since it was indexed")
+                    continue
+            except OSError as e:
+                print(f"Skipping {file_path}: {e}")
+                continue
+            if delete_file(file_path, db_conn):
+                db_conn.execute("DELETE FROM compress_jobs WHERE file_path = ? AND status = 'queued'", (file_path,))
+                db_conn.commit()
+                deleted.add(file_path)
+                reclaimed += file_size
+                print(f"File deleted: {file_path}")
+            else:
+                print(f"Failed to delete file: {file_path}")
+        if quit_dedupe:
+            break
+
+    logging.info(f"Dedupe reclaimed {reclaimed / 1024 ** 3:.2f} GB")
+    return reclaimed
+
+# pending: worth compressing; compressed: produced by compress; skipped: not worth it; unknown: never estimated
+COMPRESSION_STATUS_SQL = """CASE WHEN needs_compression = 1 THEN 'pending'
+                                 WHEN needs_compression = 0 AND estimate_source IS NULL THEN 'compressed'
+                                 WHEN needs_compression = 0 THEN 'skipped'
+                                 ELSE 'unknown' END"""
+
+REPORTS = {
+    'space': f"""SELECT content_type, COALESCE(video_codec, 'unknown') AS codec, {COMPRESSION_STATUS_SQL} AS status,
+                        COUNT(*) AS files, SUM(file_size) AS bytes
+                 FROM media_files GROUP BY 1, 2, 3 ORDER BY bytes DESC""",
+    'review': f"""SELECT content_type, COUNT(*) AS files, SUM(file_size) AS bytes
+                  FROM media_files INDEXED BY idx_media_files_report
+                  WHERE {REVIEW_QUEUE_FILTER} GROUP BY content_type ORDER BY bytes DESC""",
+    'savings': """SELECT month, files, original_bytes, compressed_bytes, saved_bytes,
+                         SUM(saved_bytes) OVER (ORDER BY month) AS total_saved_bytes
+                  FROM (SELECT strftime('%Y-%m', completed_at, 'unixepoch') AS month, COUNT(*) AS files,
+                               SUM(original_size) AS original_bytes, SUM(compressed_size) AS compressed_bytes,
+                               SUM(original_size - compressed_size) AS saved_bytes
+                        FROM compress_history GROUP BY month)
+                  ORDER BY month""",
+}
+
+QUERY_COLUMNS = ("content_type, file_size, video_codec, video_width, duration, "
+                 f"{COMPRESSION_STATUS_SQL} AS status, has_been_reviewed, has_english_audio, estimated_ratio, file_path")
+
+def parse_size(value):
+    """Bytes in a size such as `5G`, `500M`, `1.5T` or `1048576` (binary units)."""
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    value = str(value).strip().lower().rstrip('b')
+    multiplier = units.get(value[-1:])
+    size = float(value[:-1] if multiplier else value) * (multiplier or 1)
+    if size < 0:
+        raise ValueError("size must not be negative")
+    return int(size)
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+    return f"{size:.2f} TiB"
+
+def build_query(options):
+    """SQL and parameters for `query`; options are the filters given on the command line."""
+    conditions = []
+    params = []
+    if 'type' in options:
+        conditions.append("content_type = ?")
+        params.append(options['type'])
+    if 'min-size' in options:
+        conditions.append("file_size >= ?")
+        params.append(parse_size(options['min-size']))
+    if 'max-size' in options:
+        conditions.append("file_size < ?")
+        params.append(parse_size(options['max-size']))
+    if 'codec' in options:
+        conditions.append("video_codec = ?")
+        params.append(options['codec'])
+    if 'status' in options:
+        if options['status'] not in ('pending', 'compressed', 'skipped', 'unknown'):
+            raise ValueError("--status must be pending, compressed, skipped or unknown")
+        conditions.append(f"({COMPRESSION_STATUS_SQL}) = ?")
+        params.append(options['status'])
+    for option, yes, no in (('reviewed', "has_been_reviewed = 1", "(has_been_reviewed IS NULL OR has_been_reviewed = 0)"),
+                            ('english', "has_english_audio = 1", "has_english_audio = 0")):
+        if option in options:
+            if options[option] not in ('yes', 'no'):
+                raise ValueError(f"--{option} must be yes or no")
+            conditions.append(yes if options[option] == 'yes' else no)
+    if 'under' in options:
+        # Primary-key range rather than LIKE, so a subtree costs no more than its size
+        low, high = _path_range(os.path.normpath(options['under']))
+        conditions.append("file_path > ? AND file_path < ?")
+        params += [low, high]
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    if options.get('summary'):
+        return (f"""SELECT COUNT(*) AS files, COALESCE(SUM(file_size), 0) AS bytes,
+                           CAST(COALESCE(SUM(file_size * (1 - estimated_ratio)), 0) AS INTEGER) AS expected_savings_bytes
+                    FROM media_files INDEXED BY idx_media_files_report {where}""", params)
+    sql = f"SELECT {QUERY_COLUMNS} FROM media_files {where} ORDER BY file_size DESC"
+    if 'limit' in options:
+        sql += " LIMIT ?"
+        params.append(int(options['limit']))
+    return sql, params
+
+def write_rows(cursor, fmt='text', out=None):
+    """Stream a cursor's rows as aligned text, CSV or JSON Lines without holding the result in memory."""
+    out = out or sys.stdout
+    columns = [description[0] for description in cursor.description]
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        writer.writerows(cursor)
+    elif fmt == 'json':
+        for row in cursor:
+            out.write(json.dumps(dict(zip(columns, row))) + '\n')
+    else:
+        # Widths come from the headers, not the data, so rows print as they arrive; paths go last
+        widths = [max(len(column), 12) for column in columns]
+        out.write('  '.join(column.ljust(width) for column, width in zip(columns, widths)).rstrip() + '\n')
+        for row in cursor:
+            cells = [format_size(value) if (column.endswith('bytes') or column == 'file_size') and value is not None
+                     else '' if value is None else f"{value:.3f}" if isinstance(value, float) else str(value)
+                     for column, value in zip(columns, row)]
+            out.write('  '.join(cell.ljust(width) for cell, width in zip(cells, widths)).rstrip() + '\n')
+
+def run_report(db_conn, names, fmt='text'):
+    for name in names:
+        if fmt == 'text':
+            print(f"\n{name.capitalize()}:")
+        write_rows(db_conn.execute(REPORTS[name]), fmt)
+
+def run_query(db_conn, options, fmt='text'):
+    sql, params = build_query(options)
+    write_rows(db_conn.execute(sql, params), fmt)
+
+USAGE = ("Usage: python script.py [scan <directory> [--workers N] [--full] | review [count] | "
+         "compress <type> <size_threshold> [--jobs N|auto] [--budget 8h] | compress --worker [<type> <size_threshold>] [--jobs N|auto] | "
+         "estimate <type> <size_threshold> [--trial] | watch <directory> [--workers N] [--poll] | dedupe [--similar] | "
+         "stats [--runs N] [--prometheus FILE] | report [space|review|savings] [--format text|csv|json] | "
+         "query [--type T] [--min-size 5G] [--max-size S] [--codec C] [--status S] [--reviewed yes|no] "
+         "[--english yes|no] [--under DIR] [--summary] [--limit N] [--format text|csv|json]]")
+
+# Options that never take a value
+FLAG_OPTIONS = {'worker', 'trial', 'poll', 'similar', 'summary', 'full'}
+
+def parse_options(args):
+    """Split `--name value` / `--name=value` options out of the positional arguments."""
+    positional = []
+    options = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('--'):
+            name, sep, value = arg[2:].partition('=')
+            if not sep:
+                if name in FLAG_OPTIONS:
+                    value = True
+                elif i + 1 < len(args) and not args[i + 1].startswith('--'):
+                    value = args[i + 1]
+                    i += 1
+                else:
+                    value = True
+            options[name] = value
         else:
-            logging.error(f"Failed to compress {file_path}")
+            positional.append(arg)
+        i += 1
+    return positional, options
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python script.py [scan <directory> | review [count] | compress <type> <size_threshold>]")
+    args, options = parse_options(sys.argv[1:])
+    if len(args) < 1:
+        print(USAGE)
         sys.exit(1)
 
-    command = sys.argv[1]
+    command = args[0]
+    if command in ("scan", "watch", "compress"):
+        begin_metrics_run(command)
 
-    if command == "scan" and len(sys.argv) == 3:
-        scan_directory = sys.argv[2]
+    if command in ("scan", "watch") and len(args) == 2:
+        scan_directory = args[1]
         if not os.path.isdir(scan_directory):
             print(f"Error: {scan_directory} is not a valid directory")
             sys.exit(1)
 
-        if not ensure_smb_mounted(SMB_SERVER, SMB_PATH, MOUNT_POINT):
+        try:
+            workers = int(options.get('workers', SCAN_WORKERS))
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            print("Error: --workers must be a positive integer")
+            sys.exit(1)
+
+        if not get_storage().ensure_available():
             print("Failed to mount SMB share. Exiting.")
             sys.exit(1)
 
         conn = create_db_connection(DB_PATH)
         try:
-            scan_files(scan_directory, conn)
+            if command == "watch":
+                try:
+                    watch_directory(scan_directory, conn, workers=workers, poll=bool(options.get('poll')))
+                except KeyboardInterrupt:
+                    logging.info("Stopped watching")
+            else:
+                scan_files(scan_directory, conn, workers=workers, full=True if options.get('full') else None)
         finally:
+            save_metrics_run(conn, finished=True)
             conn.close()
     elif command == "review":
         conn = create_db_connection(DB_PATH)
         try:
-            if len(sys.argv) == 3 and sys.argv[2] == "count":
-                count = get_files_without_english_audio(conn)
-                print(f"Number of files to review: {len(count)}")
+            if len(args) == 2 and args[1] == "count":
+                count = count_files_without_english_audio(conn)
+                print(f"Number of files to review: {count}")
             else:
                 review_files(conn)
         finally:
             conn.close()
-    elif command == "compress" and len(sys.argv) == 4:
-        file_type = sys.argv[2]
-        size_threshold = int(sys.argv[3])
+    elif command == "compress" and (len(args) == 3 or (options.get('worker') and len(args) == 1)):
+        file_type = args[1] if len(args) == 3 else None
+        size_threshold = int(args[2]) if len(args) == 3 else None
         
-        if file_type not in ["movie", "tv_show"]:
+        if file_type is not None and file_type not in ["movie", "tv_show"]:
             print("Error: file type must be either 'movie' or 'tv_show'")
             sys.exit(1)
+
+        try:
+            jobs = get_encode_jobs(options.get('jobs', ENCODE_JOBS))
+        except ValueError:
+            print("Error: --jobs must be a positive integer or 'auto'")
+            sys.exit(1)
+
+        try:
+            budget = parse_duration(options['budget']) if 'budget' in options else None
+        except ValueError:
+            print("Error: --budget must be a duration such as 8h, 90m or 3600")
+            sys.exit(1)
         
         conn = create_db_connection(DB_PATH)
         try:
-            compress_files(file_type, size_threshold, conn)
+            if options.get('worker'):
+                run_compress_worker(conn, jobs=jobs, file_type=file_type, size_threshold=size_threshold)
+            else:
+                compress_files(file_type, size_threshold, conn, jobs=jobs, budget=budget)
+        finally:
+            save_metrics_run(conn, finished=True)
+            conn.close()
+    elif command == "estimate" and len(args) == 3:
+        file_type = args[1]
+        size_threshold = int(args[2])
+
+        if file_type not in ["movie", "tv_show"]:
+            print("Error: file type must be either 'movie' or 'tv_show'")
+            sys.exit(1)
+
+        conn = create_db_connection(DB_PATH)
+        try:
+            estimate_files(file_type, size_threshold, conn, trial=bool(options.get('trial')))
+        finally:
+            conn.close()
+    elif command == "dedupe" and len(args) == 1:
+        if not get_storage().ensure_available():
+            print("Failed to mount SMB share. Exiting.")
+            sys.exit(1)
+
+        conn = create_db_connection(DB_PATH)
+        try:
+            dedupe_files(conn, similar=bool(options.get('similar')))
+        finally:
+            conn.close()
+    elif command == "stats" and len(args) == 1:
+        try:
+            runs = int(options.get('runs', 5))
+        except ValueError:
+            print("Error: --runs must be an integer")
+            sys.exit(1)
+
+        conn = create_db_connection(DB_PATH)
+        try:
+            print_stats(conn, runs)
+            if 'prometheus' in options:
+                write_prometheus_textfile(conn, options['prometheus'])
+        finally:
+            conn.close()
+    elif command in ("report", "query"):
+        fmt = options.pop('format', 'text')
+        if fmt not in ('text', 'csv', 'json'):
+            print("Error: --format must be text, csv or json")
+            sys.exit(1)
+        names = args[1:] or list(REPORTS)
+        if command == "report" and any(name not in REPORTS for name in names):
+            print(f"Error: reports are {', '.join(REPORTS)}")
+            sys.exit(1)
+
+        conn = create_db_connection(DB_PATH)
+        try:
+            if command == "report":
+                run_report(conn, names, fmt)
+            elif len(args) == 1:
+                run_query(conn, options, fmt)
+            else:
+                print(USAGE)
+                sys.exit(1)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        except BrokenPipeError:
+            # `query ... | head` closes the pipe early
+            pass
         finally:
             conn.close()
     else:
-        print("Usage: python script.py [scan <directory> | review [count] | compress <type> <size_threshold>]")
+        print(USAGE)
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
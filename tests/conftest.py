@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import media_manager
+
+
+@pytest.fixture
+def mm(tmp_path, monkeypatch):
+    """media_manager with every path, share and limit pointed at tmp_path."""
+    staging = tmp_path / 'staging'
+    monkeypatch.setattr(media_manager, 'DB_PATH', str(tmp_path / 'files.db'))
+    monkeypatch.setattr(media_manager, 'DESTINATION_DIR', str(staging))
+    monkeypatch.setattr(media_manager, 'BANDWIDTH_STATE_DIR', str(staging / 'bandwidth'))
+    monkeypatch.setattr(media_manager, 'PROFILE_CACHE_DIR', str(staging / 'profiles'))
+    monkeypatch.setattr(media_manager, 'HANDBRAKE_PRESET', os.path.join(REPO_DIR, 'compress.json'))
+    monkeypatch.setattr(media_manager, '_encode_profiles', {})
+    monkeypatch.setattr(media_manager, 'REVIEW_CACHE_DIR', str(staging / 'review_cache'))
+    monkeypatch.setattr(media_manager, 'STORAGE_BACKEND', 'local')
+    monkeypatch.setattr(media_manager, 'BANDWIDTH_LIMITS', {})
+    monkeypatch.setattr(media_manager, 'DIR_MTIME_SETTLE', 0)
+    monkeypatch.setattr(media_manager, 'RETRY_DELAY', 0)
+    monkeypatch.setattr(media_manager, '_storage', None)
+    monkeypatch.setattr(media_manager, '_bandwidth_limiter', None)
+    monkeypatch.setattr(media_manager, 'metrics', media_manager.PhaseMetrics())
+    return media_manager
+
+
+@pytest.fixture
+def db(mm):
+    conn = mm.setup_database(mm.DB_PATH)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def add_file(db):
+    """Insert a bare media_files row; extra columns are passed as keyword arguments."""
+    def add(file_path, file_size=1000, content_type='movie', **columns):
+        values = dict({'file_path': file_path, 'file_basename': os.path.basename(file_path), 'file_size': file_size,
+                       'content_type': content_type, 'needs_compression': 1}, **columns)
+        db.execute(f"INSERT INTO media_files ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+                   tuple(values.values()))
+        db.commit()
+    return add
@@ -0,0 +1,95 @@
+"""Minimal MKV and MP4 files for the header parser and retag tests, built by hand rather than by a muxer."""
+import struct
+import zlib
+
+
+def ebml(element_id, payload):
+    # Shortest size field, as mkvmerge writes them, so rewritten headers keep their length
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+    length = next(n for n in range(1, 9) if len(payload) < (1 << (7 * n)) - 1)
+    return id_bytes + ((1 << (7 * length)) | len(payload)).to_bytes(length, 'big') + payload
+
+
+def uint(element_id, value):
+    return ebml(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big'))
+
+
+def string(element_id, value):
+    return ebml(element_id, value.encode('utf-8'))
+
+
+def mkv_track(number, track_type, codec_id, language=None, bcp47=None, width=None, height=None,
+              default_duration=None, channels=None):
+    fields = uint(0xD7, number) + uint(0x73C5, number) + uint(0x83, track_type) + string(0x86, codec_id)
+    if language is not None:
+        fields += string(0x22B59C, language)
+    if bcp47 is not None:
+        fields += string(0x22B59D, bcp47)
+    if default_duration is not None:
+        fields += uint(0x23E383, default_duration)
+    if width is not None:
+        fields += ebml(0xE0, uint(0xB0, width) + uint(0xBA, height))
+    if channels is not None:
+        fields += ebml(0xE1, uint(0x9F, channels))
+    return ebml(0xAE, fields)
+
+
+def mkv_bit_rate_tag(track_uid, bit_rate):
+    targets = ebml(0x63C0, uint(0x63C5, track_uid))
+    simple = ebml(0x67C8, string(0x45A3, 'BPS') + string(0x4487, str(bit_rate)))
+    return ebml(0x7373, targets + simple)
+
+
+def build_mkv(tracks, duration_ms=5400000.0, void=0, tags=b'', crc=False, cluster=b'\xaa' * 4096):
+    """Matroska file with the given TrackEntry elements; void adds a Void element of that size after Tracks."""
+    header = ebml(0x1A45DFA3, string(0x4282, 'matroska'))
+    info = ebml(0x1549A966, uint(0x2AD7B1, 1000000) + ebml(0x4489, struct.pack('>d', duration_ms)))
+    body = b''.join(tracks)
+    if crc:
+        body = ebml(0xBF, struct.pack('<I', zlib.crc32(body))) + body
+    segment = info + ebml(0x1654AE6B, body)
+    if void:
+        segment += b'\xec' + ((1 << 56) | (void - 9)).to_bytes(8, 'big') + b'\0' * (void - 9)
+    if tags:
+        segment += ebml(0x1254C367, tags)
+    segment += ebml(0x1F43B675, cluster)
+    return header + ebml(0x18538067, segment)
+
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type.encode('latin-1')) + payload
+
+
+def pack_language(code):
+    return sum((ord(char) - 0x60) << shift for char, shift in zip(code, (10, 5, 0)))
+
+
+def mp4_track(handler, entry, language='und', timescale=24000, sample_delta=1001, elng=None):
+    mdhd = struct.pack('>4xIIIIHH', 0, 0, timescale, timescale * 10, pack_language(language), 0)
+    hdlr = struct.pack('>4x4x4s12x', handler.encode('latin-1')) + b'\0'
+    stsd = struct.pack('>4xI', 1) + entry
+    stts = struct.pack('>4xIII', 1, 240, sample_delta)
+    stbl = box('stbl', box('stsd', stsd) + box('stts', stts))
+    mdia = box('mdhd', mdhd) + box('hdlr', hdlr)
+    if elng is not None:
+        mdia += box('elng', b'\0' * 4 + elng.encode('ascii') + b'\0')
+    mdia += box('minf', stbl)
+    return box('trak', box('mdia', mdia))
+
+
+def avc_entry(width, height):
+    payload = bytearray(78)
+    struct.pack_into('>HH', payload, 24, width, height)
+    return box('avc1', bytes(payload))
+
+
+def ac3_entry(acmod, lfe, rate_code):
+    payload = bytearray(28)
+    struct.pack_into('>H', payload, 16, 2)
+    dac3 = ((acmod << 11) | (lfe << 10) | (rate_code << 5)).to_bytes(3, 'big')
+    return box('ac-3', bytes(payload) + box('dac3', dac3))
+
+
+def build_mp4(tracks, duration=10, timescale=1000, mdat=b'\xbb' * 4096):
+    mvhd = struct.pack('>4xIIII', 0, 0, timescale, duration * timescale) + b'\0' * 80
+    return box('ftyp', b'isom\0\0\0\0isom') + box('moov', box('mvhd', mvhd) + b''.join(tracks)) + box('mdat', mdat)
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+MB = 1024 ** 2
+NOON = time.mktime((2026, 3, 2, 12, 0, 0, 0, 0, -1))  # Local time, outside any schedule window below
+
+
+@pytest.fixture
+def clock(mm, monkeypatch):
+    """Fake time: sleeps advance it and are recorded."""
+    class Clock:
+        def __init__(self):
+            self.now = NOON
+            self.sleeps = []
+
+        def sleep(self, seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+    fake = Clock()
+    monkeypatch.setattr(mm.time, 'time', lambda: fake.now)
+    monkeypatch.setattr(mm.time, 'sleep', fake.sleep)
+    return fake
+
+
+@pytest.fixture(params=[True, False], ids=['shared', 'per-process'])
+def limiter(request, mm, tmp_path):
+    def make(limits, schedule=()):
+        limiter = mm.BandwidthLimiter(limits, schedule, str(tmp_path / 'buckets'))
+        limiter.shared = limiter.shared and request.param
+        return limiter
+    return make
+
+
+def test_burst_then_debt(clock, limiter):
+    bucket = limiter({'read': 10 * MB})
+    bucket.consume('read', 'copy', 10 * MB)
+    assert clock.sleeps == []
+    # The bucket is empty; a further 5 MB is paid off at 10 MB/s
+    bucket.consume('read', 'copy', 5 * MB)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_refill_is_capped_at_burst(clock, limiter):
+    bucket = limiter({'read': 10 * MB})
+    bucket.consume('read', 'copy', 10 * MB)
+    clock.now += 60
+    # A minute of idling still only banks BANDWIDTH_BURST_SECONDS worth
+    bucket.consume('read', 'copy', 15 * MB)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_large_request_is_served_at_the_average_rate(clock, limiter):
+    bucket = limiter({'write': 4 * MB})
+    for _ in range(10):
+        bucket.consume('write', 'copy', 2 * MB)
+    assert clock.now - NOON == pytest.approx((20 - 4) / 4)
+
+
+def test_class_limit_is_checked_with_the_direction_limit(clock, limiter):
+    bucket = limiter({'read': 100 * MB, 'read:probe': 1 * MB})
+    bucket.consume('read', 'probe', 2 * MB)
+    assert clock.sleeps == [pytest.approx(1.0)]
+    # Other classes only draw on the direction bucket, which still has room
+    bucket.consume('read', 'copy', 10 * MB)
+    assert len(clock.sleeps) == 1
+    # Unlimited directions never wait
+    bucket.consume('write', 'retag', 1000 * MB)
+    assert len(clock.sleeps) == 1
+
+
+def test_schedule_scales_the_rate(clock, limiter):
+    bucket = limiter({'read': 8 * MB}, schedule=((12, 13, 0.25),))
+    bucket.consume('read', 'copy', 4 * MB)
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_schedule_window_can_wrap_midnight(mm, limiter):
+    bucket = limiter({'read': 8 * MB}, schedule=((22, 6, 0.5),))
+    assert bucket.get_rate('read', time.mktime((2026, 3, 2, 23, 0, 0, 0, 0, -1))) == 4 * MB
+    assert bucket.get_rate('read', time.mktime((2026, 3, 2, 3, 0, 0, 0, 0, -1))) == 4 * MB
+    assert bucket.get_rate('read', NOON) == 8 * MB
+    assert bucket.get_rate('write', NOON) is None
+
+
+def test_buckets_are_shared_between_limiters(mm, clock, tmp_path):
+    if mm.fcntl is None:
+        pytest.skip("buckets are per process without fcntl")
+    first = mm.BandwidthLimiter({'read': 10 * MB}, (), str(tmp_path / 'buckets'))
+    second = mm.BandwidthLimiter({'read': 10 * MB}, (), str(tmp_path / 'buckets'))
+    first.consume('read', 'copy', 10 * MB)
+    second.consume('read', 'copy', 10 * MB)
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_throttle_without_limits_never_sleeps(mm, clock):
+    mm.throttle('read', 'copy', 10 ** 12)
+    assert clock.sleeps == []
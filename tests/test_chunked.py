@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def no_burn(mm, monkeypatch):
+    # The shipped preset burns in foreign audio subtitles, which rules out chunked encodes
+    preset = dict(mm.load_handbrake_preset(), SubtitleAddForeignAudioSearch=False, SubtitleBurnBehavior='none')
+    monkeypatch.setattr(mm, '_handbrake_preset', preset)
+    return preset
+
+
+@pytest.fixture
+def fake_tools(mm, tmp_path, monkeypatch):
+    """Fake ffmpeg and HandBrakeCLI runs; segment_sizes gives each encoded segment's picture size."""
+    class Tools:
+        def __init__(self):
+            self.segment_sizes = [(1920, 800)] * 3
+            self.crops = []
+
+    tools = Tools()
+
+    def run_ffmpeg(args):
+        output = args[-1]
+        if '-f' in args and args[args.index('-f') + 1] == 'segment':
+            for index in range(len(tools.segment_sizes)):
+                with open(output % index, 'wb') as f:
+                    f.write(b'source')
+        else:
+            with open(output, 'wb') as f:
+                f.write(b'muxed')
+        return True
+
+    def encode_file(input_file, output_file, threads=None, segment=None, profile=None, crop=None):
+        tools.crops.append(crop)
+        with open(output_file, 'wb') as f:
+            f.write(b'encoded')
+        return {'wall_seconds': 1.0, 'avg_fps': 50.0, 'profile': profile}
+
+    def get_file_metadata(file_path):
+        name = os.path.basename(file_path)
+        if name.startswith('encoded-'):
+            width, height = tools.segment_sizes[int(name[8:11])]
+            return [], [], {'width': width, 'height': height}
+        return [{'language': 'en', 'format': 'AAC'}], [], {'width': 1920, 'height': 1080, 'duration': 6000.0}
+
+    monkeypatch.setattr(mm, '_run_ffmpeg', run_ffmpeg)
+    monkeypatch.setattr(mm, 'encode_file', encode_file)
+    monkeypatch.setattr(mm, 'get_file_metadata', get_file_metadata)
+    monkeypatch.setattr(mm, 'detect_crop', lambda input_file, profile=None: (132, 148, 0, 0))
+    return tools
+
+
+def staged_input(tmp_path):
+    staging = tmp_path / 'job'
+    staging.mkdir()
+    input_file = staging / 'film.mkv'
+    input_file.write_bytes(b'\0' * 1024)
+    return str(input_file), str(staging / 'film.mp4')
+
+
+def test_preset_burns_subtitles(mm, no_burn):
+    base = json.load(open(mm.HANDBRAKE_PRESET))['PresetList'][0]
+    assert mm.preset_burns_subtitles(base)
+    assert not mm.preset_burns_subtitles(no_burn)
+    assert mm.preset_burns_subtitles(dict(no_burn, SubtitleBurnBehavior='first'))
+
+
+def test_every_segment_gets_the_crop_of_the_whole_source(mm, tmp_path, no_burn, fake_tools):
+    input_file, output_file = staged_input(tmp_path)
+    stats = mm.chunked_encode_file(input_file, output_file, 3)
+    assert fake_tools.crops == [(132, 148, 0, 0)] * 3
+    assert os.path.exists(output_file)
+    assert stats['avg_fps'] > 0
+
+
+def test_segments_of_different_sizes_are_not_joined(mm, tmp_path, no_burn, fake_tools):
+    fake_tools.segment_sizes = [(1920, 800), (1920, 1080), (1920, 800)]
+    input_file, output_file = staged_input(tmp_path)
+    with pytest.raises(RuntimeError, match='picture size'):
+        mm.chunked_encode_file(input_file, output_file, 3)
+    assert not os.path.exists(output_file)
+    assert not os.path.exists(os.path.join(os.path.dirname(output_file), 'chunks'))
+
+
+@pytest.mark.parametrize('burns', [True, False])
+def test_burned_subtitles_need_a_single_run(mm, tmp_path, monkeypatch, fake_tools, burns):
+    if not burns:
+        monkeypatch.setattr(mm, '_handbrake_preset', dict(mm.load_handbrake_preset(), SubtitleAddForeignAudioSearch=False,
+                                                          SubtitleBurnBehavior='none'))
+    monkeypatch.setattr(mm, 'CHUNKED_ENCODE_MIN_BYTES', 1)
+    monkeypatch.setattr(mm, 'CHUNK_SEGMENTS', 3)
+    input_file, output_file = staged_input(tmp_path)
+    mm.encode_phase('/media/movies/film.mkv', input_file, output_file)
+    # A chunked encode runs HandBrakeCLI once per segment with the detected crop, a single run once without one
+    assert fake_tools.crops == ([None] if burns else [(132, 148, 0, 0)] * 3)
+
+
+def test_detect_crop_reads_the_scan(mm, tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'HandBrakeCLI'
+    title_set = {'MainFeature': 0, 'TitleList': [{'Crop': [140, 140, 0, 0], 'Geometry': {'Width': 1920, 'Height': 1080}}]}
+    script.write_text(f"#!{sys.executable}\nimport json\nprint('Version: ' + json.dumps({{'Name': 'HandBrake'}}, indent=4))\n"
+                      f"print('JSON Title Set: ' + json.dumps({title_set!r}, indent=4))\n")
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    assert mm.detect_crop(str(tmp_path / 'film.mkv')) == (140, 140, 0, 0)
+
+    script.write_text(f"#!{sys.executable}\nimport sys\nsys.exit(3)\n")
+    with pytest.raises(RuntimeError):
+        mm.detect_crop(str(tmp_path / 'film.mkv'))
@@ -0,0 +1,60 @@
+import os
+
+
+def corrupt_first_copy(mm, monkeypatch, offset):
+    original = mm._copy_range
+    calls = []
+
+    def copy_range(fsrc, fdst, *args, **kwargs):
+        original(fsrc, fdst, *args, **kwargs)
+        calls.append(1)
+        if len(calls) == 1:
+            fdst.seek(offset)
+            fdst.write(b'\0')
+
+    monkeypatch.setattr(mm, '_copy_range', copy_range)
+    return calls
+
+
+def test_read_back_catches_corruption_between_sampled_blocks(mm, tmp_path, monkeypatch):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(os.urandom(1024 * 1024) + b'\1' * 1024)
+    dst = tmp_path / 'dst.bin'
+    calls = corrupt_first_copy(mm, monkeypatch, 200 * 1024)
+
+    checksum = mm.copy_file(str(src), str(dst), read_back=True, buffer_size=64 * 1024)
+    assert len(calls) == 2
+    assert dst.read_bytes() == src.read_bytes()
+    assert checksum == mm.file_checksum(str(src))
+
+
+def test_sampled_verification_resumes_interrupted_copy(mm, tmp_path, monkeypatch):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(os.urandom(512 * 1024))
+    dst = tmp_path / 'dst.bin'
+    original = mm._copy_range
+    calls = []
+
+    def failing_copy_range(fsrc, fdst, offset, total, buffer_size, digest, state, bandwidth=None):
+        calls.append(offset)
+        if len(calls) == 1:
+            original(fsrc, fdst, offset, total // 2, buffer_size, digest, state, bandwidth)
+            raise OSError('share went away')
+        original(fsrc, fdst, offset, total, buffer_size, digest, state, bandwidth)
+
+    monkeypatch.setattr(mm, '_copy_range', failing_copy_range)
+    checksum = mm.copy_file(str(src), str(dst), buffer_size=64 * 1024)
+    assert calls == [0, 256 * 1024]
+    assert dst.read_bytes() == src.read_bytes()
+    assert checksum == mm.file_checksum(str(src))
+
+
+def test_storage_upload_copy_reads_back(mm, tmp_path, monkeypatch):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(os.urandom(300 * 1024))
+    read_back = []
+    monkeypatch.setattr(mm, 'read_back_checksum', lambda path, op_class=None: read_back.append(op_class)
+                        or mm.file_checksum(path))
+    mm.get_storage().copy(str(src), str(tmp_path / 'up.bin'), bandwidth=('write', 'copy'), read_back=True)
+    mm.get_storage().copy(str(src), str(tmp_path / 'in.bin'), bandwidth=('read', 'copy'))
+    assert read_back == ['copy']
@@ -0,0 +1,81 @@
+import pytest
+
+GB = 1024 ** 3
+
+
+def similar_paths(mm, db):
+    return [sorted(row[0] for row in rows) for kind, rows in mm.find_duplicate_groups(db, similar=True)
+            if kind == 'similar']
+
+
+@pytest.mark.parametrize('name, title', [
+    ('Movie.Name.2010.1080p.BluRay.x264-GROUP.mkv', 'movie name 2010'),
+    ('Movie Name (2010).mkv', 'movie name 2010'),
+    ('[Group] Movie Name 2010 [ABCD1234].mp4', 'movie name 2010'),
+    ('Show.Name.S01E02.720p.WEB-DL.mkv', 'show name s01e02'),
+])
+def test_normalize_title(mm, name, title):
+    assert mm.normalize_title(f'/media/{name}') == title
+
+
+def test_identical_fingerprints_are_grouped(mm, db, add_file):
+    add_file('/media/movies/a.mkv', fingerprint='1000:abc')
+    add_file('/media/movies/b.mkv', fingerprint='1000:abc')
+    add_file('/media/movies/c.mkv', fingerprint='1000:def')
+    groups = mm.find_duplicate_groups(db)
+    assert [(kind, sorted(row[0] for row in rows)) for kind, rows in groups] == [
+        ('identical', ['/media/movies/a.mkv', '/media/movies/b.mkv'])]
+
+
+def test_episodes_of_equal_length_are_not_similar(mm, db, add_file):
+    for episode in range(1, 4):
+        add_file(f'/media/tv/Show/Season 1/Show.S01E0{episode}.mkv', GB, 'tv_show', duration=1320.0)
+    assert similar_paths(mm, db) == []
+
+
+def test_reencode_of_an_episode_is_similar(mm, db, add_file):
+    add_file('/media/tv/Show/Season 1/Show.S01E01.1080p.BluRay.mkv', 2 * GB, 'tv_show', duration=1320.0)
+    add_file('/media/tv/Show/Season 1/Show S01E01.mkv', GB, 'tv_show', duration=1321.0)
+    add_file('/media/tv/Show/Season 1/Show.S01E02.mkv', GB, 'tv_show', duration=1320.5)
+    assert similar_paths(mm, db) == [['/media/tv/Show/Season 1/Show S01E01.mkv',
+                                      '/media/tv/Show/Season 1/Show.S01E01.1080p.BluRay.mkv']]
+
+
+def test_movie_copies_in_one_directory_are_similar(mm, db, add_file):
+    add_file('/media/movies/Movie (2010)/Movie.mkv', 4 * GB, duration=6000.0)
+    add_file('/media/movies/Movie (2010)/Movie.Extended.mkv', 3 * GB, duration=6001.0)
+    add_file('/media/movies/Other (2011)/Other.mkv', 4 * GB, duration=6000.5)
+    assert similar_paths(mm, db) == [['/media/movies/Movie (2010)/Movie.Extended.mkv',
+                                      '/media/movies/Movie (2010)/Movie.mkv']]
+
+
+def test_size_ratio_bound(mm, db, add_file):
+    add_file('/media/movies/Movie (2010)/Movie.mkv', 20 * GB, duration=6000.0)
+    add_file('/media/movies/Movie (2010)/Movie-sample.mkv', GB, duration=6000.0)
+    assert similar_paths(mm, db) == []
+
+
+def test_duration_tolerance_and_content_type(mm, db, add_file):
+    add_file('/media/movies/Movie/Movie.mkv', GB, duration=6000.0)
+    add_file('/media/movies/Movie/Movie.1080p.mkv', GB, duration=6000.0 + mm.DEDUPE_DURATION_TOLERANCE + 1)
+    add_file('/media/tv/Movie/Movie.mkv', GB, 'tv_show', duration=6000.0)
+    assert similar_paths(mm, db) == []
+
+
+def test_similar_deletions_are_confirmed_one_by_one(mm, db, add_file, tmp_path, monkeypatch):
+    paths = []
+    for name, size in (('Movie.2160p.mkv', 3), ('Movie.1080p.mkv', 2), ('Movie.720p.mkv', 1)):
+        path = tmp_path / 'Movie' / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b'\0' * size)
+        paths.append(str(path))
+    for path, width in zip(paths, (3840, 1920, 1280)):
+        add_file(path, GB, video_width=width, duration=6000.0, fingerprint=f'{path}:x')
+    answers = iter(['n', 'y'])
+    prompts = []
+    monkeypatch.setattr('builtins.input', lambda prompt: prompts.append(prompt) or next(answers))
+    monkeypatch.setattr(mm, 'backfill_fingerprints', lambda db_conn: None)
+    mm.dedupe_files(db, similar=True)
+    assert prompts == [f"Delete {paths[1]}? (y/n/q): ", f"Delete {paths[2]}? (y/n/q): "]
+    assert [path for path in paths if (tmp_path / 'Movie' / path.split('/')[-1]).exists()] == paths[:2]
+    assert [row[0] for row in db.execute("SELECT file_path FROM media_files ORDER BY video_width DESC")] == paths[:2]
@@ -0,0 +1,73 @@
+import sqlite3
+import threading
+
+
+def test_two_workers_never_lease_the_same_job(mm, db, add_file):
+    for i in range(40):
+        add_file(f'/share/movies/{i:02d}.mkv', file_size=1000 + i)
+    mm.enqueue_compress_jobs(db, 'movie', 0)
+
+    leased = {'w1': [], 'w2': []}
+    start = threading.Barrier(2)
+
+    def drain(worker_id):
+        conn = sqlite3.connect(mm.DB_PATH, timeout=30)
+        try:
+            start.wait()
+            while True:
+                file_path = mm.lease_next_job(conn, worker_id)
+                if file_path is None:
+                    return
+                leased[worker_id].append(file_path)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=drain, args=(worker_id,)) for worker_id in leased]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    all_leased = leased['w1'] + leased['w2']
+    assert len(all_leased) == 40
+    assert len(set(all_leased)) == 40
+    rows = dict(db.execute("SELECT file_path, worker_id FROM compress_jobs").fetchall())
+    for worker_id, file_paths in leased.items():
+        assert all(rows[file_path] == worker_id for file_path in file_paths)
+    claims = dict(db.execute("SELECT file_path, claimed_by FROM media_files").fetchall())
+    assert claims == rows
+
+
+def test_live_lease_is_not_taken_over_but_expired_one_is(mm, db, add_file, monkeypatch):
+    add_file('/share/movies/a.mkv')
+    mm.enqueue_compress_jobs(db, 'movie', 0)
+    assert mm.lease_next_job(db, 'w1') == '/share/movies/a.mkv'
+    assert mm.lease_next_job(db, 'w2') is None
+
+    db.execute("UPDATE compress_jobs SET lease_expires = 0")
+    db.commit()
+    assert mm.lease_next_job(db, 'w2') == '/share/movies/a.mkv'
+    # The first worker lost its lease, so its completion must not count
+    mm.complete_job(db, '/share/movies/a.mkv', 'w1')
+    assert db.execute("SELECT status, worker_id FROM compress_jobs").fetchone() == ('leased', 'w2')
+
+
+def test_released_lease_is_requeued_without_spending_an_attempt(mm, db, add_file):
+    add_file('/share/movies/a.mkv')
+    mm.enqueue_compress_jobs(db, 'movie', 0)
+    queue = mm.LeaseQueue('w1')
+    assert queue.next_job(db) == '/share/movies/a.mkv'
+    queue.release(db, '/share/movies/a.mkv')
+    assert db.execute("SELECT status, attempts, worker_id FROM compress_jobs").fetchone() == ('queued', 0, None)
+    assert db.execute("SELECT claimed_by FROM media_files").fetchone() == (None,)
+    assert mm.lease_next_job(db, 'w2') == '/share/movies/a.mkv'
+
+
+def test_job_fails_after_max_attempts(mm, db, add_file):
+    add_file('/share/movies/a.mkv')
+    mm.enqueue_compress_jobs(db, 'movie', 0)
+    for _ in range(mm.MAX_JOB_ATTEMPTS):
+        assert mm.lease_next_job(db, 'w1') == '/share/movies/a.mkv'
+        mm.fail_job(db, '/share/movies/a.mkv', 'w1', RuntimeError('encode failed'))
+    assert mm.lease_next_job(db, 'w1') is None
+    assert db.execute("SELECT status, last_error FROM compress_jobs").fetchone() == ('failed', 'encode failed')
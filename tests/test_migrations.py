@@ -0,0 +1,70 @@
+import sqlite3
+
+import pytest
+
+
+def schema_version(conn):
+    return int(conn.execute("SELECT value FROM metadata WHERE key = 'schema_version'").fetchone()[0])
+
+
+def index_names(conn):
+    return {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+
+def query_plan(conn, sql):
+    return ' '.join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"))
+
+
+def test_original_schema_is_migrated_to_the_latest(mm):
+    # The media_files table as the first release created it, with no metadata table
+    conn = sqlite3.connect(mm.DB_PATH)
+    conn.execute("""CREATE TABLE media_files (file_path TEXT PRIMARY KEY, file_basename TEXT, file_size INTEGER,
+                    last_modified INTEGER, content_type TEXT, audio_metadata TEXT, subtitle_metadata TEXT,
+                    needs_compression BOOLEAN, has_been_reviewed BOOLEAN)""")
+    conn.execute("INSERT INTO media_files VALUES ('/media/movies/a.mkv', 'a.mkv', 1000, 0, 'movie', "
+                 "'[{\"language\": \"en\"}]', '[]', 1, 0)")
+    conn.commit()
+    conn.close()
+
+    conn = mm.setup_database(mm.DB_PATH)
+    try:
+        assert schema_version(conn) == len(mm.SCHEMA_MIGRATIONS)
+        assert {'idx_media_files_report', 'idx_compress_history_completed'} <= index_names(conn)
+        assert conn.execute("SELECT file_size, content_type FROM media_files").fetchall() == [(1000, 'movie')]
+    finally:
+        conn.close()
+
+
+def test_v6_database_gains_report_indexes(mm):
+    conn = mm.setup_database(mm.DB_PATH)
+    conn.execute("DROP INDEX idx_media_files_report")
+    conn.execute("DROP INDEX idx_compress_history_completed")
+    conn.execute("UPDATE metadata SET value = '6' WHERE key = 'schema_version'")
+    conn.commit()
+    conn.close()
+
+    conn = mm.setup_database(mm.DB_PATH)
+    try:
+        assert schema_version(conn) == 7
+        assert {'idx_media_files_report', 'idx_compress_history_completed'} <= index_names(conn)
+    finally:
+        conn.close()
+
+
+def test_migrations_are_idempotent(mm):
+    mm.setup_database(mm.DB_PATH).close()
+    conn = mm.setup_database(mm.DB_PATH)
+    try:
+        assert schema_version(conn) == len(mm.SCHEMA_MIGRATIONS)
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('report, index', [
+    ('space', 'idx_media_files_report'),
+    ('review', 'idx_media_files_report'),
+    ('savings', 'idx_compress_history_completed'),
+])
+def test_reports_read_only_covering_indexes(mm, db, report, index):
+    db.execute("ANALYZE")
+    assert f'COVERING INDEX {index}' in query_plan(db, mm.REPORTS[report])
@@ -0,0 +1,59 @@
+from containers import (ac3_entry, avc_entry, build_mkv, build_mp4, mkv_bit_rate_tag, mkv_track, mp4_track)
+
+
+def movie_tracks():
+    return [
+        mkv_track(1, 1, 'V_MPEG4/ISO/AVC', width=1920, height=1080, default_duration=41708333),
+        mkv_track(2, 2, 'A_AC3', channels=6),
+        mkv_track(3, 2, 'A_AAC', language='ger', channels=2),
+        mkv_track(4, 0x11, 'S_TEXT/UTF8', language='fre', bcp47='fr-CA'),
+    ]
+
+
+def test_parse_matroska(mm, tmp_path):
+    path = tmp_path / 'film.mkv'
+    path.write_bytes(build_mkv(movie_tracks(), tags=mkv_bit_rate_tag(1, 8000000) + mkv_bit_rate_tag(2, 640000)))
+    audio_tracks, subtitle_tracks, video_info = mm.parse_matroska(str(path))
+    assert video_info == {'codec': 'AVC', 'width': 1920, 'height': 1080, 'frame_rate': 23.976, 'duration': 5400.0,
+                          'bit_rate': 8000000}
+    # Language defaults to English when the element is absent
+    assert audio_tracks == [{'language': 'en', 'format': 'AC-3', 'channels': '6', 'bit_rate': '640000'},
+                            {'language': 'de', 'format': 'AAC', 'channels': '2', 'bit_rate': 'Unknown'}]
+    # LanguageBCP47 overrides Language
+    assert subtitle_tracks == [{'language': 'fr-CA', 'format': 'UTF-8'}]
+
+
+def test_unparseable_header_falls_back_to_mediainfo(mm, tmp_path, monkeypatch):
+    path = tmp_path / 'fake.mkv'
+    path.write_bytes(b'\0' * 64)
+    monkeypatch.setattr(mm, 'get_mediainfo_metadata', lambda file_path: ([], [], {'codec': 'mediainfo'}))
+    assert mm.get_file_metadata(str(path)) == ([], [], {'codec': 'mediainfo'})
+
+
+def test_parse_mp4(mm, tmp_path):
+    path = tmp_path / 'film.mp4'
+    path.write_bytes(build_mp4([
+        mp4_track('vide', avc_entry(3840, 2160), language='und'),
+        mp4_track('soun', ac3_entry(acmod=7, lfe=1, rate_code=15), language='eng', timescale=48000),
+        mp4_track('sbtl', b'', language='spa'),
+    ], duration=7200))
+    audio_tracks, subtitle_tracks, video_info = mm.parse_mp4(str(path))
+    assert video_info == {'codec': 'AVC', 'width': 3840, 'height': 2160, 'frame_rate': 23.976, 'duration': 7200.0,
+                          'bit_rate': None}
+    assert audio_tracks == [{'language': 'en', 'format': 'AC-3', 'channels': '6', 'bit_rate': '448000'}]
+    assert subtitle_tracks == [{'language': 'es', 'format': 'Unknown'}]
+
+
+def test_parse_mp4_without_moov(mm, tmp_path):
+    path = tmp_path / 'fragment.mp4'
+    path.write_bytes(b'\0\0\0\x10mdat' + b'\0' * 8)
+    assert mm.parse_mp4(str(path)) is None
+
+
+def test_get_file_metadata_uses_native_parser(mm, tmp_path, monkeypatch):
+    path = tmp_path / 'film.mkv'
+    path.write_bytes(build_mkv(movie_tracks()))
+    calls = []
+    monkeypatch.setattr(mm, 'get_mediainfo_metadata', calls.append)
+    assert mm.get_file_metadata(str(path))[2]['width'] == 1920
+    assert calls == []
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+
+@pytest.mark.parametrize('width, size', [
+    (640, (854, 480)),
+    (1024, (1280, 720)),
+    (1280, (1280, 720)),
+    (1440, (1920, 1080)),
+    (1500, (1920, 1080)),
+    (1920, (1920, 1080)),
+    (2560, (3840, 2160)),
+    (4096, (3840, 2160)),
+])
+def test_tier_is_never_below_the_source(mm, width, size):
+    preset = mm.get_encode_profile('movie', width, 23.976)['preset']
+    assert (preset['PictureWidth'], preset['PictureHeight']) == size
+    assert preset['PictureWidth'] >= min(width, mm.PROFILE_RESOLUTION_TIERS[-1][0])
+
+
+def test_profile_keeps_constant_quality(mm):
+    base = mm.load_handbrake_preset()
+    preset = mm.get_encode_profile('movie', 1920, 23.976)['preset']
+    assert preset['VideoQualityType'] == base['VideoQualityType'] == 2
+    assert preset['VideoQualitySlider'] == base['VideoQualitySlider']
+    assert preset.get('VideoAvgBitrate') == base.get('VideoAvgBitrate')
+
+
+def test_profile_is_written_and_reused(mm):
+    first = mm.get_encode_profile('tv_show', 1280, 25.0)
+    assert mm.get_encode_profile('tv_show', 1100, 25.0) is first
+    with open(first['path']) as f:
+        assert json.load(f)['PresetList'][0]['PresetName'] == first['name']
+    # Narrow sources skip the second pass
+    assert first['preset']['VideoMultiPass'] is False
+
+
+def test_unprobed_source_uses_the_base_preset(mm):
+    assert mm.get_encode_profile('movie', None, None) is None
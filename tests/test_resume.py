@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+AUDIO = [{'language': 'English', 'format': 'AAC'}]
+VIDEO = {'codec': 'AVC', 'width': 1920, 'height': 1080, 'frame_rate': 24.0, 'duration': 0.01, 'bit_rate': 20000000}
+
+
+class Crash(BaseException):
+    """Stands in for the process dying: compress_file only handles Exception."""
+
+
+@pytest.fixture
+def library(mm, db, tmp_path, monkeypatch):
+    movies = tmp_path / 'library' / 'movies'
+    movies.mkdir(parents=True)
+    (movies / 'film.mkv').write_bytes(os.urandom(64 * 1024))
+    monkeypatch.setattr(mm, 'get_file_metadata', lambda file_path: (AUDIO, [], dict(VIDEO)))
+    encodes = []
+
+    def encode_file(input_file, output_file, threads=None, segment=None, profile=None):
+        encodes.append(input_file)
+        with open(output_file, 'wb') as f:
+            f.write(os.urandom(16 * 1024))
+        return {'wall_seconds': 1.0, 'avg_fps': 90.0, 'profile': profile}
+
+    monkeypatch.setattr(mm, 'encode_file', encode_file)
+    mm.scan_files(str(tmp_path / 'library'), db)
+    return {'root': str(tmp_path / 'library'), 'source': str(movies / 'film.mkv'),
+            'compressed': str(movies / 'film.mp4'), 'encodes': encodes}
+
+
+def crash_once(mm, monkeypatch, name):
+    original = getattr(mm, name)
+
+    def crashing(*args, **kwargs):
+        monkeypatch.setattr(mm, name, original)
+        raise Crash(name)
+
+    monkeypatch.setattr(mm, name, crashing)
+
+
+def assert_compressed(mm, db, library):
+    assert not os.path.exists(library['source'])
+    assert os.path.exists(library['compressed'])
+    assert db.execute("SELECT file_path, needs_compression, estimate_source FROM media_files").fetchall() == [
+        (library['compressed'], 0, None)]
+    assert db.execute("SELECT file_path FROM audio_tracks").fetchall() == [(library['compressed'],)]
+    assert db.execute("SELECT phase FROM compress_state").fetchall() == [('db_updated',)]
+    assert mm.get_unfinished_compressions(db) == []
+    assert not os.path.exists(mm.get_staging_paths(library['source'])[0])
+
+
+def test_compress_without_interruption(mm, db, library):
+    assert mm.compress_file(library['source'], db)
+    assert_compressed(mm, db, library)
+    assert len(library['encodes']) == 1
+
+
+@pytest.mark.parametrize('crash_in, phase, encodes', [
+    ('encode_phase', 'copied_in', 1),
+    ('upload_phase', 'encoded', 1),
+    ('remove_original_phase', 'uploaded', 1),
+    ('record_compressed_file', 'original_removed', 1),
+])
+def test_resume_after_each_phase(mm, db, library, monkeypatch, crash_in, phase, encodes):
+    crash_once(mm, monkeypatch, crash_in)
+    with pytest.raises(Crash):
+        mm.compress_file(library['source'], db)
+    assert db.execute("SELECT phase FROM compress_state").fetchone() == (phase,)
+
+    mm.resume_unfinished_compressions(mm.ClaimedFileList([], mm.get_worker_id()), db)
+    assert_compressed(mm, db, library)
+    # Work finished before the crash is verified and reused, not redone
+    assert len(library['encodes']) == encodes
+
+
+def test_corrupted_staged_input_starts_over(mm, db, library, monkeypatch):
+    crash_once(mm, monkeypatch, 'encode_phase')
+    with pytest.raises(Crash):
+        mm.compress_file(library['source'], db)
+    input_file = mm.get_staging_paths(library['source'])[1]
+    with open(input_file, 'r+b') as f:
+        f.write(b'corrupt')
+
+    mm.resume_unfinished_compressions(mm.ClaimedFileList([], mm.get_worker_id()), db)
+    assert_compressed(mm, db, library)
+
+
+@pytest.mark.parametrize('crash_in', ['remove_original_phase', 'record_compressed_file'])
+def test_scan_between_crash_and_resume(mm, db, library, monkeypatch, crash_in):
+    crash_once(mm, monkeypatch, crash_in)
+    with pytest.raises(Crash):
+        mm.compress_file(library['source'], db)
+
+    # The scan sees the uploaded file, and the original too if it was not removed yet
+    mm.scan_files(library['root'], db, full=True)
+    assert (library['compressed'],) in db.execute("SELECT file_path FROM media_files").fetchall()
+
+    mm.resume_unfinished_compressions(mm.ClaimedFileList([], mm.get_worker_id()), db)
+    assert_compressed(mm, db, library)
@@ -0,0 +1,126 @@
+import struct
+import zlib
+
+import pytest
+
+from containers import ac3_entry, avc_entry, build_mkv, build_mp4, mkv_track, mp4_track
+
+CLUSTER = bytes(range(256)) * 16
+
+
+def tracks(first_audio_language='ger'):
+    return [
+        mkv_track(1, 1, 'V_MPEG4/ISO/AVC', width=1280, height=720),
+        mkv_track(2, 2, 'A_AAC', language=first_audio_language, channels=2),
+        mkv_track(3, 2, 'A_AC3', channels=6),
+        mkv_track(4, 0x11, 'S_TEXT/UTF8', language='eng', bcp47='en-GB'),
+    ]
+
+
+def write_mkv(tmp_path, **kwargs):
+    path = tmp_path / 'film.mkv'
+    path.write_bytes(build_mkv(kwargs.pop('tracks', None) or tracks(), cluster=CLUSTER, **kwargs))
+    return path
+
+
+def languages(mm, path):
+    audio_tracks, subtitle_tracks, _ = mm.parse_matroska(str(path))
+    return [track['language'] for track in audio_tracks + subtitle_tracks]
+
+
+def test_same_length_edit(mm, tmp_path):
+    path = write_mkv(tmp_path)
+    size = path.stat().st_size
+    assert mm.retag_matroska(str(path), {('a', 0): 'fr'})
+    assert path.stat().st_size == size
+    assert languages(mm, path) == ['fr', 'en', 'en-GB']
+    assert path.read_bytes().endswith(CLUSTER)
+
+
+def test_growth_into_following_void(mm, tmp_path):
+    path = write_mkv(tmp_path, void=64)
+    original = path.read_bytes()
+    # The second audio track has no Language element yet, so its entry grows
+    assert mm.retag_matroska(str(path), {('a', 1): 'spa', ('s', 0): 'ger'})
+    data = path.read_bytes()
+    assert len(data) == len(original)
+    assert data.endswith(CLUSTER)
+    assert languages(mm, path) == ['de', 'es', 'de']
+    # What's left of the Void still sits between Tracks and the unmoved Cluster
+    with open(path, 'rb') as f:
+        tracks_offset = mm._matroska_layout(f)[0x1654AE6B]
+        _, payload_start, size = mm._read_ebml_header(f, tracks_offset)
+        void_id, void_start, void_size = mm._read_ebml_header(f, payload_start + size)
+    assert void_id == 0xEC
+    assert data.index(CLUSTER) == original.index(CLUSTER) == void_start + void_size + len(
+        mm._ebml_encode(0x1F43B675, CLUSTER)) - len(CLUSTER)
+
+
+def test_growth_without_void_leaves_file_alone(mm, tmp_path):
+    path = write_mkv(tmp_path)
+    original = path.read_bytes()
+    assert not mm.retag_matroska(str(path), {('a', 1): 'spa'})
+    assert path.read_bytes() == original
+
+
+def test_language_bcp47_is_dropped(mm, tmp_path):
+    path = write_mkv(tmp_path)
+    assert mm.retag_matroska(str(path), {('s', 0): 'fr'})
+    assert b'en-GB' not in path.read_bytes()
+    # Matroska wants the bibliographic code
+    assert b'fre' in path.read_bytes()
+    assert languages(mm, path)[-1] == 'fr'
+
+
+def test_crc_is_recomputed(mm, tmp_path):
+    path = write_mkv(tmp_path, crc=True)
+    assert mm.retag_matroska(str(path), {('a', 0): 'ita'})
+    with open(path, 'rb') as f:
+        tracks_offset = mm._matroska_layout(f)[0x1654AE6B]
+        _, payload_start, size = mm._read_ebml_header(f, tracks_offset)
+        f.seek(payload_start)
+        payload = f.read(size)
+    children = list(mm._ebml_children(payload))
+    assert children[0][0] == 0xBF
+    rest = b''.join(mm._ebml_encode(child_id, child) for child_id, child in children[1:])
+    assert struct.unpack('<I', children[0][1])[0] == zlib.crc32(rest)
+
+
+def test_unknown_stream_is_rejected(mm, tmp_path):
+    path = write_mkv(tmp_path)
+    original = path.read_bytes()
+    with pytest.raises(ValueError):
+        mm.retag_matroska(str(path), {('a', 5): 'eng'})
+    assert path.read_bytes() == original
+
+
+def test_mp4_patches_mdhd_and_drops_elng(mm, tmp_path):
+    path = tmp_path / 'film.mp4'
+    path.write_bytes(build_mp4([
+        mp4_track('vide', avc_entry(1920, 1080)),
+        mp4_track('soun', ac3_entry(acmod=2, lfe=0, rate_code=0), language='eng', elng='en-US'),
+    ]))
+    size = path.stat().st_size
+    assert mm.retag_mp4(str(path), {('a', 0): 'fre'})
+    data = path.read_bytes()
+    assert len(data) == size
+    assert b'elng' not in data and b'free' in data
+    # MP4 stores the terminology code
+    packed = sum((ord(char) - 0x60) << shift for char, shift in zip('fra', (10, 5, 0)))
+    assert struct.pack('>H', packed) in data
+    assert mm.parse_mp4(str(path))[0][0]['language'] == 'fr'
+
+
+def test_retag_languages_remuxes_when_headers_do_not_fit(mm, tmp_path, monkeypatch):
+    path = write_mkv(tmp_path)
+    remuxed = []
+    monkeypatch.setattr(mm, 'remux_languages', lambda file_path, edits: remuxed.append(edits))
+    assert mm.retag_languages(str(path), {('a', 1): 'spa'})
+    assert remuxed == [{('a', 1): 'spa'}]
+
+
+def test_parse_language_edits(mm):
+    assert mm.parse_language_edits('a:0=eng s:1=spa') == {('a', 0): 'eng', ('s', 1): 'spa'}
+    for text in ('a0=eng', 'v:0=eng', 'a:x=eng', 'a:0='):
+        with pytest.raises(ValueError):
+            mm.parse_language_edits(text)
@@ -0,0 +1,45 @@
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def movies(mm, tmp_path, monkeypatch):
+    monkeypatch.setattr(mm, 'get_file_metadata', lambda file_path: ([{'language': 'English', 'format': 'AAC'}], [], {}))
+    path = tmp_path / 'library' / 'movies'
+    path.mkdir(parents=True)
+    return path
+
+
+def write(path, age):
+    path.write_bytes(b'x' * 100)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def test_settled_files_are_probed_as_one_batch(mm, db, movies, monkeypatch):
+    old = [write(movies / f'{i}.mkv', age=3600) for i in range(25)]
+    fresh = write(movies / 'copying.mkv', age=0)
+    pending = {file_path: (None, 0) for file_path in old + [fresh]}
+    commits = []
+    monkeypatch.setattr(mm, 'DB_WRITE_INTERVAL', 10)
+    original_probe_files = mm.probe_files
+    monkeypatch.setattr(mm, 'probe_files', lambda tasks, db_conn, workers: commits.append(len(tasks))
+                        or original_probe_files(tasks, db_conn, workers))
+
+    mm.update_settled_files(pending, db, workers=4)
+    assert commits == [25]
+    assert sorted(row[0] for row in db.execute("SELECT file_path FROM media_files")) == sorted(old)
+    # Still being written: waits for its size to hold
+    assert list(pending) == [fresh]
+
+
+def test_watch_catch_up_scan_probes_old_files_immediately(mm, db, movies):
+    old = write(movies / 'old.mkv', age=3600)
+    fresh = write(movies / 'new.mkv', age=0)
+    pending = {}
+    mm.scan_files(str(movies.parent), db, workers=2, pending=pending)
+    assert db.execute("SELECT file_path FROM media_files").fetchall() == [(old,)]
+    assert list(pending) == [fresh]